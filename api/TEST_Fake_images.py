@@ -1,7 +1,10 @@
 # route: /api/image_generator
 from http.server import BaseHTTPRequestHandler
 import os, json, base64, logging, sys, io, re, random
-from cgi import parse_header
+
+# Sibling helper modules (api/_*.py are not deployed as routes)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _body import parse_upload, read_body, BodyTooLarge
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
 log = logging.getLogger("image_generator")
@@ -102,23 +105,23 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         send_json(self, 200, {
             "ok": True,
-            "usage": "POST application/json with: { image_base64: string, number_of_images: number }. Returns base64 images WITHOUT calling OpenAI.",
+            "usage": "POST application/json with: { image_base64: string, number_of_images: number }, or the raw image as an image/* body (?number_of_images=N), or multipart/form-data with an 'image' file part. Returns base64 images WITHOUT calling OpenAI.",
             "description": "Stub mode for testing: echoes your image and/or tiny placeholder PNGs as base64 so you can test your pipeline without incurring costs."
         })
 
     def do_POST(self):
         # --- tolerant body read + parsing -----------------------------------
         ctype_raw = self.headers.get("content-type", "") or ""
-        clen_raw  = self.headers.get("content-length", "") or ""
-        try:
-            clen = int(clen_raw) if clen_raw else 0
-        except Exception:
-            clen = 0
+        main_type = ctype_raw.split(";", 1)[0].strip().lower()
 
-        main_type, _ = parse_header(ctype_raw)
-        main_type = (main_type or "").lower()
-
-        body = self.rfile.read(clen) if clen else b""
+        try:
+            body = read_body(self)
+        except BodyTooLarge as e:
+            self.close_connection = True
+            return send_json(self, 413, {"error": str(e)})
+        except ValueError as e:
+            self.close_connection = True
+            return send_json(self, 400, {"error": str(e)})
         raw = (body or b"").strip()
 
         # Accept JSON (with/without charset), or anything that starts with "{"
@@ -129,8 +132,13 @@ class handler(BaseHTTPRequestHandler):
         log.info("POST content-type=%r main=%r len=%d jsonish=%s form=%s",
                  ctype_raw, main_type, len(raw), is_jsonish, is_form)
 
+        image_bytes = None
         try:
-            if is_form:
+            upload = parse_upload(main_type, ctype_raw, body or b"", self.path)
+            if upload is not None:
+                # Binary upload (raw image/* or multipart): no base64 round trip
+                data, image_bytes = upload
+            elif is_form:
                 from urllib.parse import parse_qs
                 qs = parse_qs(raw.decode("utf-8", "ignore"))
                 data = {k: v[0] for k, v in qs.items()}
@@ -138,7 +146,7 @@ class handler(BaseHTTPRequestHandler):
                 data = json.loads(raw.decode("utf-8", "ignore") or "{}")
         except Exception:
             return send_json(self, 400, {
-                "error": "Invalid request body. Send JSON or x-www-form-urlencoded.",
+                "error": "Invalid request body. Send JSON, x-www-form-urlencoded, multipart/form-data or a raw image/* body.",
                 "got_content_type": ctype_raw,
                 "body_preview": raw[:100].decode("utf-8", "ignore")
             })
@@ -146,8 +154,8 @@ class handler(BaseHTTPRequestHandler):
         image_base64 = (data.get("image_base64") or "").strip()
         number_of_images = data.get("number_of_images", 2)
 
-        if not image_base64:
-            return send_json(self, 400, {"error": "Missing 'image_base64'"})
+        if not image_base64 and not image_bytes:
+            return send_json(self, 400, {"error": "Missing 'image_base64' (or an image upload)"})
 
         # Validate number_of_images
         try:
@@ -157,16 +165,23 @@ class handler(BaseHTTPRequestHandler):
         except (ValueError, TypeError):
             return send_json(self, 400, {"error": "number_of_images must be a valid integer"})
 
-        # Extract base64 from image_base64 (if it's a data URL, otherwise use as-is)
-        mime_hint, base64_image = _strip_data_url(image_base64)
-        if not base64_image:
-            base64_image = image_base64
-
-        try:
-            # Validate base64 image data (so clients get early, clear errors)
-            _decode_image_b64(base64_image)
-        except Exception as e:
-            return send_json(self, 400, {"error": f"Invalid base64 image data: {str(e)}"})
+        if image_bytes:
+            mime_hint = _detect_mime(image_bytes)
+            if mime_hint == "application/octet-stream":
+                return send_json(self, 400, {"error": "Unrecognized image upload (expected PNG, JPEG or WEBP)"})
+            # single encode, only because the model/response payload needs base64
+            base64_image = base64.b64encode(image_bytes).decode("ascii")
+        else:
+            # Extract base64 from image_base64 (if it's a data URL, otherwise use as-is)
+            mime_hint, base64_image = _strip_data_url(image_base64)
+            if not base64_image:
+                base64_image = image_base64
+
+            try:
+                # Validate base64 image data (so clients get early, clear errors)
+                _decode_image_b64(base64_image)
+            except Exception as e:
+                return send_json(self, 400, {"error": f"Invalid base64 image data: {str(e)}"})
 
         try:
             # ---- STUB PIPELINE (no OpenAI) ---------------------------------
@@ -0,0 +1,61 @@
+# Process-wide asyncio engine: one event loop on a daemon thread, shared by every request,
+# plus a global cap on concurrent upstream calls.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, asyncio, threading, logging
+from contextlib import asynccontextmanager
+
+log = logging.getLogger("aio")
+
+# Upper bound on concurrent upstream (OpenAI) calls across all requests in this process
+MAX_UPSTREAM_CALLS = int(os.environ.get("MAX_UPSTREAM_CALLS", "32") or "32")
+
+_lock = threading.Lock()
+_loop = None
+_upstream = None
+_counters = {"calls": 0, "in_flight": 0, "peak_in_flight": 0, "waiting": 0}
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """The engine loop, started on first use."""
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="aio-engine", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def submit(coro):
+    """Schedule a coroutine on the engine loop from any thread. Returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_sync(coro, timeout: float = None):
+    """Run a coroutine on the engine loop and block the calling (non-loop) thread for its result."""
+    return submit(coro).result(timeout)
+
+
+@asynccontextmanager
+async def upstream_slot():
+    """Hold one of the MAX_UPSTREAM_CALLS process-wide slots for the duration of an upstream call."""
+    global _upstream
+    if _upstream is None:
+        _upstream = asyncio.Semaphore(MAX_UPSTREAM_CALLS)  # only ever touched on the engine loop
+    _counters["waiting"] += 1
+    try:
+        await _upstream.acquire()
+    finally:
+        _counters["waiting"] -= 1
+    _counters["calls"] += 1
+    _counters["in_flight"] += 1
+    _counters["peak_in_flight"] = max(_counters["peak_in_flight"], _counters["in_flight"])
+    try:
+        yield
+    finally:
+        _counters["in_flight"] -= 1
+        _upstream.release()
+
+
+def engine_stats() -> dict:
+    return {**_counters, "max_upstream_calls": MAX_UPSTREAM_CALLS}
@@ -0,0 +1,196 @@
+# Result blob store: generated images are written once (content-addressed) and referenced by
+# URL / key / size / sha256 in responses and callbacks instead of inline base64.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, io, abc, shutil, hashlib, tempfile, threading, logging
+from urllib.parse import quote
+
+log = logging.getLogger("blobs")
+
+BLOB_STORE            = os.environ.get("BLOB_STORE", "").lower()     # "", "local" or "s3"
+BLOB_DIR              = os.environ.get("BLOB_DIR", "/tmp/improve2_blobs")
+BLOB_PREFIX           = os.environ.get("BLOB_PREFIX", "results/")
+BLOB_PUBLIC_URL       = os.environ.get("BLOB_PUBLIC_URL", "").rstrip("/")  # base URL serving the keys, if public
+BLOB_URL_TTL          = int(os.environ.get("BLOB_URL_TTL", str(7 * 24 * 3600)) or "3600")  # presigned URL lifetime
+BLOB_S3_BUCKET        = os.environ.get("BLOB_S3_BUCKET", "")
+BLOB_S3_ENDPOINT      = os.environ.get("BLOB_S3_ENDPOINT", "")  # S3-compatible services (R2, MinIO, Supabase Storage)
+BLOB_S3_REGION        = os.environ.get("BLOB_S3_REGION", "")
+# Outputs up to this size stay inline (base64) in "auto" delivery
+BLOB_INLINE_MAX_BYTES = int(os.environ.get("BLOB_INLINE_MAX_BYTES", str(64 * 1024)) or "0")
+
+CHUNK = 1024 * 1024
+SPOOL_MAX_MEMORY = 8 * CHUNK  # file-like inputs larger than this are hashed into a temp file, not memory
+
+_EXT = {"image/jpeg": "jpg", "image/webp": "webp", "image/avif": "avif", "image/png": "png"}
+
+
+class BlobStore(abc.ABC):
+    """
+    put() stores a blob under a key derived from its sha256 (so a result is written once,
+    however often it is published) and returns a reference {key, url, bytes, sha256, content_type}.
+    Subclasses provide exists(), write() and url().
+    """
+
+    def key_for(self, sha256: str, content_type: str) -> str:
+        return f"{BLOB_PREFIX}{sha256[:2]}/{sha256}.{_EXT.get(content_type, 'bin')}"
+
+    def put(self, data, content_type: str) -> dict:
+        """
+        data is bytes or a readable binary file object. A file object is read in CHUNK pieces
+        and hashed on the way into a spooled temp file, so it is never held in memory whole.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            sha256, size, src = hashlib.sha256(data).hexdigest(), len(data), io.BytesIO(data)
+        else:
+            sha256, size, src = _spool(data)
+        with src:
+            key = self.key_for(sha256, content_type)
+            if not self.exists(key):
+                self.write(key, src, content_type)
+        return {"key": key, "url": self.url(key), "bytes": size, "sha256": sha256, "content_type": content_type}
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        """True if `key` is already stored."""
+
+    @abc.abstractmethod
+    def write(self, key: str, src, content_type: str):
+        """Store the binary file object `src` (positioned at its start) under `key`."""
+
+    @abc.abstractmethod
+    def url(self, key: str) -> str:
+        """A URL clients can fetch `key` from."""
+
+
+def _spool(fileobj):
+    h, size = hashlib.sha256(), 0
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        for chunk in iter(lambda: fileobj.read(CHUNK), b""):
+            h.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return h.hexdigest(), size, spool
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Files under `directory` (testing and single-host setups), served by something else at
+    `public_url` (BLOB_PUBLIC_URL), which is required: file:// URLs would leak server paths
+    and no client could fetch them.
+    """
+
+    def __init__(self, directory: str = BLOB_DIR, public_url: str = BLOB_PUBLIC_URL):
+        if not public_url:
+            raise RuntimeError(LOCAL_NEEDS_PUBLIC_URL)
+        self.directory = directory
+        self.public_url = public_url.rstrip("/")
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, *key.split("/"))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def write(self, key: str, src, content_type: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                shutil.copyfileobj(src, f, CHUNK)
+            os.replace(tmp, path)  # atomic; concurrent writers of the same key are harmless
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{quote(key)}"
+
+
+class S3BlobStore(BlobStore):
+    """
+    S3 or any S3-compatible service (endpoint_url). URLs are BLOB_PUBLIC_URL/key for public
+    buckets / CDNs, presigned GET URLs (BLOB_URL_TTL) otherwise. Credentials come from the
+    usual AWS environment variables.
+    """
+
+    def __init__(self, bucket: str = BLOB_S3_BUCKET, endpoint_url: str = BLOB_S3_ENDPOINT,
+                 region: str = BLOB_S3_REGION, public_url: str = BLOB_PUBLIC_URL):
+        try:
+            import boto3  # optional: only needed for BLOB_STORE=s3, imported when the store is built
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("BLOB_STORE=s3 needs boto3 (pip install boto3)")
+        if not bucket:
+            raise RuntimeError("BLOB_STORE=s3 needs BLOB_S3_BUCKET")
+        self.bucket = bucket
+        self.public_url = public_url
+        self.ClientError = ClientError
+        self.s3 = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region or None)
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def write(self, key: str, src, content_type: str):
+        # upload_fileobj streams in parts (multipart above its threshold)
+        self.s3.upload_fileobj(src, self.bucket, key, ExtraArgs={
+            "ContentType": content_type,
+            "CacheControl": "public, max-age=31536000, immutable",  # content-addressed keys never change
+        })
+
+    def url(self, key: str) -> str:
+        if self.public_url:
+            return f"{self.public_url}/{quote(key)}"
+        return self.s3.generate_presigned_url("get_object", Params={"Bucket": self.bucket, "Key": key},
+                                              ExpiresIn=BLOB_URL_TTL)
+
+
+LOCAL_NEEDS_PUBLIC_URL = "BLOB_STORE=local needs BLOB_PUBLIC_URL (file:// URLs are not reachable by clients)"
+
+_lock = threading.Lock()
+_store = None
+_warned = False
+
+
+def blob_store_problem():
+    """Why the configured BLOB_STORE cannot serve clients, or None."""
+    if BLOB_STORE == "local" and not BLOB_PUBLIC_URL:
+        return LOCAL_NEEDS_PUBLIC_URL
+    return None
+
+
+def get_blob_store():
+    """The configured store (BLOB_STORE), or None when results are always inline."""
+    global _store, _warned
+    if BLOB_STORE in ("", "none", "inline"):
+        return None
+    problem = blob_store_problem()
+    if problem:
+        if not _warned:
+            _warned = True
+            log.warning(f"Blob store disabled, results stay inline: {problem}")
+        return None
+    with _lock:
+        if _store is None:
+            if BLOB_STORE == "local":
+                _store = LocalBlobStore()
+            elif BLOB_STORE == "s3":
+                _store = S3BlobStore()
+            else:
+                raise RuntimeError(f"Unknown BLOB_STORE {BLOB_STORE!r} (use local or s3)")
+            log.info(f"Result blob store: {type(_store).__name__}")
+        return _store
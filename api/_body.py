@@ -0,0 +1,130 @@
+# Request body helpers shared by the api/ handlers.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os
+from urllib.parse import urlparse, parse_qs
+
+IMAGE_FIELD_NAMES = ("image", "image_file", "file")
+
+# Hard cap on request bodies, enforced while reading (6MB image as base64 JSON ~ 8.2MB)
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", str(10 * 1024 * 1024)) or "0")
+
+
+class BodyTooLarge(Exception):
+    """Request body exceeds the configured limit (respond with 413)."""
+
+    def __init__(self, size: int, limit: int):
+        super().__init__(f"Request body too large ({size} bytes, limit {limit})")
+        self.size = size
+        self.limit = limit
+
+
+def read_body(handler, max_bytes: int = None) -> bytearray:
+    """
+    Read the request body in O(n), supporting both Content-Length and
+    Transfer-Encoding: chunked (used by Deno fetch).
+
+    The limit is checked before any byte past it is read: a too-large
+    Content-Length is rejected up front, a chunked body as soon as the
+    running total crosses it. Raises BodyTooLarge (-> 413) or ValueError
+    for truncated/malformed bodies (-> 400).
+    """
+    limit = MAX_BODY_BYTES if max_bytes is None else max_bytes
+    rfile = handler.rfile
+    if "chunked" in (handler.headers.get("transfer-encoding", "") or "").lower():
+        return _read_chunked(rfile, limit)
+
+    try:
+        clen = int(handler.headers.get("content-length", "0") or "0")
+    except ValueError:
+        clen = 0
+    if clen <= 0:
+        return bytearray()
+    if limit and clen > limit:
+        raise BodyTooLarge(clen, limit)
+
+    # preallocate once and fill in place
+    buf = bytearray(clen)
+    view = memoryview(buf)
+    got = 0
+    while got < clen:
+        n = rfile.readinto(view[got:])
+        if not n:
+            raise ValueError(f"Incomplete request body ({got} of {clen} bytes)")
+        got += n
+    return buf
+
+
+def _read_chunked(rfile, limit: int) -> bytearray:
+    buf = bytearray()  # bytearray appends are amortized O(1), unlike bytes +=
+    while True:
+        size_line = rfile.readline(1024)
+        if not size_line:
+            raise ValueError("Incomplete chunked body")
+        size_line = size_line.strip()
+        if not size_line:
+            continue
+        try:
+            size = int(size_line.split(b";", 1)[0], 16)  # ignore chunk extensions
+        except ValueError:
+            raise ValueError(f"Invalid chunk size line: {size_line[:40]!r}")
+        if size == 0:
+            # optional trailer headers, terminated by an empty line
+            while True:
+                line = rfile.readline(1024)
+                if not line or not line.strip():
+                    break
+            return buf
+        if limit and len(buf) + size > limit:
+            raise BodyTooLarge(len(buf) + size, limit)
+        chunk = rfile.read(size)
+        if len(chunk) != size:
+            raise ValueError("Incomplete chunked body")
+        buf += chunk
+        rfile.readline(1024)  # CRLF after the chunk data
+
+
+def query_params(path: str) -> dict:
+    """Single-valued query string parameters of a request path."""
+    return {k: v[0] for k, v in parse_qs(urlparse(path).query).items()}
+
+
+def parse_upload(main_type: str, ctype_raw: str, body, path: str):
+    """
+    Parse a binary image upload without any base64 step.
+
+    - image/*             -> the body IS the image; parameters come from the query string
+    - multipart/form-data -> the image is the "image" file part (or the first image/* part);
+                             other parts are form fields, layered over the query string
+
+    Returns (fields, image_bytes), or None when the body is not a binary upload
+    (callers then fall back to JSON / x-www-form-urlencoded).
+    """
+    main_type = (main_type or "").lower()
+    fields = query_params(path)
+
+    if main_type.startswith("image/"):
+        return fields, (body or None)
+
+    if main_type != "multipart/form-data":
+        return None
+
+    from email.parser import BytesParser  # only multipart uploads need the email package
+    from email.policy import HTTP
+
+    head = b"Content-Type: " + ctype_raw.encode("latin-1", "ignore") + b"\r\n\r\n"
+    msg = BytesParser(policy=HTTP).parsebytes(head + body)
+    if not msg.is_multipart():
+        raise ValueError("Malformed multipart body")
+
+    image_bytes = None
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition") or ""
+        payload = part.get_payload(decode=True) or b""
+        is_file = part.get_filename() is not None or part.get_content_maintype() == "image"
+        if is_file:
+            if image_bytes is None or name in IMAGE_FIELD_NAMES:
+                image_bytes = payload
+        elif name:
+            fields[name] = payload.decode(part.get_content_charset() or "utf-8", "ignore")
+
+    return fields, image_bytes
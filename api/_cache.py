@@ -0,0 +1,323 @@
+# Result caches for model outputs: content-addressed (memory LRU + disk tier) and perceptual-hash keyed.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, io, time, hashlib, threading, base64, logging
+from collections import OrderedDict
+
+log = logging.getLogger("cache")
+
+CACHE_DIR       = os.environ.get("GEN_CACHE_DIR", "/tmp/gen_cache")
+CACHE_MEM_BYTES = int(os.environ.get("GEN_CACHE_MEM_BYTES", str(64 * 1024 * 1024)) or "0")
+CACHE_DISK_BYTES = int(os.environ.get("GEN_CACHE_DISK_BYTES", str(512 * 1024 * 1024)) or "0")
+CACHE_TTL       = float(os.environ.get("GEN_CACHE_TTL", str(24 * 3600)) or "0")
+
+# A perceptual hit needs both: dHash within PHASH_MAX_DISTANCE bits and every cell of the 4x4 colour
+# signature within PHASH_MAX_COLOR_DIFF (0-255). On 200 synthetic product shots with one shared layout
+# (same backdrop and placement, different product shape and colour) these defaults matched 1 pair in
+# 19,900 and 99.5% of re-encodes / resizes (JPEG q60-85, WebP, 50-75% scale); dHash alone at the old
+# distance of 6 matched 933 pairs in 7,140, since it ignores colour. See tests/test_perceptual_cache.py.
+PHASH_MAX_ENTRIES    = int(os.environ.get("DESCRIBE_CACHE_MAX_ENTRIES", "512") or "0")
+PHASH_MAX_DISTANCE   = int(os.environ.get("DESCRIBE_CACHE_MAX_DISTANCE", "4") or "0")
+PHASH_MAX_COLOR_DIFF = int(os.environ.get("DESCRIBE_CACHE_MAX_COLOR_DIFF", "8") or "0")
+PHASH_TTL            = float(os.environ.get("DESCRIBE_CACHE_TTL", str(24 * 3600)) or "0")
+
+
+def cache_key(*parts) -> str:
+    """Stable key over arbitrary parts (image digest, prompt, model, settings...)."""
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def image_digest(url_or_dataurl: str):
+    """
+    sha256 of the normalized input image: decoded bytes for base64 / data URLs
+    (so whitespace or a different data URL prefix do not matter). None for http(s)
+    URLs: the image behind a URL can change, so callers fetch it and use bytes_digest().
+    """
+    s = (url_or_dataurl or "").strip()
+    if s.startswith("http://") or s.startswith("https://"):
+        return None
+    if s.startswith("data:"):
+        s = s.split(",", 1)[-1]
+    try:
+        buf = base64.b64decode("".join(s.split()))
+    except Exception:
+        buf = s.encode("utf-8")
+    return bytes_digest(buf)
+
+
+def bytes_digest(buf: bytes) -> str:
+    """sha256 of image bytes; equal to image_digest() of the same bytes as base64."""
+    return hashlib.sha256(buf).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier string cache. Memory tier is an LRU bounded by total bytes;
+    disk tier is one file per key under `directory`, evicted oldest-first
+    by total size. Both tiers expire entries after `ttl` seconds.
+    The disk tier's size is tracked in memory: the directory is scanned once, at
+    startup, and files other processes write later are only counted by their own process.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, mem_bytes: int = CACHE_MEM_BYTES,
+                 disk_bytes: int = CACHE_DISK_BYTES, ttl: float = CACHE_TTL):
+        self.directory = directory
+        self.mem_bytes = mem_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self._mem = OrderedDict()  # key -> (stored_at, value)
+        self._mem_size = 0
+        self._lock = threading.Lock()
+        self.counters = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+        self._disk = OrderedDict()  # key -> size, oldest write first
+        self._disk_size = 0
+        if directory and disk_bytes:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_scan()
+
+    # --- public API ---------------------------------------------------------
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry and (not self.ttl or now - entry[0] < self.ttl):
+                self._mem.move_to_end(key)
+                self.counters["mem_hits"] += 1
+                return entry[1]
+            if entry:
+                self._drop_mem(key)
+
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._mem_put(key, value, now)
+        return value
+
+    def put(self, key: str, value: str):
+        if not value:
+            return
+        now = time.time()
+        with self._lock:
+            self.counters["puts"] += 1
+            self._mem_put(key, value, now)
+        self._disk_put(key, value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            c = dict(self.counters)
+            c["mem_entries"] = len(self._mem)
+            c["mem_bytes"] = self._mem_size
+            c["disk_entries"] = len(self._disk)
+            c["disk_bytes"] = self._disk_size
+        hits = c["mem_hits"] + c["disk_hits"]
+        total = hits + c["misses"]
+        c["hit_rate"] = round(hits / total, 4) if total else 0.0
+        return c
+
+    # --- memory tier (call with lock held) ------------------------------------
+
+    def _mem_put(self, key, value, now):
+        if key in self._mem:
+            self._drop_mem(key)
+        if len(value) > self.mem_bytes:
+            return
+        self._mem[key] = (now, value)
+        self._mem_size += len(value)
+        while self._mem_size > self.mem_bytes:
+            old_key = next(iter(self._mem))
+            self._drop_mem(old_key)
+            self.counters["evictions"] += 1
+
+    def _drop_mem(self, key):
+        _, value = self._mem.pop(key)
+        self._mem_size -= len(value)
+
+    # --- disk tier ----------------------------------------------------------
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _disk_get(self, key, now):
+        if not (self.directory and self.disk_bytes):
+            return None
+        path = self._path(key)
+        try:
+            if self.ttl and now - os.path.getmtime(path) >= self.ttl:
+                self._disk_forget(key)
+                self._remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            self._disk_forget(key)
+            return None
+        except Exception as e:
+            log.warning(f"Cache read failed for {key[:12]}: {e}")
+            return None
+
+    def _disk_put(self, key, value):
+        if not (self.directory and self.disk_bytes):
+            return
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(value)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)  # atomic; concurrent writers of the same key are harmless
+            self._disk_add(key, size)
+        except Exception as e:
+            log.warning(f"Cache write failed for {key[:12]}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _disk_scan(self):
+        # startup only: index what earlier processes left, dropping expired entries and stray temp files
+        now = time.time()
+        entries = []
+        for de in os.scandir(self.directory):
+            if not de.is_file():
+                continue
+            st = de.stat()
+            if de.name.endswith(".tmp") or (self.ttl and now - st.st_mtime >= self.ttl):
+                self._remove(de.path)
+                continue
+            entries.append((st.st_mtime, de.name, st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        self._disk_evict()
+
+    def _disk_add(self, key, size):
+        with self._lock:
+            self._disk_size += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+        self._disk_evict()
+
+    def _disk_forget(self, key):
+        with self._lock:
+            self._disk_size -= self._disk.pop(key, 0)
+
+    def _disk_evict(self):
+        # oldest writes first, until the tracked total fits
+        victims = []
+        with self._lock:
+            while self._disk_size > self.disk_bytes and self._disk:
+                key, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                victims.append(key)
+            self.counters["evictions"] += len(victims)
+        for key in victims:
+            self._remove(self._path(key))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_shared_lock = threading.Lock()
+_shared = None
+
+
+def shared_result_cache() -> ResultCache:
+    """
+    The process-wide ResultCache on CACHE_DIR. Routes loaded into one process (api/router.py)
+    share it, so the directory has a single index and byte budget; keys of different routes
+    differ in their parts, so entries do not collide.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = ResultCache()
+        return _shared
+
+
+def dhash(image_bytes: bytes, size: int = 8) -> int:
+    """
+    64-bit difference hash: grayscale, shrink to (size+1) x size, compare
+    horizontally adjacent pixels. Stable across re-encoding and resizing.
+    """
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("L", (size * 8, size * 8))  # let JPEG decode at reduced scale
+        small = img.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+        px = small.tobytes()
+    bits = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (px[base + col] > px[base + col + 1])
+    return bits
+
+
+def color_signature(image_bytes: bytes, size: int = 4) -> bytes:
+    """Mean RGB of each cell of a size x size grid (3 * size * size bytes); what dhash() does not see."""
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("RGB", (size * 16, size * 16))
+        return img.convert("RGB").resize((size, size), Image.Resampling.BOX).tobytes()
+
+
+class PerceptualCache:
+    """
+    Bounded LRU keyed by perceptual hash; a lookup hits when a stored hash is
+    within `max_distance` bits (Hamming distance) of the query hash and, when both
+    sides have a color_signature(), no cell differs by more than `max_color_diff`.
+    """
+
+    def __init__(self, max_entries: int = PHASH_MAX_ENTRIES, max_distance: int = PHASH_MAX_DISTANCE,
+                 ttl: float = PHASH_TTL, max_color_diff: int = PHASH_MAX_COLOR_DIFF):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.max_color_diff = max_color_diff
+        self.ttl = ttl
+        self._entries = OrderedDict()  # hash -> (stored_at, signature, value)
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _colors_match(self, a: bytes, b: bytes) -> bool:
+        if not a or not b or len(a) != len(b):
+            return not a and not b
+        return max(abs(x - y) for x, y in zip(a, b)) <= self.max_color_diff
+
+    def get(self, h: int, signature: bytes = b""):
+        now = time.time()
+        with self._lock:
+            best, best_dist = None, self.max_distance + 1
+            for key, (stored_at, sig, _) in list(self._entries.items()):
+                if self.ttl and now - stored_at >= self.ttl:
+                    del self._entries[key]
+                    continue
+                dist = bin(key ^ h).count("1")
+                if dist < best_dist and self._colors_match(sig, signature):
+                    best, best_dist = key, dist
+            if best is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(best)
+            self.counters["hits"] += 1
+            return self._entries[best][2]
+
+    def put(self, h: int, value, signature: bytes = b""):
+        with self._lock:
+            self._entries.pop(h, None)
+            self._entries[h] = (time.time(), signature, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "entries": len(self._entries)}
@@ -0,0 +1,76 @@
+# Per-request deadlines: every request gets a time budget under the platform's maxDuration, which
+# caps upstream call timeouts and retries and lets the pipeline return partial results in time.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, time
+from contextvars import ContextVar
+
+from _http import HTTP_TIMEOUT
+
+# vercel.json maxDuration of every route that uses deadlines (tests/test_vercel_config.py checks it);
+# the margin leaves time to respond and send the callback
+FUNCTION_MAX_DURATION = float(os.environ.get("FUNCTION_MAX_DURATION", "300") or "300")
+DEADLINE_MARGIN       = float(os.environ.get("DEADLINE_MARGIN", "30") or "0")
+REQUEST_DEADLINE      = float(os.environ.get("REQUEST_DEADLINE", "0") or "0") or FUNCTION_MAX_DURATION - DEADLINE_MARGIN
+
+# Upstream calls are not started with less than this left; they could not finish anyway
+MIN_CALL_TIME = float(os.environ.get("DEADLINE_MIN_CALL_TIME", "1") or "0")
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """A point in time (monotonic clock) by which the request has to be answered."""
+
+    def __init__(self, seconds: float = None, started: float = None):
+        self.budget = REQUEST_DEADLINE if seconds is None else min(float(seconds), REQUEST_DEADLINE)
+        self.started = time.monotonic() if started is None else started
+        self.expires = self.started + self.budget
+
+    @classmethod
+    def parse(cls, value, started: float = None) -> "Deadline":
+        """Deadline from a request's "deadline" seconds (capped at REQUEST_DEADLINE); ValueError if invalid."""
+        if value in (None, ""):
+            return cls(started=started)
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("deadline must be a number of seconds")
+        if seconds <= 0:
+            raise ValueError("deadline must be positive")
+        return cls(seconds, started=started)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+
+_current = ContextVar("deadline", default=None)
+
+
+def current_deadline():
+    """The deadline of the request being served in this context (thread or task), or None."""
+    return _current.get()
+
+
+def use_deadline(deadline):
+    """Make `deadline` current for this context; asyncio tasks and to_thread() calls started later inherit it."""
+    return _current.set(deadline)
+
+
+def call_timeout(cap: float = HTTP_TIMEOUT) -> float:
+    """Timeout for one upstream call: `cap`, or less if the current deadline is closer."""
+    deadline = _current.get()
+    if deadline is None:
+        return cap
+    remaining = deadline.remaining()
+    if remaining < MIN_CALL_TIME:
+        raise DeadlineExceeded("Request deadline reached before the upstream call")
+    return min(cap, remaining)
@@ -0,0 +1,122 @@
+# Hedged requests for long-tail upstream calls: when a call runs past a percentile of recently
+# observed latency, fire a duplicate, keep whichever finishes first and cancel the other.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, asyncio, logging
+from collections import deque
+
+log = logging.getLogger("hedge")
+
+HEDGE_ENABLED     = os.environ.get("HEDGE_ENABLED", "0").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE  = float(os.environ.get("HEDGE_PERCENTILE", "95") or "95")
+HEDGE_BUDGET      = float(os.environ.get("HEDGE_BUDGET", "0.1") or "0")        # extra calls per primary call
+HEDGE_WINDOW      = int(os.environ.get("HEDGE_WINDOW", "200") or "200")        # latencies and calls kept
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20") or "1")      # no hedging before this many
+HEDGE_MIN_DELAY   = float(os.environ.get("HEDGE_MIN_DELAY", "1") or "0")       # seconds, floor on the trigger
+
+
+class RollingLatency:
+    """
+    Last `window` latencies (seconds); percentiles over that window. A primary that lost to its
+    hedge is recorded at the time it was cancelled, a lower bound on its real latency.
+    """
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        idx = min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))
+        return ordered[idx]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class Hedger:
+    """
+    Runs zero-argument coroutine functions with optional hedging (engine loop only, not thread-safe).
+    The hedge fires once a call has been running longer than the HEDGE_PERCENTILE latency of the
+    last HEDGE_WINDOW calls, if the budget allows: hedges may not exceed HEDGE_BUDGET of the last
+    HEDGE_WINDOW calls, so the extra load follows the request rate and nothing is banked while idle.
+    """
+
+    def __init__(self, label: str, enabled: bool = HEDGE_ENABLED, percentile: float = HEDGE_PERCENTILE,
+                 budget: float = HEDGE_BUDGET):
+        self.label = label
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self.latency = RollingLatency()
+        self.recent = deque(maxlen=HEDGE_WINDOW)  # 0 per primary call, 1 per hedge, in order
+        self.counters = {"calls": 0, "hedges": 0, "hedge_wins": 0, "primary_wins": 0,
+                         "budget_denied": 0, "cancelled": 0}
+
+    def hedge_delay(self):
+        """Seconds after which to hedge, or None while there is too little history."""
+        if len(self.latency) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, self.latency.percentile(self.percentile))
+
+    def budget_allows(self):
+        hedges = sum(self.recent)
+        return hedges + 1 <= self.budget * (len(self.recent) - hedges)
+
+    async def run(self, make_call):
+        self.counters["calls"] += 1
+        self.recent.append(0)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        primary = asyncio.ensure_future(make_call())
+        delay = self.hedge_delay() if self.enabled else None
+        if delay is None:
+            result = await primary
+            self.latency.add(loop.time() - started)
+            return result
+
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except BaseException:
+            primary.cancel()
+            raise
+        if done or not self.budget_allows():
+            if not done:
+                self.counters["budget_denied"] += 1
+            result = await primary
+            self.latency.add(loop.time() - started)
+            return result
+
+        self.recent.append(1)
+        self.counters["hedges"] += 1
+        log.info(f"{self.label}: no result after {delay:.1f}s (p{self.percentile:g}), hedging")
+        hedge = asyncio.ensure_future(make_call())
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                failed = {task: task.exception() for task in done if task.exception() is not None}
+                for task in done - failed.keys():
+                    self.counters["hedge_wins" if task is hedge else "primary_wins"] += 1
+                    # always the primary's time: when the hedge wins this is where the primary is
+                    # cancelled, so the tail it hit stays in the window instead of the hedge's fast run
+                    self.latency.add(loop.time() - started)
+                    return task.result()
+                error = failed.get(primary) or error or failed.get(hedge)
+            raise error  # both attempts failed; prefer the primary's error
+        finally:
+            for task in pending:
+                task.cancel()
+                self.counters["cancelled"] += 1
+
+    def stats(self) -> dict:
+        p50 = self.latency.percentile(50)
+        trigger = self.hedge_delay()
+        return {**self.counters, "enabled": self.enabled, "percentile": self.percentile, "budget": self.budget,
+                "recent_hedges": sum(self.recent), "samples": len(self.latency),
+                "p50_s": round(p50, 3) if p50 is not None else None,
+                "hedge_after_s": round(trigger, 3) if trigger is not None else None}
@@ -0,0 +1,225 @@
+# Process-wide pooled HTTP layer: one keep-alive httpx client (plus one async client for the
+# asyncio engine) shared by the OpenAI SDK, remote image fetches and callbacks.
+# httpx and openai are imported on first use: they are most of a handler's cold import time,
+# and GET / OPTIONS requests never need them.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, json, threading, logging
+
+log = logging.getLogger("http")
+
+HTTP_MAX_CONNECTIONS  = int(os.environ.get("HTTP_MAX_CONNECTIONS", "32") or "32")
+HTTP_MAX_KEEPALIVE    = int(os.environ.get("HTTP_MAX_KEEPALIVE", "16") or "16")
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60") or "60")
+HTTP_CONNECT_TIMEOUT  = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10") or "10")
+HTTP_TIMEOUT          = float(os.environ.get("HTTP_TIMEOUT", "300") or "300")  # image generation can take minutes
+HTTP2                 = os.environ.get("HTTP2", "1").lower() in ("1", "true", "yes")
+
+try:
+    import importlib.util
+    # optional: lets httpx negotiate HTTP/2 over TLS (ALPN); found, not imported
+    H2_AVAILABLE = importlib.util.find_spec("h2") is not None
+except (ImportError, ValueError):
+    H2_AVAILABLE = False
+
+
+class PoolStats:
+    """Request / new-connection counters fed by httpx event hooks and httpcore trace events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "new_connections": 0, "errors": 0, "http2_responses": 0}
+
+    def on_request(self, request):
+        request.extensions["trace"] = self.trace
+        with self._lock:
+            self.counters["requests"] += 1
+
+    def on_response(self, response):
+        if response.http_version == "HTTP/2":
+            with self._lock:
+                self.counters["http2_responses"] += 1
+
+    # httpx.AsyncClient only accepts coroutine hooks, and async connections await the trace callback
+    async def on_request_async(self, request):
+        self.on_request(request)
+        request.extensions["trace"] = self.trace_async
+
+    async def on_response_async(self, response):
+        self.on_response(response)
+
+    async def trace_async(self, event_name, info):
+        self.trace(event_name, info)
+
+    def trace(self, event_name, info):
+        # emitted only when the pool has to open a connection instead of reusing one
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.counters["new_connections"] += 1
+        elif event_name.endswith(".failed"):
+            with self._lock:
+                self.counters["errors"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            c = dict(self.counters)
+        c["reused"] = max(0, c["requests"] - c["new_connections"])
+        c["reuse_rate"] = round(c["reused"] / c["requests"], 4) if c["requests"] else 0.0
+        return c
+
+
+stats = PoolStats()
+
+_lock = threading.Lock()
+_transport = None
+_http_client = None
+_openai_client = None
+_async_transport = None
+_async_http_client = None
+_async_openai_client = None
+
+
+class LazyClient:
+    """Stands in for a client that is only built (and its SDK imported) on first attribute access."""
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+
+def _limits():
+    import httpx
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+
+def get_http_client():
+    """The process-wide pooled httpx.Client (created on first use)."""
+    global _transport, _http_client
+    import httpx
+    with _lock:
+        if _http_client is None:
+            _transport = httpx.HTTPTransport(http2=HTTP2 and H2_AVAILABLE, limits=_limits())
+            _http_client = httpx.Client(
+                transport=_transport,
+                timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                event_hooks={"request": [stats.on_request], "response": [stats.on_response]},
+            )
+            log.info(f"HTTP pool: max_connections={HTTP_MAX_CONNECTIONS} keepalive={HTTP_MAX_KEEPALIVE} "
+                     f"http2={HTTP2 and H2_AVAILABLE}")
+        return _http_client
+
+
+def get_async_http_client():
+    """The pooled httpx.AsyncClient; only use it from the engine loop (api/_aio.py)."""
+    global _async_transport, _async_http_client
+    import httpx
+    with _lock:
+        if _async_http_client is None:
+            _async_transport = httpx.AsyncHTTPTransport(http2=HTTP2 and H2_AVAILABLE, limits=_limits())
+            _async_http_client = httpx.AsyncClient(
+                transport=_async_transport,
+                timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                event_hooks={"request": [stats.on_request_async], "response": [stats.on_response_async]},
+            )
+        return _async_http_client
+
+
+def get_openai_client():
+    """One OpenAI client for every handler, on top of the shared pool."""
+    global _openai_client
+    import httpx
+    from openai import OpenAI
+    http_client = get_http_client()
+    with _lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                http_client=http_client,
+                timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                max_retries=0,  # retries and 429 backoff are owned by the limiter (api/_ratelimit.py)
+            )
+        return _openai_client
+
+
+def get_async_openai_client():
+    """One AsyncOpenAI client for the asyncio engine, on top of the shared async pool."""
+    global _async_openai_client
+    import httpx
+    from openai import AsyncOpenAI
+    http_client = get_async_http_client()
+    with _lock:
+        if _async_openai_client is None:
+            _async_openai_client = AsyncOpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                http_client=http_client,
+                timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                max_retries=0,  # retries and 429 backoff are owned by the limiter (api/_ratelimit.py)
+            )
+        return _async_openai_client
+
+
+def post_json(url: str, payload: dict, headers: dict = None, timeout: float = 30):
+    """POST a JSON body over the shared pool. Returns (status, body text)."""
+    resp = get_http_client().post(
+        url,
+        content=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json", **(headers or {})},
+        timeout=timeout,
+    )
+    return resp.status_code, resp.text
+
+
+def fetch_bytes(url: str, max_bytes: int, headers: dict = None, timeout: float = 30):
+    """
+    GET `url` over the shared pool, reading at most `max_bytes` (ValueError past that).
+    Returns (bytes, content type).
+    """
+    with get_http_client().stream("GET", url, headers=headers, timeout=timeout) as resp:
+        resp.raise_for_status()
+        buf = bytearray()
+        for chunk in resp.iter_bytes():
+            buf += chunk
+            if len(buf) > max_bytes:
+                raise ValueError(f"Remote image larger than {max_bytes} bytes")
+        ctype = (resp.headers.get("content-type") or "").split(";", 1)[0].strip().lower()
+    return bytes(buf), ctype
+
+
+async def apost_json(url: str, payload: dict, headers: dict = None, timeout: float = 30):
+    """post_json() on the async pool."""
+    resp = await get_async_http_client().post(
+        url,
+        content=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json", **(headers or {})},
+        timeout=timeout,
+    )
+    return resp.status_code, resp.text
+
+
+async def afetch_bytes(url: str, max_bytes: int, headers: dict = None, timeout: float = 30):
+    """fetch_bytes() on the async pool."""
+    async with get_async_http_client().stream("GET", url, headers=headers, timeout=timeout) as resp:
+        resp.raise_for_status()
+        buf = bytearray()
+        async for chunk in resp.aiter_bytes():
+            buf += chunk
+            if len(buf) > max_bytes:
+                raise ValueError(f"Remote image larger than {max_bytes} bytes")
+        ctype = (resp.headers.get("content-type") or "").split(";", 1)[0].strip().lower()
+    return bytes(buf), ctype
+
+
+def pool_stats() -> dict:
+    """Counters plus the current connection pool state (sync and async pools), for monitoring."""
+    out = {**stats.snapshot(), "http2_enabled": HTTP2 and H2_AVAILABLE,
+           "max_connections": HTTP_MAX_CONNECTIONS, "max_keepalive": HTTP_MAX_KEEPALIVE}
+    conns = []
+    for transport in (_transport, _async_transport):
+        pool = getattr(transport, "_pool", None)
+        conns += list(getattr(pool, "connections", []) or [])
+    out["open_connections"] = len(conns)
+    out["idle_connections"] = sum(1 for c in conns if c.is_idle())
+    return out
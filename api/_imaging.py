@@ -0,0 +1,377 @@
+# Pillow helpers shared by the api/ handlers.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, io, re, asyncio, logging, functools
+
+log = logging.getLogger("imaging")
+
+
+@functools.lru_cache(maxsize=None)
+def _pil():
+    """(Image, ImageOps), imported on first use so handlers do not pay for Pillow at cold start."""
+    from PIL import Image, ImageOps
+    try:
+        import pillow_avif  # noqa: F401  registers the AVIF plugin on Pillow builds without native AVIF
+    except ImportError:
+        pass
+    return Image, ImageOps
+
+# Input normalization: applied to uploaded images before any model call
+INPUT_NORMALIZE = os.environ.get("INPUT_NORMALIZE", "1").lower() in ("1", "true", "yes")
+INPUT_MAX_EDGE  = int(os.environ.get("INPUT_MAX_EDGE", "1536") or "1536")
+INPUT_FORMAT    = os.environ.get("INPUT_FORMAT", "JPEG").upper()  # JPEG or WEBP
+INPUT_QUALITY   = int(os.environ.get("INPUT_QUALITY", "85") or "85")
+
+# Output encoding: applied to generated images before they are returned
+OUTPUT_FORMAT           = os.environ.get("OUTPUT_FORMAT", "").upper()  # empty: each route keeps its default
+OUTPUT_JPEG_PROGRESSIVE = os.environ.get("OUTPUT_JPEG_PROGRESSIVE", "1").lower() in ("1", "true", "yes")
+OUTPUT_JPEG_OPTIMIZE    = os.environ.get("OUTPUT_JPEG_OPTIMIZE", "1").lower() in ("1", "true", "yes")
+OUTPUT_WEBP_METHOD      = int(os.environ.get("OUTPUT_WEBP_METHOD", "4") or "4")  # 0 fast .. 6 small
+OUTPUT_AVIF_SPEED       = int(os.environ.get("OUTPUT_AVIF_SPEED", "6") or "6")   # 0 small .. 10 fast
+OUTPUT_QUALITY = {"JPEG": 85, "WEBP": 80, "AVIF": 60}
+
+OUTPUT_FORMATS = ("AVIF", "WEBP", "JPEG", "PNG")
+
+_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png", "AVIF": "image/avif"}
+
+
+def normalize_input_image(buf: bytes, max_edge: int = None, fmt: str = None, quality: int = None):
+    """
+    Fix EXIF orientation, downscale to `max_edge` and re-encode at `quality`.
+    The downscale starts during decode: JPEG is decoded at a reduced DCT scale
+    (Image.draft) and the remaining factor uses reduce() via reducing_gap.
+    Images with transparency are kept lossless-alpha capable (WEBP, else PNG).
+
+    Returns (bytes, mime). The input is returned unchanged when it is already
+    within limits and correctly oriented, and either in the target format or
+    not made smaller by re-encoding.
+    """
+    Image, ImageOps = _pil()
+    max_edge = max_edge or INPUT_MAX_EDGE
+    fmt = (fmt or INPUT_FORMAT).upper()
+    quality = quality or INPUT_QUALITY
+
+    with Image.open(io.BytesIO(buf)) as img:
+        src_format = img.format
+        w, h = img.size
+        orientation = img.getexif().get(0x0112, 1)  # EXIF Orientation
+        scale = max_edge / max(w, h)
+        if scale >= 1 and orientation == 1 and src_format == fmt:
+            return buf, _MIME.get(src_format, "application/octet-stream")
+
+        if scale < 1:
+            # JPEG only: decode at 1/2, 1/4 or 1/8 scale, never below the target size
+            img.draft("RGB", (int(w * scale), int(h * scale)))
+        out = ImageOps.exif_transpose(img)
+
+        if scale < 1:
+            ow, oh = out.size
+            s = max_edge / max(ow, oh)
+            out = out.resize((max(1, round(ow * s)), max(1, round(oh * s))),
+                             Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+        has_alpha = out.mode in ("RGBA", "LA") or (out.mode == "P" and "transparency" in out.info)
+        if has_alpha and fmt == "JPEG":
+            fmt = "WEBP" if "WEBP" in Image.SAVE else "PNG"
+        if has_alpha:
+            out = out.convert("RGBA")
+        elif out.mode != "RGB":
+            out = out.convert("RGB")
+
+        dst = io.BytesIO()
+        if fmt == "PNG":
+            out.save(dst, format="PNG", optimize=True)
+        else:
+            out.save(dst, format=fmt, quality=quality)
+
+    # a pure re-encode that did not shrink anything is not worth the quality loss
+    if scale >= 1 and orientation == 1 and dst.tell() >= len(buf):
+        return buf, _MIME.get(src_format, "application/octet-stream")
+    return dst.getvalue(), _MIME[fmt]
+
+
+def normalize_input_logged(buf: bytes, label: str = "input"):
+    """normalize_input_image() with before/after sizes logged; never raises."""
+    if not INPUT_NORMALIZE:
+        return buf, None
+    try:
+        out, mime = normalize_input_image(buf)
+    except Exception as e:
+        log.warning(f"Input normalization failed for {label}, using original bytes: {e}")
+        return buf, None
+    log.info(f"Input normalization ({label}): {len(buf)} -> {len(out)} bytes ({mime})")
+    if mime == "application/octet-stream":
+        return buf, None
+    return out, mime
+
+
+# --------------------------------------------------------------------------
+# Output encoding: format negotiation and encoder settings
+# --------------------------------------------------------------------------
+
+def writable_formats() -> tuple:
+    """OUTPUT_FORMATS this Pillow build can write, best compression first."""
+    Image = _pil()[0]
+    Image.init()
+    return tuple(f for f in OUTPUT_FORMATS if f in Image.SAVE)
+
+
+def supported_output_format(fmt: str) -> str:
+    """Validate an output format name; one this build cannot write falls back to WEBP, then JPEG."""
+    fmt = (fmt or "").strip().upper().replace("JPG", "JPEG")
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format {fmt!r} (expected one of {', '.join(OUTPUT_FORMATS).lower()})")
+    writable = writable_formats()
+    for candidate in (fmt, "WEBP", "JPEG"):
+        if candidate in writable:
+            if candidate != fmt:
+                log.warning(f"{fmt} encoding is not available in this Pillow build, using {candidate}")
+            return candidate
+    return "JPEG"
+
+
+def _accepted_types(accept: str) -> set:
+    types = set()
+    for part in (accept or "").lower().split(","):
+        media, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            k, _, v = param.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    pass
+        if media and q > 0:
+            types.add(media.strip())
+    return types
+
+
+def negotiate_output_format(requested: str = None, accept: str = None, default: str = "JPEG") -> str:
+    """
+    Pick the output encoder for a request. An explicit `requested` format wins
+    ("auto" defers to the Accept header); otherwise image/avif, then image/webp
+    from `accept` when this build can write them; then OUTPUT_FORMAT; then `default`
+    (None: no preference, keep the source encoding). Raises ValueError for unknown names.
+    """
+    requested = (requested or "").strip()
+    if requested and requested.lower() != "auto":
+        return supported_output_format(requested)
+    accepted = _accepted_types(accept)
+    writable = writable_formats()
+    for fmt in ("AVIF", "WEBP"):
+        if _MIME[fmt] in accepted and fmt in writable:
+            return fmt
+    fallback = OUTPUT_FORMAT or default
+    return supported_output_format(fallback) if fallback else None
+
+
+def encode_image(img, fmt: str, quality: int = None) -> bytes:
+    """Encode a decoded RGB(A) image with the configured encoder settings for `fmt`."""
+    fmt = fmt.upper()
+    quality = quality or OUTPUT_QUALITY.get(fmt)
+    buf = io.BytesIO()
+    if fmt == "JPEG":
+        img.save(buf, format="JPEG", quality=quality,
+                 progressive=OUTPUT_JPEG_PROGRESSIVE, optimize=OUTPUT_JPEG_OPTIMIZE)
+    elif fmt == "WEBP":
+        img.save(buf, format="WEBP", quality=quality, method=OUTPUT_WEBP_METHOD)
+    elif fmt == "AVIF":
+        img.save(buf, format="AVIF", quality=quality, speed=OUTPUT_AVIF_SPEED)
+    else:
+        img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def output_mime(fmt: str) -> str:
+    return _MIME.get((fmt or "").upper(), "application/octet-stream")
+
+
+def reencode_image(img_bytes, fmt: str, quality: int = None) -> bytes:
+    """Decode once and re-encode as `fmt` (24-bit RGB unless the image has alpha and `fmt` keeps it)."""
+    Image = _pil()[0]
+    with Image.open(io.BytesIO(img_bytes)) as img:
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        out = img.convert("RGBA" if has_alpha and fmt.upper() != "JPEG" else "RGB")
+    return encode_image(out, fmt, quality)
+
+
+# --------------------------------------------------------------------------
+# Output renditions: several crops/sizes/formats from one decode
+# --------------------------------------------------------------------------
+
+# max_edge None keeps the crop at full resolution; quality 75 is Pillow's JPEG default
+RENDITION_PRESETS = {
+    "9x16":  {"aspect": "9:16", "max_edge": None, "format": "JPEG", "quality": 75},
+    "4x5":   {"aspect": "4:5",  "max_edge": 1350, "format": "JPEG", "quality": 85},
+    "1x1":   {"aspect": "1:1",  "max_edge": 1080, "format": "JPEG", "quality": 85},
+    "thumb": {"aspect": "1:1",  "max_edge": 256,  "format": "JPEG", "quality": 80},
+}
+MAX_RENDITIONS = 8
+RENDITION_KEYS = ("name", "aspect", "max_edge", "format", "quality")
+RENDITION_MIN_EDGE = 16
+RENDITION_MAX_RATIO = 4.0  # aspects from 1:4 to 4:1; beyond that crops collapse to slivers
+_RENDITION_NAME = re.compile(r"^[A-Za-z0-9_.@-]{1,32}$")
+
+
+def parse_renditions(value, default_format: str = None, default_quality: int = None) -> list:
+    """
+    Normalize rendition specs from a request. Accepts preset names ("4x5,thumb"
+    or ["4x5", "thumb"]) and/or dicts {name?, aspect, max_edge?, format?, quality?}.
+    default_format/default_quality replace the preset's values unless a dict spec
+    sets its own. Returns a list of complete spec dicts; raises ValueError on bad input.
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = [v.strip() for v in value.split(",") if v.strip()]
+    if not isinstance(value, list):
+        raise ValueError("renditions must be a list or a comma-separated string")
+    if len(value) > MAX_RENDITIONS:
+        raise ValueError(f"At most {MAX_RENDITIONS} renditions per request")
+
+    specs = []
+    for v in value:
+        if isinstance(v, str):
+            if v not in RENDITION_PRESETS:
+                raise ValueError(f"Unknown rendition preset '{v}' (known: {', '.join(RENDITION_PRESETS)})")
+            v = {"name": v}
+        if not isinstance(v, dict):
+            raise ValueError("Each rendition must be a preset name or an object")
+        unknown = sorted(set(v) - set(RENDITION_KEYS))
+        if unknown:
+            raise ValueError(f"Unknown rendition field(s) {', '.join(map(str, unknown))} "
+                             f"(allowed: {', '.join(RENDITION_KEYS)})")
+        if v.get("name") is not None and not (isinstance(v["name"], str) and _RENDITION_NAME.match(v["name"])):
+            raise ValueError(f"Invalid rendition name {v['name']!r} (1-32 of A-Z a-z 0-9 _ . @ -)")
+        spec = {"name": v.get("name") or "", **RENDITION_PRESETS.get(v.get("name"), {})}
+        if default_format and not v.get("format") and spec.get("format") != default_format:
+            # preset qualities are tuned for the preset's format
+            spec["format"], spec["quality"] = default_format, None
+        if default_quality and not v.get("quality"):
+            spec["quality"] = default_quality
+        spec.update({k: v[k] for k in v if v[k] is not None})
+
+        try:
+            aw, ah = (float(x) for x in str(spec.get("aspect") or "").split(":"))
+            if aw <= 0 or ah <= 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Invalid rendition aspect {spec.get('aspect')!r} (expected e.g. \"4:5\")")
+        if not 1 / RENDITION_MAX_RATIO <= aw / ah <= RENDITION_MAX_RATIO:
+            raise ValueError(f"Rendition aspect {spec['aspect']!r} is out of range (1:4 to 4:1)")
+        spec["format"] = supported_output_format(str(spec.get("format") or "JPEG"))
+        spec["quality"] = _spec_int(spec, "quality", 1, 100, OUTPUT_QUALITY.get(spec["format"], 85))
+        spec["max_edge"] = _spec_int(spec, "max_edge", RENDITION_MIN_EDGE, None, None)
+        if not spec["name"]:
+            spec["name"] = f"{spec['aspect'].replace(':', 'x')}" + (f"@{spec['max_edge']}" if spec["max_edge"] else "")
+        specs.append(spec)
+    return specs
+
+
+def _spec_int(spec: dict, key: str, lo: int, hi, default):
+    value = spec.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"Rendition {key} must be an integer")
+    try:
+        n = int(value)
+    except ValueError:
+        raise ValueError(f"Rendition {key} must be an integer, got {value!r}")
+    if n < lo or (hi is not None and n > hi):
+        raise ValueError(f"Rendition {key} must be " + (f"between {lo} and {hi}" if hi is not None else f"at least {lo}"))
+    return n
+
+
+def _center_crop_box(img_w: int, img_h: int, aspect: str):
+    aw, ah = (float(x) for x in aspect.split(":"))
+    target_ratio = aw / ah
+    current_ratio = img_w / img_h
+    if current_ratio > target_ratio:
+        # Image is too wide → crop width
+        new_w = int(img_h * target_ratio)
+        left = (img_w - new_w) // 2
+        return left, 0, left + new_w, img_h
+    # Image is too tall → crop height
+    new_h = int(img_w / target_ratio)
+    top = (img_h - new_h) // 2
+    return 0, top, img_w, top + new_h
+
+
+def make_renditions(img_bytes, specs: list) -> list:
+    """
+    Decode once, force 24-bit RGB and produce every rendition in `specs`.
+    Renditions are made largest-first; each downscale starts from the previous
+    (already reduced) full frame instead of the original decode.
+    Returns [{name, aspect, width, height, format, data}] in the order of `specs`;
+    a rendition that fails to encode comes back as {name, aspect, format, error}.
+    """
+    Image = _pil()[0]
+    with Image.open(io.BytesIO(img_bytes)) as img:
+        log.info(f"Pre-conversion mode: {img.mode}")  # <-- useful for debugging
+        rgb_img = img.convert("RGB")  # Force 24-bit
+        log.info(f"Post-conversion mode: {rgb_img.mode}")
+
+    full_w, full_h = rgb_img.size
+    plans = []
+    for i, spec in enumerate(specs):
+        box = _center_crop_box(full_w, full_h, spec["aspect"])
+        crop_w, crop_h = box[2] - box[0], box[3] - box[1]
+        scale = min(1.0, spec["max_edge"] / max(crop_w, crop_h)) if spec.get("max_edge") else 1.0
+        plans.append((scale, i, box))
+
+    out = [None] * len(specs)
+    work, work_scale = rgb_img, 1.0
+    for scale, i, box in sorted(plans, key=lambda t: -t[0]):
+        spec = specs[i]
+        if scale < work_scale:
+            # progressive: shrink the working full frame from its previous size
+            work = work.resize((max(1, round(full_w * scale)), max(1, round(full_h * scale))),
+                               Image.Resampling.LANCZOS, reducing_gap=2.0)
+            work_scale = scale
+        cropped = work.crop(box if work is rgb_img else _center_crop_box(work.width, work.height, spec["aspect"]))
+
+        entry = {"name": spec["name"], "aspect": spec["aspect"], "format": spec["format"].lower()}
+        try:
+            data = encode_image(cropped, spec["format"], spec["quality"])
+        except Exception as e:
+            # one bad rendition does not cost the caller the others
+            log.warning(f"Rendition {spec['name']} failed: {e}")
+            out[i] = {**entry, "error": str(e) or type(e).__name__}
+            continue
+        out[i] = {**entry, "width": cropped.width, "height": cropped.height, "data": data}
+    return out
+
+
+# --------------------------------------------------------------------------
+# Process-pool offload: input bytes travel through shared memory, not pickles
+# --------------------------------------------------------------------------
+
+def _run_from_shm(func, name: str, size: int, args: tuple):
+    # runs in the worker process
+    # pool workers share the parent's resource tracker, so attaching here does
+    # not take ownership; the parent unlinks the block in offload_async()
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    view = shm.buf[:size]
+    try:
+        return func(view, *args)
+    finally:
+        view.release()
+        shm.close()
+
+
+async def offload_async(pool, func, data, *args):
+    """
+    Run func(data_view, *args) on a process pool. `data` is copied once into a
+    shared memory block that the worker reads in place; the result comes back
+    pickled (raw bytes, no base64). Awaits the worker instead of blocking a thread.
+    """
+    from multiprocessing import shared_memory  # only offloading needs it, not cold start
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+        return await asyncio.wrap_future(pool.submit(_run_from_shm, func, shm.name, len(data), args))
+    finally:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,136 @@
+# Job store for asynchronous improve2 requests (POST -> 202 + job_id, GET ?job_id=...).
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, json, sqlite3, threading, time, uuid
+from contextlib import contextmanager
+
+JOB_DB_PATH = os.environ.get("IMPROVE2_JOB_DB", "/tmp/improve2_jobs.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id         TEXT PRIMARY KEY,
+    status     TEXT NOT NULL,
+    total      INTEGER NOT NULL,
+    error      TEXT,
+    meta       TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    idx    INTEGER NOT NULL,
+    prompt TEXT,
+    status TEXT NOT NULL,
+    image  TEXT,
+    error  TEXT,
+    renditions TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+# columns added after the first release, for job databases created before them
+_MIGRATIONS = (
+    "ALTER TABLE job_items ADD COLUMN renditions TEXT",
+)
+
+
+class JobStore:
+    """
+    SQLite-backed job store. Job status moves queued -> running -> succeeded|failed;
+    each image is tracked as an item that moves pending -> done|failed|timed_out.
+    """
+
+    def __init__(self, path: str = JOB_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+            for stmt in _MIGRATIONS:
+                try:
+                    db.execute(stmt)
+                except sqlite3.OperationalError:
+                    pass  # already applied
+
+    @contextmanager
+    def _connect(self):
+        # one short-lived connection per operation; commits on success, always closed
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def create(self, total: int, meta: dict = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, total, meta, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, total, json.dumps(meta or {}), now, now),
+            )
+        return job_id
+
+    def set_prompts(self, job_id: str, prompts: list):
+        with self._lock, self._connect() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO job_items (job_id, idx, prompt, status) VALUES (?, ?, ?, 'pending')",
+                [(job_id, i, p) for i, p in enumerate(prompts)],
+            )
+            db.execute(
+                "UPDATE jobs SET status = 'running', total = ?, updated_at = ? WHERE id = ?",
+                (len(prompts), time.time(), job_id),
+            )
+
+    def set_item(self, job_id: str, idx: int, status: str, image: str = None, error: str = None,
+                 renditions: dict = None):
+        with self._lock, self._connect() as db:
+            db.execute(
+                "UPDATE job_items SET status = ?, image = ?, error = ?, renditions = ? WHERE job_id = ? AND idx = ?",
+                (status, image, error, json.dumps(renditions) if renditions else None, job_id, idx),
+            )
+            db.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def finish(self, job_id: str, status: str, error: str = None):
+        with self._lock, self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def get(self, job_id: str):
+        """Return the job as a JSON-ready dict, or None if unknown."""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT status, total, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if not row:
+                return None
+            items = db.execute(
+                "SELECT idx, prompt, status, image, error, renditions FROM job_items WHERE job_id = ? ORDER BY idx",
+                (job_id,)
+            ).fetchall()
+
+        status, total, error, created_at, updated_at = row
+        out_items = []
+        generated_images = []
+        for idx, prompt, item_status, image, item_error, renditions in items:
+            out_items.append({"index": idx, "prompt": prompt, "status": item_status, "error": item_error})
+            if item_status == "done" and image:
+                generated_images.append({"prompt": prompt, "image": image})
+                if renditions:
+                    generated_images[-1]["renditions"] = json.loads(renditions)
+
+        done = sum(1 for i in out_items if i["status"] == "done")
+        failed = sum(1 for i in out_items if i["status"] == "failed")
+        timed_out = sum(1 for i in out_items if i["status"] == "timed_out")
+        return {
+            "job_id": job_id,
+            "status": status,
+            "error": error,
+            "progress": {"total": total, "done": done, "failed": failed, "timed_out": timed_out,
+                         "pending": total - done - failed - timed_out},
+            "items": out_items,
+            "generated_images": generated_images,
+            "created_at": created_at,
+            "updated_at": updated_at,
+        }
@@ -0,0 +1,336 @@
+# Outbox for result callbacks: each callback is stored in SQLite first and delivered by a
+# background worker on the engine loop, with exponential backoff and a max-attempt policy.
+# Durable only as far as OUTBOX_DB_PATH is: on a serverless instance /tmp goes away with the
+# instance, so retries still pending then are lost (at-most-once past the first attempt).
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, json, time, random, sqlite3, threading, uuid, asyncio, logging
+from contextlib import contextmanager
+
+from _aio import submit as submit_coro, get_loop
+from _http import apost_json
+
+log = logging.getLogger("outbox")
+
+OUTBOX_DB_PATH      = os.environ.get("CALLBACK_OUTBOX_DB", "/tmp/improve2_callbacks.sqlite3")
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("CALLBACK_MAX_ATTEMPTS", "8") or "1")
+OUTBOX_BASE_DELAY   = float(os.environ.get("CALLBACK_RETRY_BASE_DELAY", "2") or "2")
+OUTBOX_MAX_DELAY    = float(os.environ.get("CALLBACK_RETRY_MAX_DELAY", "300") or "300")
+OUTBOX_TIMEOUT      = float(os.environ.get("CALLBACK_TIMEOUT", "30") or "30")
+OUTBOX_CONCURRENCY  = int(os.environ.get("CALLBACK_CONCURRENCY", "4") or "1")
+OUTBOX_POLL         = float(os.environ.get("CALLBACK_POLL_INTERVAL", "5") or "5")   # seconds between scans for due retries
+OUTBOX_RETENTION    = float(os.environ.get("CALLBACK_RETENTION", str(7 * 24 * 3600)) or "0")
+
+# a claimed callback not settled within this long (e.g. the process died mid-delivery) is retried
+LEASE = OUTBOX_TIMEOUT + 30
+
+# receiver answers worth retrying; any other non-2xx fails the callback at once
+RETRY_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+# payload fields kept in memory only, never written to the outbox. A callback that had them
+# and is picked up by another process (after a restart) is failed, not sent without them.
+SECRET_FIELDS = ("auth_token",)
+SECRETS_LOST = "not sent: its auth_token was held in memory by a process that is gone"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS callbacks (
+    id              TEXT PRIMARY KEY,
+    dedupe_key      TEXT,
+    label           TEXT,
+    url             TEXT NOT NULL,
+    payload         TEXT NOT NULL,
+    status          TEXT NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_status     INTEGER,
+    last_error      TEXT,
+    created_at      REAL NOT NULL,
+    updated_at      REAL NOT NULL,
+    delivered_at    REAL,
+    secret_fields   TEXT
+);
+CREATE INDEX IF NOT EXISTS callbacks_due ON callbacks (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS callbacks_dedupe ON callbacks (dedupe_key, created_at);
+"""
+
+# columns added after the first release, for outbox databases created before them
+_MIGRATIONS = (
+    "ALTER TABLE callbacks ADD COLUMN secret_fields TEXT",
+)
+
+
+def backoff(attempts: int) -> float:
+    """Seconds before retry number `attempts` (1-based): exponential, capped, with jitter."""
+    delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class Outbox:
+    """
+    SQLite-backed callback outbox. A callback moves pending -> delivering -> delivered|failed,
+    going back to pending (with a later next_attempt_at) after each retryable failure.
+    Enqueuing a callback with the same dedupe_key (product_id) as undelivered ones marks
+    those superseded, so a product gets at most one delivery of its latest result.
+    SECRET_FIELDS are held in memory until the callback settles; payloads are dropped then.
+    A callback whose secrets this process does not hold is failed when claimed (SECRETS_LOST).
+    """
+
+    def __init__(self, path: str = OUTBOX_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._secrets = {}  # callback id -> SECRET_FIELDS taken out of its payload
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+            for stmt in _MIGRATIONS:
+                try:
+                    db.execute(stmt)
+                except sqlite3.OperationalError:
+                    pass  # already applied
+
+    @contextmanager
+    def _connect(self):
+        # one short-lived connection per operation; commits on success, always closed
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def enqueue(self, url: str, payload: dict, dedupe_key: str = None, label: str = "Callback") -> str:
+        callback_id = uuid.uuid4().hex
+        now = time.time()
+        secrets = {k: payload[k] for k in SECRET_FIELDS if payload.get(k)}
+        stored = {k: v for k, v in payload.items() if k not in secrets}
+        with self._lock, self._connect() as db:
+            if dedupe_key:
+                superseded = [r[0] for r in db.execute(
+                    "SELECT id FROM callbacks WHERE dedupe_key = ? AND status IN ('pending', 'delivering')",
+                    (dedupe_key,),
+                )]
+                db.executemany(
+                    "UPDATE callbacks SET status = 'superseded', payload = '{}', updated_at = ? WHERE id = ?",
+                    [(now, i) for i in superseded],
+                )
+                for i in superseded:
+                    self._secrets.pop(i, None)
+            db.execute(
+                "INSERT INTO callbacks (id, dedupe_key, label, url, payload, status, next_attempt_at, created_at, "
+                "updated_at, secret_fields) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?, ?, ?)",
+                (callback_id, dedupe_key or None, label, url, json.dumps(stored), now, now, now,
+                 ",".join(secrets) or None),
+            )
+            if secrets:
+                self._secrets[callback_id] = secrets
+        return callback_id
+
+    def claim(self, limit: int, callback_id: str = None) -> list:
+        """
+        Lease up to `limit` due callbacks (pending, or delivering with an expired lease), or just
+        `callback_id` if it is still pending. Payloads come back with their SECRET_FIELDS;
+        due callbacks whose secrets were lost with another process are failed instead.
+        """
+        now = time.time()
+        with self._lock, self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")  # select + lease atomically, also against other processes
+            if callback_id:
+                rows = db.execute(
+                    "SELECT id, label, url, payload, attempts, secret_fields FROM callbacks "
+                    "WHERE id = ? AND status = 'pending'",
+                    (callback_id,),
+                ).fetchall()
+            else:
+                rows = db.execute(
+                    "SELECT id, label, url, payload, attempts, secret_fields FROM callbacks "
+                    "WHERE status IN ('pending', 'delivering') AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+            lost = [r["id"] for r in rows if r["secret_fields"] and r["id"] not in self._secrets]
+            if lost:
+                db.executemany(
+                    "UPDATE callbacks SET status = 'failed', payload = '{}', last_error = ?, next_attempt_at = ?, "
+                    "updated_at = ? WHERE id = ?",
+                    [(SECRETS_LOST, now, now, i) for i in lost],
+                )
+                log.error(f"{len(lost)} callback(s) failed: {SECRETS_LOST}")
+                rows = [r for r in rows if r["id"] not in lost]
+            db.executemany(
+                "UPDATE callbacks SET status = 'delivering', attempts = attempts + 1, next_attempt_at = ?, "
+                "updated_at = ? WHERE id = ?",
+                [(now + LEASE, now, r["id"]) for r in rows],
+            )
+            secrets = {r["id"]: self._secrets.get(r["id"], {}) for r in rows}
+        return [{"id": r["id"], "label": r["label"], "url": r["url"],
+                 "payload": {**json.loads(r["payload"]), **secrets[r["id"]]}, "attempts": r["attempts"] + 1}
+                for r in rows]
+
+    def next_due(self):
+        """Earliest next_attempt_at over unsettled callbacks, or None."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT MIN(next_attempt_at) FROM callbacks WHERE status IN ('pending', 'delivering')"
+            ).fetchone()[0]
+
+    def delivered(self, callback_id: str, http_status: int):
+        now = time.time()
+        with self._lock, self._connect() as db:
+            db.execute(
+                "UPDATE callbacks SET status = 'delivered', payload = '{}', last_status = ?, last_error = NULL, "
+                "delivered_at = ?, updated_at = ? WHERE id = ? AND status = 'delivering'",
+                (http_status, now, now, callback_id),
+            )
+            self._secrets.pop(callback_id, None)
+
+    def attempt_failed(self, callback_id: str, attempts: int, error: str, http_status: int = None,
+                       retry: bool = True) -> str:
+        """Record a failed attempt; returns the new status ("pending" to retry, or "failed")."""
+        now = time.time()
+        status = "pending" if retry and attempts < OUTBOX_MAX_ATTEMPTS else "failed"
+        next_at = now + backoff(attempts) if status == "pending" else now
+        with self._lock, self._connect() as db:
+            db.execute(
+                "UPDATE callbacks SET status = ?, last_status = ?, last_error = ?, next_attempt_at = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'delivering'",
+                (status, http_status, error[:1000], next_at, now, callback_id),
+            )
+            if status == "failed":
+                db.execute("UPDATE callbacks SET payload = '{}' WHERE id = ?", (callback_id,))
+                self._secrets.pop(callback_id, None)
+        return status
+
+    def prune(self):
+        if not OUTBOX_RETENTION:
+            return
+        with self._lock, self._connect() as db:
+            db.execute("DELETE FROM callbacks WHERE status IN ('delivered', 'failed', 'superseded') AND updated_at < ?",
+                       (time.time() - OUTBOX_RETENTION,))
+
+    @staticmethod
+    def _public(row) -> dict:
+        out = {k: row[k] for k in ("id", "label", "url", "status", "attempts", "last_status", "last_error",
+                                   "created_at", "updated_at", "delivered_at")}
+        out["product_id"] = row["dedupe_key"]
+        if row["status"] == "pending":
+            out["next_attempt_at"] = row["next_attempt_at"]
+        return out
+
+    def get(self, callback_id: str):
+        """Delivery status of one callback as a JSON-ready dict (no payload), or None if unknown."""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM callbacks WHERE id = ?", (callback_id,)).fetchone()
+        return self._public(row) if row else None
+
+    def find(self, dedupe_key: str, limit: int = 20) -> list:
+        """Most recent callbacks for a product_id, newest first."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT * FROM callbacks WHERE dedupe_key = ? ORDER BY created_at DESC LIMIT ?", (dedupe_key, limit)
+            ).fetchall()
+        return [self._public(r) for r in rows]
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM callbacks GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+
+class OutboxWorker:
+    """
+    Delivers due callbacks from an Outbox as a coroutine on the engine loop (api/_aio.py),
+    OUTBOX_CONCURRENCY at a time. notify() wakes it right after an enqueue; otherwise it
+    sleeps until the next retry is due (rescanning at least every OUTBOX_POLL seconds, for
+    callbacks written by other processes). Callbacks left over by
+    an earlier process (frozen or killed mid-delivery) are picked up once their lease expires.
+    headers() is called per delivery, so the service key is never stored in the outbox.
+    deliver_now() makes a callback's first attempt right away, for callers that wait on it.
+    """
+
+    def __init__(self, outbox: Outbox, headers=None):
+        self.outbox = outbox
+        self.headers = headers or dict
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._wake = None
+        self.counters = {"attempts": 0, "delivered": 0, "retried": 0, "failed": 0}
+
+    def start(self):
+        with self._start_lock:
+            if not self._started:
+                self._started = True
+                submit_coro(self._run())
+
+    def notify(self):
+        """Wake the worker now (callable from any thread)."""
+        self.start()
+        get_loop().call_soon_threadsafe(lambda: self._wake is not None and self._wake.set())
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        last_prune = 0.0
+        while True:
+            try:
+                if time.time() - last_prune > 3600:
+                    last_prune = time.time()
+                    await asyncio.to_thread(self.outbox.prune)
+                batch = await asyncio.to_thread(self.outbox.claim, OUTBOX_CONCURRENCY)
+                next_due = None if batch else await asyncio.to_thread(self.outbox.next_due)
+            except Exception as e:
+                log.error(f"Outbox scan failed: {e}")
+                batch, next_due = [], None
+            if batch:
+                await asyncio.gather(*(self._deliver(cb) for cb in batch))
+                continue
+            # sleep until the next retry is due, an enqueue wakes us, or the next periodic scan
+            idle = OUTBOX_POLL if next_due is None else min(OUTBOX_POLL, max(0.05, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), idle)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def deliver_now(self, callback_id: str):
+        """First attempt at one pending callback, on the caller's schedule; retries stay with the worker."""
+        batch = await asyncio.to_thread(self.outbox.claim, 1, callback_id)
+        if batch:
+            await self._deliver(batch[0])
+            return
+        # the worker's scan got to it first: wait for that attempt instead
+        end = time.monotonic() + LEASE
+        while time.monotonic() < end:
+            cb = await asyncio.to_thread(self.outbox.get, callback_id)
+            if not cb or cb["status"] != "delivering":
+                return
+            await asyncio.sleep(0.05)
+
+    async def _deliver(self, cb: dict):
+        self.counters["attempts"] += 1
+        label, url, attempts = cb["label"] or "Callback", cb["url"], cb["attempts"]
+        # receivers can drop duplicate deliveries of the same callback (retries after a lost response)
+        headers = {**self.headers(), "Idempotency-Key": cb["id"]}
+        try:
+            status, body = await apost_json(url, cb["payload"], headers=headers, timeout=OUTBOX_TIMEOUT)
+        except Exception as e:
+            status, body, error = None, "", f"{type(e).__name__}: {e}"
+        else:
+            error = f"HTTP {status}: {body[:500]}"
+        try:
+            if status is not None and 200 <= status < 300:
+                await asyncio.to_thread(self.outbox.delivered, cb["id"], status)
+                self.counters["delivered"] += 1
+                log.info(f"{label} -> {url} status={status} attempt={attempts} body={body[:500]}")
+                return
+            retry = status is None or status in RETRY_STATUS
+            outcome = await asyncio.to_thread(self.outbox.attempt_failed, cb["id"], attempts, error, status, retry)
+        except Exception as e:
+            log.error(f"{label} {cb['id']}: could not record delivery result: {e}")
+            return
+        if outcome == "pending":
+            self.counters["retried"] += 1
+            log.warning(f"{label} -> {url} attempt {attempts}/{OUTBOX_MAX_ATTEMPTS} failed ({error}); will retry")
+        else:
+            self.counters["failed"] += 1
+            log.error(f"{label} -> {url} failed after {attempts} attempt(s): {error}")
+
+    def stats(self) -> dict:
+        return {**self.counters, "outbox": self.outbox.stats(), "max_attempts": OUTBOX_MAX_ATTEMPTS}
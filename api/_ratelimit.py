@@ -0,0 +1,280 @@
+# Adaptive rate limiter in front of upstream model calls: token bucket + AIMD concurrency,
+# honoring retry-after, with jittered retries for throttled and transient failures.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, time, random, sqlite3, asyncio, logging, threading, contextvars, email.utils
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from _aio import run_sync, MAX_UPSTREAM_CALLS
+from _deadline import current_deadline, use_deadline, DeadlineExceeded, MIN_CALL_TIME
+
+log = logging.getLogger("ratelimit")
+
+RATE_LIMIT_RPS        = float(os.environ.get("RATE_LIMIT_RPS", "0") or "0")    # token refill rate; 0 = no bucket
+RATE_LIMIT_BURST      = float(os.environ.get("RATE_LIMIT_BURST", "10") or "10")
+RATE_LIMIT_MIN_CONC   = int(os.environ.get("RATE_LIMIT_MIN_CONCURRENCY", "1") or "1")
+RATE_LIMIT_MAX_CONC   = int(os.environ.get("RATE_LIMIT_MAX_CONCURRENCY", str(MAX_UPSTREAM_CALLS)) or "1")
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", "5") or "0")
+RATE_LIMIT_BASE_DELAY = float(os.environ.get("RATE_LIMIT_BASE_DELAY", "1") or "1")
+RATE_LIMIT_MAX_DELAY  = float(os.environ.get("RATE_LIMIT_MAX_DELAY", "60") or "60")
+# Share the bucket and throttle pauses across processes (e.g. several workers on one host)
+RATE_LIMIT_SHARED_DB  = os.environ.get("RATE_LIMIT_SHARED_DB", "")
+
+# AIMD: +1 slot per window of successful calls, halve on throttling (at most once per cooldown)
+AIMD_DECREASE = 0.5
+AIMD_COOLDOWN = 2.0
+
+TRANSIENT_STATUS = (408, 409, 500, 502, 503, 504)
+
+
+def _status(e):
+    return getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+
+
+def is_throttle(e) -> bool:
+    # insufficient_quota is a billing 429; waiting does not fix it
+    return _status(e) == 429 and getattr(e, "code", None) != "insufficient_quota"
+
+
+def is_transient(e) -> bool:
+    if _status(e) in TRANSIENT_STATUS:
+        return True
+    return type(e).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout")
+
+
+def retry_after(e):
+    """Seconds to wait from retry-after-ms / retry-after (delta or HTTP date), or None."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class _LocalBucket:
+    """In-process token bucket + pause deadline."""
+
+    def __init__(self):
+        self.tokens = RATE_LIMIT_BURST
+        self.updated = time.monotonic()
+        self.paused_until = 0.0  # wall clock, like the shared bucket
+
+    def take(self, rate: float, burst: float) -> float:
+        """Reserve one token; returns how long to wait before using it."""
+        now = time.monotonic()
+        wait = max(0.0, self.paused_until - time.time())
+        if rate > 0:
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / rate)
+        return wait
+
+    def pause(self, until: float):
+        self.paused_until = max(self.paused_until, until)
+
+
+class _SharedBucket:
+    """The same bucket in SQLite; BEGIN IMMEDIATE serializes processes on the file lock."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._tx() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                       "tokens REAL NOT NULL, updated REAL NOT NULL, paused_until REAL NOT NULL)")
+            db.execute("INSERT OR IGNORE INTO bucket VALUES (1, ?, ?, 0)", (RATE_LIMIT_BURST, time.time()))
+
+    @contextmanager
+    def _tx(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+    def take(self, rate: float, burst: float) -> float:
+        now = time.time()
+        with self._tx() as db:
+            tokens, updated, paused_until = db.execute(
+                "SELECT tokens, updated, paused_until FROM bucket WHERE id = 1").fetchone()
+            wait = max(0.0, paused_until - now)
+            if rate > 0:
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate) - 1
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+            db.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens, now))
+        return wait
+
+    def pause(self, until: float):
+        with self._tx() as db:
+            db.execute("UPDATE bucket SET paused_until = MAX(paused_until, ?) WHERE id = 1", (until,))
+
+
+class AdaptiveLimiter:
+    """
+    Gate for upstream calls, used from the engine loop (api/_aio.py):
+    - a token bucket (RATE_LIMIT_RPS / RATE_LIMIT_BURST, 0 = off),
+    - an AIMD concurrency limit between RATE_LIMIT_MIN_CONC and RATE_LIMIT_MAX_CONC,
+    - a global pause after a 429, for as long as its retry-after asks.
+    Throttled (429) and transient (5xx, timeouts) calls are retried with full-jitter
+    exponential backoff, up to RATE_LIMIT_MAX_RETRIES times, and never past the current
+    request deadline (api/_deadline.py): DeadlineExceeded instead of a retry that cannot finish.
+    """
+
+    def __init__(self, shared_db: str = RATE_LIMIT_SHARED_DB):
+        self.limit = float(RATE_LIMIT_MAX_CONC)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters = deque()
+        self.bucket = _LocalBucket()
+        if shared_db:
+            try:
+                self.bucket = _SharedBucket(shared_db)
+            except Exception as e:
+                log.warning(f"Shared rate limit state unavailable ({e}), limiting per process")
+        self.counters = {"calls": 0, "throttled": 0, "transient_errors": 0, "retries": 0,
+                         "gave_up": 0, "limit_decreases": 0}
+        self._blocking_pool = None
+        self._pool_lock = threading.Lock()
+
+    # --- concurrency ----------------------------------------------------------
+
+    async def _acquire(self):
+        # single-threaded loop: plain futures as waiters, no lock needed
+        while self.in_flight >= int(self.limit):
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            finally:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+        self.in_flight += 1
+        try:
+            if isinstance(self.bucket, _LocalBucket):
+                wait = self.bucket.take(RATE_LIMIT_RPS, RATE_LIMIT_BURST)
+            else:
+                wait = await asyncio.to_thread(self.bucket.take, RATE_LIMIT_RPS, RATE_LIMIT_BURST)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        except BaseException:
+            self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+    def _on_success(self):
+        self.limit = min(float(RATE_LIMIT_MAX_CONC), self.limit + 1.0 / max(1.0, self.limit))
+        self._wake()
+
+    async def _on_throttle(self, delay_hint):
+        now = time.monotonic()
+        if now - self._last_decrease >= AIMD_COOLDOWN:
+            self._last_decrease = now
+            self.limit = max(float(RATE_LIMIT_MIN_CONC), self.limit * AIMD_DECREASE)
+            self.counters["limit_decreases"] += 1
+            log.warning(f"Upstream throttled; concurrency limit now {int(self.limit)}")
+        if delay_hint:
+            if isinstance(self.bucket, _LocalBucket):
+                self.bucket.pause(time.time() + delay_hint)
+            else:
+                await asyncio.to_thread(self.bucket.pause, time.time() + delay_hint)
+
+    # --- public API -------------------------------------------------------------
+
+    async def call(self, make_call, label: str = "upstream"):
+        """Await make_call() (a zero-argument coroutine function) under the limiter, with retries."""
+        attempt = 0
+        while True:
+            await self._acquire()
+            self.counters["calls"] += 1
+            try:
+                result = await make_call()
+            except Exception as e:
+                self._release()
+                throttled = is_throttle(e)
+                if not (throttled or is_transient(e)) or attempt >= RATE_LIMIT_MAX_RETRIES:
+                    if throttled or is_transient(e):
+                        self.counters["gave_up"] += 1
+                    raise
+                hint = retry_after(e)
+                if throttled:
+                    self.counters["throttled"] += 1
+                    await self._on_throttle(hint)
+                else:
+                    self.counters["transient_errors"] += 1
+                # full jitter, but never earlier than the server asked for
+                backoff = random.uniform(0, min(RATE_LIMIT_MAX_DELAY, RATE_LIMIT_BASE_DELAY * 2 ** attempt))
+                delay = max(backoff, min(hint or 0.0, RATE_LIMIT_MAX_DELAY))
+                deadline = current_deadline()
+                if deadline is not None and deadline.remaining() < delay + MIN_CALL_TIME:
+                    self.counters["gave_up"] += 1
+                    raise DeadlineExceeded(f"{label}: no time left before the request deadline to retry ({e})") from e
+                attempt += 1
+                self.counters["retries"] += 1
+                log.warning(f"{label}: {'throttled' if throttled else 'transient error'} ({e}); "
+                            f"retry {attempt}/{RATE_LIMIT_MAX_RETRIES} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self._release()  # cancelled
+                raise
+            self._release()
+            self._on_success()
+            return result
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # the limiter's own threads: minute-long blocking SDK calls must not occupy the loop's
+        # default executor, which the async routes use for SQLite, cache and blob store work.
+        # Sized to the concurrency cap, so every call holding a permit has a thread.
+        with self._pool_lock:
+            if self._blocking_pool is None:
+                self._blocking_pool = ThreadPoolExecutor(max_workers=max(1, RATE_LIMIT_MAX_CONC),
+                                                         thread_name_prefix="upstream-blocking")
+            return self._blocking_pool
+
+    def call_blocking(self, fn, label: str = "upstream"):
+        """call() for synchronous code outside the engine loop: fn runs on the limiter's own threads."""
+        deadline = current_deadline()  # the caller's, carried over to the loop and the worker thread
+
+        async def run():
+            use_deadline(deadline)
+            loop = asyncio.get_running_loop()
+            # a fresh context copy per attempt, as asyncio.to_thread would make
+            return await self.call(lambda: loop.run_in_executor(self._pool(), contextvars.copy_context().run, fn),
+                                   label)
+
+        return run_sync(run())
+
+    def stats(self) -> dict:
+        return {**self.counters, "concurrency_limit": int(self.limit), "in_flight": self.in_flight,
+                "rps": RATE_LIMIT_RPS, "burst": RATE_LIMIT_BURST, "shared": not isinstance(self.bucket, _LocalBucket)}
+
+
+limiter = AdaptiveLimiter()
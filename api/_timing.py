@@ -0,0 +1,153 @@
+# Per-request stage timings: where a request's time went (upstream calls vs. our own CPU work), as a
+# Server-Timing response header, an opt-in "timings" object in JSON responses and one structured
+# JSON log line per request.
+# Files starting with "_" are not deployed as routes; this is a helper module.
+import os, re, json, time, threading, functools, logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+log = logging.getLogger("timing")
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1").lower() in ("1", "true", "yes")   # response header
+TIMING_LOG    = os.environ.get("TIMING_LOG", "1").lower() in ("1", "true", "yes")      # one JSON line per request
+
+
+class Timings:
+    """
+    Stage durations of one request. Sequential handler steps are recorded with lap(name) (time
+    since the previous lap); concurrent work (one generation per image) with stage(name) blocks.
+    A name recorded twice accumulates. Thread-safe: stages run in pool threads and on the engine loop.
+    """
+
+    def __init__(self, route: str):
+        self.route = route
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+        self.status = None
+        self.expose = False  # the client asked for a "timings" object in the response
+        self._last = self.started
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def lap(self, name: str):
+        now = time.perf_counter()
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + (now - self._last)
+            self._last = now
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            stages = {name: round(s * 1000, 1) for name, s in self.stages.items()}
+        return {"total_ms": self.total_ms(), "stages_ms": stages}
+
+    def header(self) -> str:
+        """Server-Timing value: one metric per stage plus "total" (durations in ms)."""
+        with self._lock:
+            parts = [f"{_metric_name(name)};dur={s * 1000:.1f}" for name, s in self.stages.items()]
+        parts.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(parts)
+
+    def log_line(self):
+        if TIMING_LOG:
+            log.info(json.dumps({"event": "request_timing", "route": self.route, "status": self.status,
+                                 **self.as_dict(), **self.fields}, default=str))
+
+
+def _metric_name(name: str) -> str:
+    # Server-Timing metric names are HTTP tokens
+    return re.sub(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]", "_", name) or "stage"
+
+
+_current = ContextVar("timings", default=None)
+
+
+def current_timings():
+    """The Timings of the request being served in this context (thread or task), or None."""
+    return _current.get()
+
+
+def use_timings(timings):
+    """Make `timings` current for this context; asyncio tasks and copied contexts started later inherit it."""
+    return _current.set(timings)
+
+
+def lap(name: str):
+    """Record the time since the previous lap as `name` on the current request (no-op outside one)."""
+    timings = _current.get()
+    if timings is not None:
+        timings.lap(name)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as `name` on the current request (no-op outside one)."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    with timings.stage(name):
+        yield
+
+
+def annotate(**fields):
+    """Extra fields for the request's log line (e.g. number_of_images)."""
+    timings = _current.get()
+    if timings is not None:
+        timings.fields.update(fields)
+
+
+def expose_timings(value):
+    """Opt the current request into a "timings" object in its JSON response ("timings": true or ?timings=1)."""
+    timings = _current.get()
+    if timings is not None and str(value or "").strip().lower() in ("1", "true", "yes", "on"):
+        timings.expose = True
+
+
+def with_timings(obj):
+    """`obj` plus the current request's "timings" when it opted in; unchanged otherwise."""
+    timings = _current.get()
+    if timings is None or not timings.expose or not isinstance(obj, dict):
+        return obj
+    return {**obj, "timings": timings.as_dict()}
+
+
+def send_timing_header(handler, status: int):
+    """Record the response status and send Server-Timing (call between send_response and end_headers)."""
+    timings = _current.get()
+    if timings is None:
+        return
+    timings.status = status
+    if SERVER_TIMING:
+        handler.send_header("Server-Timing", timings.header())
+        handler.send_header("Timing-Allow-Origin", "*")  # let cross-origin pages read it
+
+
+def timed_request(route: str):
+    """Decorator for a handler's do_POST: times the request and writes its log line when it ends."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self):
+            timings = Timings(route)
+            token = use_timings(timings)
+            try:
+                return method(self)
+            finally:
+                timings.log_line()
+                _current.reset(token)
+        return wrapper
+    return decorate
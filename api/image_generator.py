@@ -1,45 +1,83 @@
 # route: /api/image_generator
 from http.server import BaseHTTPRequestHandler
-import os, json, base64, logging, sys, io, re
-from cgi import parse_header
-from openai import OpenAI
-from PIL import Image
-import io
+import os, json, base64, logging, sys, io, re, contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
+# Sibling helper modules (api/_*.py are not deployed as routes)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _body import parse_upload, read_body, BodyTooLarge, query_params
+from _cache import shared_result_cache, PerceptualCache, cache_key, image_digest, dhash, color_signature
+from _http import get_openai_client, LazyClient, pool_stats
+from _ratelimit import limiter
+from _deadline import Deadline, DeadlineExceeded, REQUEST_DEADLINE, call_timeout, current_deadline, use_deadline
+from _imaging import normalize_input_logged, negotiate_output_format, encode_image, output_mime, OUTPUT_QUALITY
+from _timing import timed_request, lap, stage, annotate, expose_timings, with_timings, send_timing_header
+
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
 log = logging.getLogger("image_generator")
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Shared, pooled client (keep-alive, HTTP/2 when available), built on first use; see api/_http.py
+client = LazyClient(get_openai_client)
+
+# Upper bound on concurrent image generations per request
+GEN_MAX_WORKERS = int(os.environ.get("IMAGE_GEN_MAX_WORKERS", "4") or "4")
+
+DESCRIBE_MODEL = "gpt-4.1"
+PROMPTS_MODEL  = "gpt-4o-mini"
+COMBINED_MODEL = "gpt-4.1"  # single_pass mode: description + prompts in one call
+# Part of the cached prompts' key: bump it when the texts of generate_creative_prompts() or
+# describe_and_plan() change, so prompts made with the old texts are not served
+PROMPTS_VERSION = "1"
+GEN_MODEL      = "gpt-4.1"
+
+# "two_pass": describe_image then generate_creative_prompts (two vision calls)
+# "single_pass": describe_and_plan (one vision call returning both)
+PIPELINE_MODES = ("two_pass", "single_pass")
+PIPELINE_MODE  = os.environ.get("IMAGE_PIPELINE_MODE", "two_pass")
+
+# Creative prompts and raw generated images, keyed by input image digest + prompt + model
+# (shared with improve2 when both run in one process)
+result_cache = shared_result_cache()
+# Image descriptions keyed by perceptual hash, so re-encoded/resized uploads still hit; one cache
+# per (model, pipeline mode), since each mode asks its model for the description differently
+def describe_model(pipeline_mode: str) -> str:
+    return COMBINED_MODEL if pipeline_mode == "single_pass" else DESCRIBE_MODEL
+
+describe_caches = {(describe_model(mode), mode): PerceptualCache() for mode in PIPELINE_MODES}
+
+def describe_cache_for(pipeline_mode: str) -> PerceptualCache:
+    return describe_caches[(describe_model(pipeline_mode), pipeline_mode)]
 
 def send_json(self, code, obj):
-    data = json.dumps(obj).encode("utf-8")
+    with stage("serialize"):
+        data = json.dumps(with_timings(obj)).encode("utf-8")
     self.send_response(code)
     self.send_header("content-type", "application/json")
     self.send_header("content-length", str(len(data)))
     self.send_header("Access-Control-Allow-Origin", "*")
+    send_timing_header(self, code)
     self.end_headers()
     self.wfile.write(data)
 
 # --- helpers ---------------------------------------------------------------
-def image_post_process(image_b64: str) -> str:
+def image_post_process(image_b64: str, fmt: str = "PNG", quality: int = None):
+    """Force 24-bit RGB and encode as `fmt`. Returns (base64, byte size)."""
     # Decode base64 → bytes
     img_bytes = base64.b64decode(image_b64)
     
-    # Open with Pillow
+    # Open with Pillow (imported here, not at cold start)
+    from PIL import Image
     with Image.open(io.BytesIO(img_bytes)) as img:
         # Convert to 24-bit RGB
         rgb_img = img.convert("RGB")
         # TODO: crop the image to 9:16 aspect ratio in center of the image
         # rgb_img = rgb_img.crop((0, 0, 1080, 1920))
 
-        
-        buf = io.BytesIO()
-        rgb_img.save(buf, format="PNG")  # keep PNG
-        rgb_bytes = buf.getvalue()
+        out_bytes = encode_image(rgb_img, fmt, quality)
     
     # Encode back to base64
-    return base64.b64encode(rgb_bytes).decode("utf-8")
+    return base64.b64encode(out_bytes).decode("utf-8"), len(out_bytes)
 
 DATA_URL_RE = re.compile(r"^data:(image/[^;]+);base64,(.+)$", re.IGNORECASE)
 
@@ -96,8 +134,8 @@ IMPORTANT: If there is Arabic text in the image:
 """
 
 def describe_image(base64_image: str) -> str:
-    response = client.responses.create(
-        model="gpt-4.1",  # vision-capable
+    response = limiter.call_blocking(lambda: client.responses.create(
+        model=DESCRIBE_MODEL,  # vision-capable
         input=[
             {
                 "role": "user",
@@ -107,7 +145,8 @@ def describe_image(base64_image: str) -> str:
                 ],
             }
         ],
-    )
+        timeout=call_timeout(),
+    ), "describe")
     return response.output_text
 
 # Step 2: Description + Image -> Creative Prompts
@@ -130,10 +169,8 @@ Start generate impressive ideas:
 """
 
     # Use OpenAI Chat API for creative prompts
-    chat_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    
-    response = chat_client.chat.completions.create(
-        model="gpt-4o-mini",
+    response = limiter.call_blocking(lambda: client.chat.completions.create(
+        model=PROMPTS_MODEL,
         messages=[
             {"role": "system", "content": "You are a creative AI designer for marketing."},
             {
@@ -143,19 +180,63 @@ Start generate impressive ideas:
                     {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
                 ]
             }
-        ]
-    )
+        ],
+        timeout=call_timeout(),
+    ), "prompts")
     
     return parse_json_safe(response.choices[0].message.content)
 
+def prompts_cache_key(base64_image: str, description: str, pipeline_mode: str, number_of_images: int) -> str:
+    # single_pass prompts come from COMBINED_MODEL, or PROMPTS_MODEL after a description cache hit
+    models = (COMBINED_MODEL, PROMPTS_MODEL) if pipeline_mode == "single_pass" else (PROMPTS_MODEL,)
+    return cache_key(image_digest(base64_image), description, "prompts", pipeline_mode, *models,
+                     PROMPTS_VERSION, number_of_images)
+
+# Step 1+2 in a single call: Image -> Description + Creative Prompts
+def describe_and_plan(base64_image: str, number_of_images: int):
+    combined_prompt_text = f"""
+{IMAGE_DESCRIPTION_PROMPT_TEMPLATE}
+
+Then, using that description and the image, generate {number_of_images} prompt ideas for another image-image model.
+The product is usually in the center of the image. Focus on ehnancing the product presentation and not changing the product itself.
+You can change the background, scene, composition, lighting, props, angel of view, or presentation style.
+Be creative and think outside the box.
+
+Return only JSON of the form:
+{{"description": "<the detailed description>", "prompts": {{"prompt1": "...", "prompt2": "..."}}}}
+with exactly {number_of_images} keys in "prompts": prompt1, prompt2, etc. (up to prompt{number_of_images}).
+"""
+
+    response = limiter.call_blocking(lambda: client.chat.completions.create(
+        model=COMBINED_MODEL,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": "You are a creative AI designer for marketing."},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": combined_prompt_text},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                ]
+            }
+        ],
+        timeout=call_timeout(),
+    ), "describe_and_plan")
+
+    out = parse_json_safe(response.choices[0].message.content)
+    description = (out.get("description") or "").strip()
+    prompts = out.get("prompts")
+    if not isinstance(prompts, dict):
+        prompts = {k: v for k, v in out.items() if k.lower().startswith("prompt")}
+    if not description or not prompts:
+        raise ValueError("Combined describe+plan output is missing 'description' or 'prompts'")
+    return description, prompts
+
 # Step 3: Prompts -> Images using GPT-4.1 with original image
-def generate_images_from_prompts(prompts_json: dict, base64_image: str, description: str, number_of_images: int) -> dict:
-    images = {}
-    
-    for key, prompt in list(prompts_json.items())[:number_of_images]:
-        try:
-            log.info(f"Generating image for {key}: {prompt}")
-            enhanced_text_prompt = f"""ORIGINAL IMAGE DESCRIPTION: {description}
+def generate_one_image(key: str, prompt: str, base64_image: str, description: str):
+    try:
+        log.info(f"Generating image for {key}: {prompt}")
+        enhanced_text_prompt = f"""ORIGINAL IMAGE DESCRIPTION: {description}
 
 ENHANCEMENT IDEA: {prompt}
 
@@ -180,10 +261,11 @@ CRITICAL TEXT HANDLING INSTRUCTIONS:
 - For any bilingual text (Arabic + English/Latin), maintain the correct direction for each script
 - Text should appear natural and readable and match exactly the original text, not distorted or backwards"""
 
-            
-            # Use GPT-4.1 with image generation tools, including original image
-            response = client.responses.create(
-                model="gpt-4.1",
+        
+        # Use GPT-4.1 with image generation tools, including original image
+        with stage(f"generate.{key}"):  # one per image; they run concurrently
+            response = limiter.call_blocking(lambda: client.responses.create(
+                model=GEN_MODEL,
                 input=[
                     {
                         "role": "user",
@@ -197,35 +279,90 @@ CRITICAL TEXT HANDLING INSTRUCTIONS:
                     }
                 ],
                 tools=[{"type": "image_generation"}],
-            )
-            
-            # Look for image_generation_call outputs
-            image_generation_calls = [
-                output
-                for output in response.output
-                if output.type == "image_generation_call"
-            ]
-            
-            if image_generation_calls:
-                # Get the base64 image data from the result
-                image_data = image_generation_calls[0].result
-                log.info(f"Generated image for {key}, base64 length: {len(image_data)}")
-                images[key] = image_data
-            else:
-                log.warning(f"No image generated for {key}. Response output:")
-                for output in response.output:
-                    log.warning(f"  Output type: {getattr(output, 'type', 'unknown')}")
-                    if hasattr(output, 'content'):
-                        for content in output.content:
-                            if hasattr(content, 'text'):
-                                log.warning(f"  Text: {content.text}")
-                images[key] = None
-                
-        except Exception as e:
-            log.exception(f"Error generating image for {key}: {e}")
-            images[key] = None
+                timeout=call_timeout(),
+            ), "generation")
+        
+        # Look for image_generation_call outputs
+        image_generation_calls = [
+            output
+            for output in response.output
+            if output.type == "image_generation_call"
+        ]
+        
+        if image_generation_calls:
+            # Get the base64 image data from the result
+            image_data = image_generation_calls[0].result
+            log.info(f"Generated image for {key}, base64 length: {len(image_data)}")
+            return image_data
+        else:
+            log.warning(f"No image generated for {key}. Response output:")
+            for output in response.output:
+                log.warning(f"  Output type: {getattr(output, 'type', 'unknown')}")
+                if hasattr(output, 'content'):
+                    for content in output.content:
+                        if hasattr(content, 'text'):
+                            log.warning(f"  Text: {content.text}")
+            return None
             
-    return images
+    except DeadlineExceeded:
+        raise  # a timeout, not a failure: generate_images_from_prompts reports it in timed_out
+    except Exception as e:
+        log.exception(f"Error generating image for {key}: {e}")
+        return None
+
+def generate_images_from_prompts(prompts_json: dict, base64_image: str, description: str, number_of_images: int,
+                                 max_workers: int = None, use_cache: bool = True):
+    """
+    Generate (or serve from cache) one image per prompt. Returns ({key: base64 or None}, [timed out keys]):
+    generations still running when the current request deadline passes are abandoned.
+    """
+    items = list(prompts_json.items())[:number_of_images]
+    if not items:
+        return {}, []
+
+    # Pre-seed keys so the result keeps prompt ordering regardless of completion order
+    images = {key: None for key, _ in items}
+
+    # Serve repeated (image, description + prompt) pairs from cache
+    digest = image_digest(base64_image)
+    cache_keys = {key: cache_key(digest, description, prompt, GEN_MODEL, "raw") for key, prompt in items}
+    todo = []
+    for key, prompt in items:
+        hit = result_cache.get(cache_keys[key]) if use_cache else None
+        if hit:
+            log.info(f"Cache hit for {key}")
+            images[key] = hit
+        else:
+            todo.append((key, prompt))
+    if not todo:
+        return images, []
+
+    workers = max(1, min(max_workers or GEN_MAX_WORKERS, len(todo)))
+    log.info(f"Generating {len(todo)} images with {workers} workers")
+    deadline = current_deadline()
+    ex = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # each worker runs in a copy of this context, so its model call sees the request deadline
+        futures = {key: ex.submit(contextvars.copy_context().run, generate_one_image, key, prompt, base64_image,
+                                  description)
+                   for key, prompt in todo}
+        wait(futures.values(), timeout=deadline.remaining() if deadline else None)
+        timed_out = []
+        for key, fut in futures.items():
+            if (not fut.done() or isinstance(fut.exception(), DeadlineExceeded)
+                    or (fut.result() is None and deadline is not None and deadline.expired)):
+                timed_out.append(key)
+                continue
+            images[key] = fut.result()
+            if images[key]:
+                result_cache.put(cache_keys[key], images[key])
+    finally:
+        # do not wait for abandoned generations; their call timeouts end them shortly
+        ex.shutdown(wait=False, cancel_futures=True)
+    if timed_out:
+        log.warning(f"Request deadline reached; {len(timed_out)} image(s) timed out: {timed_out}")
+
+    return images, timed_out
 
 # --- handler ---------------------------------------------------------------
 
@@ -240,11 +377,21 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         send_json(self, 200, {
             "ok": True,
-            "usage": "POST application/json with: { image_base64: string, number_of_images: number }. Generates enhanced product images with creative prompts.",
-            "description": "This API takes a product image as base64 and generates enhanced versions with different creative presentations while preserving the original product identity."
+            "usage": "POST application/json with: { image_base64: string, number_of_images: number }, or the raw image as an image/* body (?number_of_images=N), or multipart/form-data with an 'image' file part. Generates enhanced product images with creative prompts. Output is PNG unless output_format (webp, avif, jpeg, png, auto) / quality or an Accept header listing image/avif or image/webp picks another encoding.",
+            "description": "This API takes a product image as base64 and generates enhanced versions with different creative presentations while preserving the original product identity.",
+            "pipeline_mode": f"Optional pipeline_mode: one of {list(PIPELINE_MODES)} (default {PIPELINE_MODE}). single_pass describes the image and plans prompts in one model call.",
+            "cache": "Repeated requests are served from cache; send \"cache\": \"bypass\" (or ?cache=bypass) to force fresh results.",
+            "cache_stats": result_cache.stats(),
+            "describe_cache_stats": {f"{model}/{mode}": c.stats() for (model, mode), c in describe_caches.items()},
+            "http_pool_stats": pool_stats(),
+            "rate_limit_stats": limiter.stats(),
+            "deadline": f"Each request must finish within {REQUEST_DEADLINE:.0f}s (REQUEST_DEADLINE, a margin under the function's maxDuration); send \"deadline\": seconds to ask for less. Images still generating at the deadline are listed in timed_out_images and the finished ones are returned with \"partial\": true.",
+            "timings": "Every POST answers with a Server-Timing header (read, decode, describe, plan, generate.<prompt>, post_process, serialize) and logs one JSON line with the same stages; send \"timings\": true (or ?timings=1) to also get them as a \"timings\" object in the JSON response."
         })
 
+    @timed_request("image_generator")
     def do_POST(self):
+        deadline = Deadline()  # the request's clock starts before the body is read
         # fail fast on key issues
         err = _check_key()
         if err:
@@ -252,17 +399,18 @@ class handler(BaseHTTPRequestHandler):
 
         # --- tolerant body read + parsing -----------------------------------
         ctype_raw = self.headers.get("content-type", "") or ""
-        clen_raw  = self.headers.get("content-length", "") or ""
-        try:
-            clen = int(clen_raw) if clen_raw else 0
-        except Exception:
-            clen = 0
+        main_type = ctype_raw.split(";", 1)[0].strip().lower()
 
-        main_type, _ = parse_header(ctype_raw)
-        main_type = (main_type or "").lower()
-
-        body = self.rfile.read(clen) if clen else b""
+        try:
+            body = read_body(self)
+        except BodyTooLarge as e:
+            self.close_connection = True
+            return send_json(self, 413, {"error": str(e)})
+        except ValueError as e:
+            self.close_connection = True
+            return send_json(self, 400, {"error": str(e)})
         raw = (body or b"").strip()
+        lap("read")
 
         # Accept JSON (with/without charset), or anything that starts with "{"
         is_jsonish = main_type.startswith("application/json") or raw.startswith(b"{")
@@ -272,8 +420,13 @@ class handler(BaseHTTPRequestHandler):
         log.info("POST content-type=%r main=%r len=%d jsonish=%s form=%s",
                  ctype_raw, main_type, len(raw), is_jsonish, is_form)
 
+        image_bytes = None
         try:
-            if is_form:
+            upload = parse_upload(main_type, ctype_raw, body or b"", self.path)
+            if upload is not None:
+                # Binary upload (raw image/* or multipart): no base64 round trip
+                data, image_bytes = upload
+            elif is_form:
                 from urllib.parse import parse_qs
                 qs = parse_qs(raw.decode("utf-8", "ignore"))
                 data = {k: v[0] for k, v in qs.items()}
@@ -282,16 +435,17 @@ class handler(BaseHTTPRequestHandler):
                 data = json.loads(raw.decode("utf-8", "ignore") or "{}")
         except Exception:
             return send_json(self, 400, {
-                "error": "Invalid request body. Send JSON or x-www-form-urlencoded.",
+                "error": "Invalid request body. Send JSON, x-www-form-urlencoded, multipart/form-data or a raw image/* body.",
                 "got_content_type": ctype_raw,
                 "body_preview": raw[:100].decode("utf-8", "ignore")
             })
 
         image_base64 = (data.get("image_base64") or "").strip()
         number_of_images = data.get("number_of_images", 2)
+        expose_timings(data.get("timings") or query_params(self.path).get("timings"))
         
-        if not image_base64:  
-            return send_json(self, 400, {"error": "Missing 'image_base64'"})
+        if not image_base64 and not image_bytes:
+            return send_json(self, 400, {"error": "Missing 'image_base64' (or an image upload)"})
         
         # Validate number_of_images
         try:
@@ -301,57 +455,134 @@ class handler(BaseHTTPRequestHandler):
         except (ValueError, TypeError):
             return send_json(self, 400, {"error": "number_of_images must be a valid integer"})
 
-        # Extract base64 from image_base64 (if it's a data URL, otherwise use as-is)
-        mime_hint, base64_image = _strip_data_url(image_base64)
-        if not base64_image:
-            base64_image = image_base64
-
+        if image_bytes:
+            mime_hint = _detect_mime(image_bytes)
+            if mime_hint == "application/octet-stream":
+                return send_json(self, 400, {"error": "Unrecognized image upload (expected PNG, JPEG or WEBP)"})
+            # single encode, only because the model/response payload needs base64
+            base64_image = base64.b64encode(image_bytes).decode("ascii")
+        else:
+            # Extract base64 from image_base64 (if it's a data URL, otherwise use as-is)
+            mime_hint, base64_image = _strip_data_url(image_base64)
+            if not base64_image:
+                base64_image = image_base64
+
+            try:
+                # Validate base64 image data
+                image_bytes = _decode_image_b64(base64_image)
+            except Exception as e:
+                return send_json(self, 400, {"error": f"Invalid base64 image data: {str(e)}"})
+
+        qs = query_params(self.path)
+        # downscale / re-encode before the describe/plan/generate calls
+        norm_bytes, norm_mime = normalize_input_logged(image_bytes, "input")
+        if norm_mime and norm_bytes is not image_bytes:
+            image_bytes = norm_bytes
+            base64_image = base64.b64encode(image_bytes).decode("ascii")
+
+        use_cache = str(data.get("cache") or qs.get("cache") or "").strip().lower() != "bypass"
+        pipeline_mode = str(data.get("pipeline_mode") or qs.get("pipeline_mode") or PIPELINE_MODE).strip().lower()
+        if pipeline_mode not in PIPELINE_MODES:
+            return send_json(self, 400, {"error": f"pipeline_mode must be one of {list(PIPELINE_MODES)}"})
         try:
-            # Validate base64 image data
-            _decode_image_b64(base64_image)
-        except Exception as e:
-            return send_json(self, 400, {"error": f"Invalid base64 image data: {str(e)}"})
+            quality = int(data.get("quality") or qs.get("quality") or 0) or None
+            if quality is not None and not 1 <= quality <= 100:
+                raise ValueError("quality must be 1..100")
+            # explicit output_format wins, else Accept (image/avif, image/webp), else PNG as before
+            output_format = negotiate_output_format(data.get("output_format") or qs.get("output_format"),
+                                                    self.headers.get("accept"), default="PNG")
+            # a client may ask for less time than REQUEST_DEADLINE, never more
+            deadline = Deadline.parse(data.get("deadline") or qs.get("deadline"), started=deadline.started)
+        except ValueError as e:
+            return send_json(self, 400, {"error": str(e)})
+        use_deadline(deadline)  # caps every model call made for this request
+        lap("decode")  # parse, decode, normalize and validate
+        annotate(number_of_images=number_of_images, pipeline_mode=pipeline_mode, input_bytes=len(image_bytes))
 
         try:
-            # Step 1: Describe the image
-            log.info("Step 1: Describing image...")
-            description = describe_image(base64_image)
+            # Step 1: Describe the image (skipped when a perceptually identical image was described)
+            describe_cache = describe_cache_for(pipeline_mode)
+            try:
+                phash, colors = dhash(image_bytes), color_signature(image_bytes)
+            except Exception as e:
+                log.warning(f"Perceptual hash failed, describe cache disabled for this request: {e}")
+                phash, colors = None, b""
+            prompts_json = None
+            description = describe_cache.get(phash, colors) if (use_cache and phash is not None) else None
+            if description:
+                log.info(f"Step 1: Description cache hit (dhash={phash:016x})")
+            elif pipeline_mode == "single_pass":
+                log.info("Step 1+2: Describing image and generating prompts in one call...")
+                description, prompts_json = describe_and_plan(base64_image, number_of_images)
+            else:
+                log.info("Step 1: Describing image...")
+                description = describe_image(base64_image)
+            if phash is not None and description:
+                describe_cache.put(phash, description, colors)
+            lap("describe_and_plan" if prompts_json is not None else "describe")
             log.info(f"Image description: {description[:200]}...")
 
             # Step 2: Generate creative prompts
-            log.info("Step 2: Generating creative prompts...")
-            prompts_json = generate_creative_prompts(description, base64_image, number_of_images)
+            prompts_key = prompts_cache_key(base64_image, description, pipeline_mode, number_of_images)
+            if prompts_json is not None:
+                result_cache.put(prompts_key, json.dumps(prompts_json))
+            else:
+                log.info("Step 2: Generating creative prompts...")
+                cached_prompts = result_cache.get(prompts_key) if use_cache else None
+                if cached_prompts:
+                    prompts_json = json.loads(cached_prompts)
+                else:
+                    prompts_json = generate_creative_prompts(description, base64_image, number_of_images)
+                    result_cache.put(prompts_key, json.dumps(prompts_json))
+            lap("plan")
             log.info(f"Generated prompts: {list(prompts_json.keys())}")
 
             # Step 3: Generate images from prompts
             log.info("Step 3: Generating images...")
-            generated_images = generate_images_from_prompts(prompts_json, base64_image, description, number_of_images)
+            generated_images, timed_out = generate_images_from_prompts(prompts_json, base64_image, description,
+                                                                       number_of_images, use_cache=use_cache)
+            lap("generate")  # wall time; each image is also timed as generate.<prompt>
 
             # Prepare response - focus on generated images
             result = {
                 "success": True,
-                "generated_images": []
+                "pipeline_mode": pipeline_mode,
+                "encoding": {"format": output_format.lower(), "quality": quality or OUTPUT_QUALITY.get(output_format)},
+                "generated_images": [],
+                "partial": bool(timed_out),
+                "timed_out_images": [{"prompt": prompts_json.get(key, ""), "error": "deadline_exceeded"}
+                                     for key in timed_out],
             }
 
             # Add generated images to result as array
             for key, image_b64 in generated_images.items():
                 if image_b64:
+                    mime = output_mime(output_format)
                     try:
                         # Force 24-bit RGB before returning
-                        image_b64_rgb = image_post_process(image_b64)
+                        image_b64_rgb, size = image_post_process(image_b64, output_format, quality)
                     except Exception as e:
                         log.warning(f"Failed to convert image {key} to 24-bit: {e}")
                         image_b64_rgb = image_b64  # fallback to original
+                        mime = "image/png"
+                        size = len(image_b64) * 3 // 4
 
                     result["generated_images"].append({
                         "prompt": prompts_json.get(key, ""),
-                        "image": f"data:image/png;base64,{image_b64_rgb}"
+                        "image": f"data:{mime};base64,{image_b64_rgb}",
+                        "format": mime.split("/")[-1],
+                        "bytes": size,
                     })
+            result["output_bytes"] = sum(i["bytes"] for i in result["generated_images"])
+            lap("post_process")
 
 
             log.info(f"Successfully generated {len(result['generated_images'])} images")
             return send_json(self, 200, result)
 
+        except DeadlineExceeded as e:
+            log.warning(f"Request deadline reached before any image was generated: {e}")
+            return send_json(self, 504, {"error": "deadline_exceeded", "message": str(e)})
         except Exception as e:
             import traceback
             log.exception("Image generation pipeline failed")
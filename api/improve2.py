@@ -373,35 +373,144 @@
 #                 "trace": traceback.format_exc(),
 #             })
 from http.server import BaseHTTPRequestHandler
-import os, json, base64, logging, sys, re
-from urllib.request import urlopen, Request
-from urllib.error import URLError, HTTPError
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import urllib.request  # used for callback POST
-from openai import OpenAI
-from PIL import Image
-import io
+import os, json, base64, logging, sys, re, threading, queue, asyncio, inspect, concurrent.futures
+from urllib.parse import urlparse, parse_qs
+
+# Sibling helper modules (api/_*.py are not deployed as routes)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _jobs import JobStore
+from _http import get_async_openai_client, LazyClient, afetch_bytes, pool_stats
+from _aio import submit as submit_coro, run_sync, upstream_slot, engine_stats
+from _ratelimit import limiter
+from _hedge import Hedger
+from _deadline import Deadline, DeadlineExceeded, REQUEST_DEADLINE, call_timeout, use_deadline
+from _outbox import Outbox, OutboxWorker
+from _blobs import get_blob_store, blob_store_problem, BLOB_STORE, BLOB_INLINE_MAX_BYTES
+from _body import parse_upload, read_body, BodyTooLarge, query_params
+from _timing import (Timings, timed_request, current_timings, use_timings, lap, stage, annotate, expose_timings,
+                     with_timings, send_timing_header)
+from _cache import shared_result_cache, cache_key, image_digest, bytes_digest
+from _imaging import (normalize_input_logged, make_renditions, parse_renditions, RENDITION_PRESETS, offload_async,
+                      negotiate_output_format, OUTPUT_QUALITY)
 
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
 log = logging.getLogger("image_generator")
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Async client on the shared pool; every model call runs on the engine loop (api/_aio.py)
+# and holds one of the process-wide upstream slots. Built (and openai imported) on first use.
+aclient = LazyClient(get_async_openai_client)
+
+PLANNER_MODEL = "gpt-4o-mini"
+GEN_MODEL     = "gpt-4.1"
+
+# Optional hedging of slow generations (HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_BUDGET...)
+gen_hedger = Hedger("generation")
+
+# Stream the planner and start each generation as soon as its prompt is parsed
+PIPELINED_PLANNER = os.environ.get("IMPROVE2_PIPELINED_PLANNER", "0").lower() in ("1", "true", "yes")
+
+# Upload the input image once (Files API) and reference it from every model call
+UPLOAD_ONCE = os.environ.get("IMPROVE2_UPLOAD_ONCE", "1").lower() in ("1", "true", "yes")
+INPUT_FETCH_MAX_BYTES = 20 * 1024 * 1024
+
+# Planner outputs and post-processed images, keyed by input image digest + prompt + model + settings
+result_cache = shared_result_cache()
 
 def send_json(self, code, obj):
-    data = json.dumps(obj).encode("utf-8")
+    with stage("serialize"):
+        data = json.dumps(with_timings(obj)).encode("utf-8")
     self.send_response(code)
     self.send_header("content-type", "application/json")
     self.send_header("content-length", str(len(data)))
     self.send_header("Access-Control-Allow-Origin", "*")
+    send_timing_header(self, code)
     self.end_headers()
     self.wfile.write(data)
 
+# --------------------------------------------------------------------------
+# Streaming responses (NDJSON / Server-Sent Events)
+# --------------------------------------------------------------------------
+def _stream_mode(self) -> str:
+    """Return "ndjson", "sse" or "" (buffered) from ?stream=... or the Accept header."""
+    qs = parse_qs(urlparse(self.path).query)
+    mode = (qs.get("stream", [""])[0] or "").strip().lower()
+    if mode in ("ndjson", "sse"):
+        return mode
+    accept = (self.headers.get("accept", "") or "").lower()
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return ""
+
+def start_stream(self, mode: str):
+    # No content-length: the body is terminated by closing the connection
+    self.send_response(200)
+    self.send_header("content-type", "text/event-stream" if mode == "sse" else "application/x-ndjson")
+    self.send_header("cache-control", "no-cache")
+    self.send_header("connection", "close")
+    self.send_header("Access-Control-Allow-Origin", "*")
+    send_timing_header(self, 200)  # only the stages before the stream starts; the log line has them all
+    self.end_headers()
+    self.close_connection = True
+
+def send_event(self, mode: str, event: str, obj: dict) -> bool:
+    """Write one record and flush it to the client. Returns False if the client went away."""
+    if mode == "sse":
+        data = f"event: {event}\ndata: {json.dumps(obj)}\n\n".encode("utf-8")
+    else:
+        data = (json.dumps({"type": event, **obj}) + "\n").encode("utf-8")
+    try:
+        self.wfile.write(data)
+        self.wfile.flush()
+        return True
+    except (BrokenPipeError, ConnectionResetError) as e:
+        log.warning(f"Stream client disconnected during '{event}': {e}")
+        return False
+
 # --------------------------------------------------------------------------
 # Helpers
 # --------------------------------------------------------------------------
-def image_post_process(image_b64: str) -> str:
-    """Image post processing (force 24-bit RGB PNG)."""
+
+# Part of the generation cache key: change it whenever image_post_process output changes
+POST_PROCESS_SETTINGS = "rgb|renditions-v2"
+
+# The 9:16 TikTok crop is always produced and returned as "image"
+PRIMARY_RENDITION = {"name": "9x16", **RENDITION_PRESETS["9x16"]}
+
+# Extra renditions for every request unless the request sends its own (e.g. "4x5,1x1,thumb")
+DEFAULT_RENDITIONS = os.environ.get("IMPROVE2_RENDITIONS", "")
+
+def resolve_renditions(value, output_format: str = None, quality: int = None) -> list:
+    """
+    Rendition specs for a request: the primary 9:16 crop first, then the extras (deduped by name).
+    output_format/quality (see negotiate_output_format) apply to every rendition that does not
+    set its own.
+    """
+    primary = dict(PRIMARY_RENDITION)
+    if output_format and output_format != primary["format"]:
+        primary["format"], primary["quality"] = output_format, OUTPUT_QUALITY.get(output_format, 85)
+    if quality:
+        primary["quality"] = quality
+    specs = [primary]
+    for spec in parse_renditions(value if value else DEFAULT_RENDITIONS, output_format, quality):
+        if spec["name"] not in [x["name"] for x in specs]:
+            specs.append(spec)
+    return specs
+
+def _encode_renditions(rendered: list) -> list:
+    # renditions that failed to encode carry an "error" and no data
+    return [{**r, "bytes": len(r["data"]), "data": base64.b64encode(r["data"]).decode("utf-8")} if "data" in r else r
+            for r in rendered]
+
+def image_post_process(image_b64: str, renditions: list = None) -> list:
+    """
+    Image post processing (force 24-bit RGB, crop, encode), producing every
+    rendition from a single decode. Returns [{name, aspect, width, height,
+    format, bytes, data(base64)}]; the first entry is the primary 9:16 JPEG.
+    A rendition that could not be encoded is {name, aspect, format, error}.
+    """
     # If the string has a data URL prefix, strip it
     if image_b64.startswith("data:"):
         _, b64data = image_b64.split(",", 1)
@@ -409,38 +518,91 @@ def image_post_process(image_b64: str) -> str:
         b64data = image_b64
 
     img_bytes = base64.b64decode(b64data)
-    with Image.open(io.BytesIO(img_bytes)) as img:
-        log.info(f"Pre-conversion mode: {img.mode}")  # <-- useful for debugging
-        rgb_img = img.convert("RGB")  # Force 24-bit
-        log.info(f"Post-conversion mode: {rgb_img.mode}")
-        
-        # --- Crop to 9:16 aspect ratio (center crop) ---
-        img_w, img_h = rgb_img.size
-        target_ratio = 9 / 16
-        current_ratio = img_w / img_h
-
-        if current_ratio > target_ratio:
-            # Image is too wide → crop width
-            new_w = int(img_h * target_ratio)
-            left = (img_w - new_w) // 2
-            top = 0
-            right = left + new_w
-            bottom = img_h
-        else:
-            # Image is too tall → crop height
-            new_h = int(img_w / target_ratio)
-            left = 0
-            top = (img_h - new_h) // 2
-            right = img_w
-            bottom = top + new_h
-
-        cropped = rgb_img.crop((left, top, right, bottom))
-
-        # --- Save as JPEG ---
-        buf = io.BytesIO()
-        cropped.save(buf, format="JPEG")
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
-
+    return _encode_renditions(make_renditions(img_bytes, renditions or [PRIMARY_RENDITION]))
+
+# Post-processing is CPU-bound; run it on a persistent process pool so the k images
+# use all cores instead of queueing behind the GIL. 0 disables the pool.
+#
+# The pool uses "spawn", so every worker re-imports the host's __main__ module. A launcher
+# without an `if __name__ == "__main__":` guard starts itself again inside each worker, which
+# then crashes (BrokenProcessPool) or never answers. Vercel's Python launcher has not been
+# checked for this, so the first use of a pool waits on a start-up probe for at most
+# IMPROVE2_POST_PROCESS_POOL_START_TIMEOUT seconds, and a pool that fails to start or breaks
+# later is dropped for good: post-processing then runs in-thread.
+POST_PROCESS_WORKERS = int(os.environ.get("IMPROVE2_POST_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))) or "0")
+POST_PROCESS_POOL_START_TIMEOUT = float(os.environ.get("IMPROVE2_POST_PROCESS_POOL_START_TIMEOUT", "20"))
+
+_pp_pool = None
+_pp_probe = None  # concurrent Future of the start-up probe of _pp_pool
+_pp_pool_lock = threading.Lock()
+
+def get_post_process_pool():
+    global _pp_pool, _pp_probe, POST_PROCESS_WORKERS
+    if POST_PROCESS_WORKERS <= 0:
+        return None
+    with _pp_pool_lock:
+        if _pp_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            try:
+                # spawn: forking a process that runs request threads is not safe
+                _pp_pool = ProcessPoolExecutor(max_workers=POST_PROCESS_WORKERS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+                _pp_probe = _pp_pool.submit(os.getpid)
+            except Exception as e:
+                log.warning(f"Process pool unavailable, post-processing in-thread: {e}")
+                POST_PROCESS_WORKERS = 0
+                _pp_pool = _pp_probe = None
+        return _pp_pool
+
+def _drop_post_process_pool(pool, reason) -> None:
+    """Stop using `pool` (if it is still the current one) and post-process in-thread from now on."""
+    global _pp_pool, _pp_probe, POST_PROCESS_WORKERS
+    with _pp_pool_lock:
+        if _pp_pool is not pool:
+            return
+        log.warning(f"Post-process pool failed, falling back to in-thread: {reason}")
+        POST_PROCESS_WORKERS = 0
+        _pp_pool = _pp_probe = None
+    # a worker stuck re-running an unguarded launcher never reads the shutdown request;
+    # collect the workers first, shutdown() forgets them
+    procs = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for proc in procs:
+        proc.terminate()
+
+async def _post_process_pool_started(pool) -> bool:
+    from concurrent.futures.process import BrokenProcessPool
+    probe = _pp_probe
+    if probe is None or (probe.done() and probe.exception() is None):
+        return _pp_pool is pool
+    waiter = asyncio.wrap_future(probe)
+    try:
+        await asyncio.wait_for(asyncio.shield(waiter), POST_PROCESS_POOL_START_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        # terminating the pool fails the probe later; that outcome is expected, not worth a log line
+        waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+        _drop_post_process_pool(pool, f"no worker started within {POST_PROCESS_POOL_START_TIMEOUT:.0f}s")
+    except (BrokenProcessPool, OSError, RuntimeError) as e:
+        _drop_post_process_pool(pool, e)
+    return False
+
+async def post_process_offloaded(image_b64: str, renditions: list = None) -> list:
+    """image_post_process() on the process pool (falls back to a worker thread)."""
+    from concurrent.futures.process import BrokenProcessPool
+    pool = get_post_process_pool()
+    if pool is None or not await _post_process_pool_started(pool):
+        return await asyncio.to_thread(image_post_process, image_b64, renditions)
+    _, b64data = _strip_data_url(image_b64)
+    img_bytes = base64.b64decode(b64data)
+    try:
+        rendered = await offload_async(pool, make_renditions, img_bytes, renditions or [PRIMARY_RENDITION])
+    except (BrokenProcessPool, RuntimeError, FileNotFoundError, PermissionError) as e:
+        # e.g. no /dev/shm, no multiprocessing support, or a worker that died
+        _drop_post_process_pool(pool, e)
+        return await asyncio.to_thread(image_post_process, image_b64, renditions)
+    return _encode_renditions(rendered)
 
 
 DATA_URL_RE = re.compile(r"^data:(image/[^;]+);base64,(.+)$", re.IGNORECASE)
@@ -467,37 +629,6 @@ def _check_key():
         return "OPENAI_API_KEY format looks wrong"
     return ""
 
-def _read_body(self) -> bytes:
-    """
-    Read request body supporting both Content-Length and
-    Transfer-Encoding: chunked (used by Deno fetch).
-    """
-    if (self.headers.get("transfer-encoding", "").lower() == "chunked"):
-        buf = b""
-        while True:
-            size_line = self.rfile.readline()
-            if not size_line:
-                break
-            size_line = size_line.strip()
-            if not size_line:
-                continue
-            try:
-                size = int(size_line, 16)
-            except Exception:
-                break
-            if size == 0:
-                self.rfile.readline()  # trailing CRLF
-                break
-            chunk = self.rfile.read(size)
-            buf += chunk
-            self.rfile.read(2)  # CRLF
-        return buf
-    try:
-        clen = int(self.headers.get("content-length", "0") or "0")
-    except Exception:
-        clen = 0
-    return self.rfile.read(clen) if clen > 0 else b""
-
 def parse_json_safe(text: str) -> dict:
     if not text:
         raise ValueError("Empty model output")
@@ -528,54 +659,718 @@ Rules:
 - Return ONLY valid JSON. No commentary.
 """
 
-def to_chat_image_content(url_or_data_url: str) -> dict:
+class InputRef:
+    """
+    The request's input image, prepared once and referenced by every model call.
+    With a file_id the image was uploaded once via the Files API and calls only
+    carry the id; otherwise each call embeds the URL / data URL. sent_bytes counts
+    the image bytes we send upstream for this request.
+    """
+
+    def __init__(self, url_or_dataurl: str, file_id: str = None, sent_bytes: int = 0):
+        self.url_or_dataurl = url_or_dataurl
+        self.file_id = file_id
+        self.sent_bytes = sent_bytes
+        self._lock = threading.Lock()
+
+    def _count(self):
+        if not self.file_id and self.url_or_dataurl.startswith("data:"):
+            with self._lock:
+                self.sent_bytes += len(self.url_or_dataurl)
+
+    def chat_content(self) -> dict:
+        self._count()
+        return {"type": "image_url", "image_url": {"url": self.url_or_dataurl}}
+
+    def responses_content(self) -> dict:
+        if self.file_id:
+            return {"type": "input_image", "file_id": self.file_id}
+        self._count()
+        return {"type": "input_image", "image_url": self.url_or_dataurl}
+
+async def _fetch_image(url: str):
+    """Fetch a remote image once (size-capped). Returns (bytes, mime)."""
+    buf, ctype = await afetch_bytes(url, INPUT_FETCH_MAX_BYTES, headers={"User-Agent": "improve2/1.0"})
+    mime = _detect_mime(buf)
+    if mime == "application/octet-stream":
+        mime = ctype or "image/jpeg"
+    return buf, mime
+
+async def fetch_input(url: str) -> tuple:
+    """Fetch a remote input image once and normalize it like uploads. Returns (bytes, mime)."""
+    buf, mime = await _fetch_image(url)
+    buf, norm_mime = await asyncio.to_thread(normalize_input_logged, buf, "image_url")
+    return buf, norm_mime or mime
+
+async def prepare_input(url_or_dataurl: str, fetched: tuple = None) -> InputRef:
+    """
+    Input stage: turn the image into one reusable reference. Data URLs are decoded,
+    URLs are fetched once (or `fetched`, the (bytes, mime) of fetch_input(), is used),
+    and the bytes are uploaded once with purpose="vision".
+    Falls back to sending the URL / data URL with every call if anything fails.
+    """
+    if not UPLOAD_ONCE:
+        return InputRef(url_or_dataurl)
+    try:
+        if url_or_dataurl.startswith("data:"):
+            mime, b64 = _strip_data_url(url_or_dataurl)
+            buf = _decode_image_b64(b64)
+            mime = mime or _detect_mime(buf)
+        else:
+            buf, mime = fetched or await fetch_input(url_or_dataurl)
+        ext = {"image/png": "png", "image/webp": "webp"}.get(mime, "jpg")
+        async with upstream_slot():
+            f = await aclient.files.create(file=(f"input.{ext}", buf, mime), purpose="vision",
+                                           timeout=call_timeout())
+        log.info("Input uploaded once as %s (%d bytes)", f.id, len(buf))
+        return InputRef(url_or_dataurl, file_id=f.id, sent_bytes=len(buf))
+    except Exception as e:
+        log.warning(f"Upload-once input stage failed, sending the image inline: {e}")
+        return InputRef(url_or_dataurl)
+
+async def release_input(ref: InputRef):
+    if ref.file_id:
+        try:
+            async with upstream_slot():
+                await aclient.files.delete(ref.file_id, timeout=10)  # cleanup, even past the deadline
+        except Exception as e:
+            log.warning(f"Failed to delete uploaded input {ref.file_id}: {e}")
+
+_cleanups = set()  # release_input_later() tasks, referenced until they finish
+
+def release_input_later(ref_task: asyncio.Future):
+    """Release the input of a prepare_input() task that is still running, once it finishes."""
+    async def release():
+        try:
+            ref = await ref_task
+        except BaseException:
+            return
+        await release_input(ref)
+    task = asyncio.ensure_future(release())
+    _cleanups.add(task)
+    task.add_done_callback(_cleanups.discard)
+
+def to_chat_image_content(url_or_data_url) -> dict:
+    if isinstance(url_or_data_url, InputRef):
+        return url_or_data_url.chat_content()
     return {"type": "image_url", "image_url": {"url": url_or_data_url}}
 
-def to_responses_image_content(url_or_data_url: str) -> dict:
+def to_responses_image_content(url_or_data_url) -> dict:
+    if isinstance(url_or_data_url, InputRef):
+        return url_or_data_url.responses_content()
     return {"type": "input_image", "image_url": url_or_data_url}
 
-def plan_prompts(image_url_or_dataurl: str, k: int) -> dict:
+def _planner_messages(image_url_or_dataurl, k: int) -> list:
     prompt_text = PLANNER_PROMPT.format(k=k)
-    log.info("Planner: generating %d prompts with gpt-4o-mini", k)
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "Return only valid JSON. No commentary."},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt_text},
-                    to_chat_image_content(image_url_or_dataurl)
-                ],
-            },
+    return [
+        {"role": "system", "content": "Return only valid JSON. No commentary."},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt_text},
+                to_chat_image_content(image_url_or_dataurl)
+            ],
+        },
+    ]
+
+def _planner_uses_file(image_ref) -> bool:
+    # Chat Completions cannot reference an uploaded file; those plans go through the Responses API
+    return isinstance(image_ref, InputRef) and bool(image_ref.file_id)
+
+def _planner_responses_input(image_ref: InputRef, k: int) -> list:
+    return [{
+        "role": "user",
+        "content": [
+            {"type": "input_text", "text": PLANNER_PROMPT.format(k=k)},
+            image_ref.responses_content(),
         ],
-        temperature=0.7,
-    )
+    }]
+
+async def plan_prompts(image_url_or_dataurl, k: int) -> dict:
+    log.info("Planner: generating %d prompts with %s", k, PLANNER_MODEL)
+    async with upstream_slot():
+        if _planner_uses_file(image_url_or_dataurl):
+            r = await limiter.call(lambda: aclient.responses.create(
+                model=PLANNER_MODEL,
+                instructions="Return only valid JSON. No commentary.",
+                input=_planner_responses_input(image_url_or_dataurl, k),
+                temperature=0.7,
+                timeout=call_timeout(),
+            ), "planner")
+            return parse_json_safe(r.output_text)
+        resp = await limiter.call(lambda: aclient.chat.completions.create(
+            model=PLANNER_MODEL,
+            messages=_planner_messages(image_url_or_dataurl, k),
+            temperature=0.7,
+            timeout=call_timeout(),
+        ), "planner")
     return parse_json_safe(resp.choices[0].message.content)
 
-def gen_one_image(prompt: str, image_url_or_dataurl: str) -> str:
+async def _planner_deltas(image_url_or_dataurl, k: int):
+    """Yield the planner's output text as it streams in (holds an upstream slot while streaming)."""
+    async with upstream_slot():
+        if _planner_uses_file(image_url_or_dataurl):
+            stream = await limiter.call(lambda: aclient.responses.create(
+                model=PLANNER_MODEL,
+                instructions="Return only valid JSON. No commentary.",
+                input=_planner_responses_input(image_url_or_dataurl, k),
+                temperature=0.7,
+                stream=True,
+                timeout=call_timeout(),
+            ), "planner")
+            async for event in stream:
+                if getattr(event, "type", "") == "response.output_text.delta":
+                    yield event.delta or ""
+            return
+        stream = await limiter.call(lambda: aclient.chat.completions.create(
+            model=PLANNER_MODEL,
+            messages=_planner_messages(image_url_or_dataurl, k),
+            temperature=0.7,
+            stream=True,
+            timeout=call_timeout(),
+        ), "planner")
+        async for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+
+# A complete "promptN": "..." pair in (possibly partial) planner JSON
+PROMPT_PAIR_RE = re.compile(r'"(prompt(\d+))"\s*:\s*"((?:[^"\\]|\\.)*)"', re.IGNORECASE)
+
+async def plan_prompts_streaming(image_url_or_dataurl, k: int, on_prompt=None) -> dict:
+    """
+    Streaming planner: on_prompt(key, text) is called as soon as each "promptN"
+    value is complete in the partial output, so generation can start while the
+    rest is still being planned. The batch parse of the full output wins when it
+    has prompts; otherwise (malformed or truncated output, or a stream that broke
+    off) the prompts already handed out are used, and plan_prompts() when there
+    are none.
+    """
+    log.info("Planner: streaming %d prompts with %s", k, PLANNER_MODEL)
+    found = {}
+    text = ""
+    try:
+        scan_from = 0
+        async for delta in _planner_deltas(image_url_or_dataurl, k):
+            if not delta:
+                continue
+            text += delta
+            for m in PROMPT_PAIR_RE.finditer(text, scan_from):
+                scan_from = m.end()
+                key, n = m.group(1), int(m.group(2))
+                if key in found or not (1 <= n <= k):
+                    continue
+                try:
+                    value = json.loads(f'"{m.group(3)}"')
+                except ValueError:
+                    continue
+                found[key] = value
+                log.info("Planner stream: %s ready after %d chars", key, len(text))
+                if on_prompt:
+                    on_prompt(key, value)
+    except Exception as e:
+        if not found:
+            log.warning("Planner streaming failed (%s); falling back to batch planner", e)
+            return await plan_prompts(image_url_or_dataurl, k)
+        # the prompts handed out are already generating
+        log.warning("Planner stream broke off (%s); using %d streamed prompts", e, len(found))
+        return found
+
+    try:
+        parsed = parse_json_safe(text)
+    except Exception as e:
+        log.warning("Batch parse of streamed planner output failed (%s)", e)
+        parsed = None
+    if isinstance(parsed, dict) and any(str(key).lower().startswith("prompt") for key in parsed):
+        return parsed
+    if found:
+        log.warning("Using %d streamed prompts", len(found))
+        return found
+    log.warning("Streamed planner output had no prompts; falling back to batch planner")
+    return await plan_prompts(image_url_or_dataurl, k)
+
+async def gen_one_image(prompt: str, image_url_or_dataurl) -> str:
     enhanced_text_prompt = f"""ENHANCEMENT IDEA: {prompt}
 
 STRICT:
 - Enhance only scene/lighting/props/composition/angle.
 - Keep product/branding unchanged and readable.
 - Output 9:16 aspect suitable for TikTok."""
-    r = client.responses.create(
-        model="gpt-4.1",
-        input=[{
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": enhanced_text_prompt},
-                to_responses_image_content(image_url_or_dataurl),
-            ],
-        }],
-        tools=[{"type": "image_generation"}],
-    )
+
+    async def attempt():
+        async with upstream_slot():
+            return await limiter.call(lambda: aclient.responses.create(
+                model=GEN_MODEL,
+                input=[{
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": enhanced_text_prompt},
+                        to_responses_image_content(image_url_or_dataurl),
+                    ],
+                }],
+                tools=[{"type": "image_generation"}],
+                timeout=call_timeout(),
+            ), "generation")
+
+    # a duplicate attempt is fired if this one runs into the latency tail (HEDGE_* settings)
+    r = await gen_hedger.run(attempt)
     calls = [o for o in r.output if getattr(o, "type", "") == "image_generation_call"]
     if not calls:
         raise RuntimeError("image_generation_call missing")
     return calls[0].result  # base64 PNG
 
+# --------------------------------------------------------------------------
+# Pipeline: plan -> generate (parallel) -> post-process
+# --------------------------------------------------------------------------
+
+async def gen_and_post_process(prompt: str, image_ref, renditions: list = None, key: str = "image"):
+    """
+    Generate one image and post-process it on the process pool, in the same
+    task, so post-processing of image i overlaps generation of the others.
+    Returns (renditions, post_process_error). key names its timing stages.
+    """
+    with stage(f"generate.{key}"):
+        img_b64 = await gen_one_image(prompt, image_ref)
+    try:
+        # Force 24-bit RGB before returning
+        with stage(f"post_process.{key}"):
+            rendered = await post_process_offloaded(img_b64, renditions)
+    except Exception as conv_err:
+        return None, conv_err
+    if "error" in rendered[0]:
+        # without the primary rendition there is no image to return
+        return None, RuntimeError(rendered[0]["error"])
+    return rendered, None
+
+# How images reach the client and the callback: "inline" (base64 data URLs), "url" (blob store
+# references) or "auto" (blob store above BLOB_INLINE_MAX_BYTES, inline below it or without a store)
+IMAGE_DELIVERY_MODES = ("inline", "url", "auto")
+IMAGE_DELIVERY = os.environ.get("IMPROVE2_IMAGE_DELIVERY", "auto").lower()
+
+async def publish_renditions(rendered: list, delivery: str) -> list:
+    """
+    Write renditions to the blob store (BLOB_STORE) per the delivery mode, replacing their
+    base64 "data" with url/key/sha256. Anything that cannot be stored stays inline.
+    """
+    store = get_blob_store()
+    if not rendered or store is None or delivery == "inline":
+        return rendered
+    out = []
+    for r in rendered:
+        if "error" in r or (delivery == "auto" and r["bytes"] <= BLOB_INLINE_MAX_BYTES):
+            out.append(r)
+            continue
+        try:
+            # content-addressed: a cached result published again is not rewritten
+            ref = await asyncio.to_thread(store.put, base64.b64decode(r["data"]), f"image/{r['format']}")
+        except Exception as e:
+            log.warning(f"Blob store write failed, sending {r['name']} inline: {e}")
+            out.append(r)
+            continue
+        out.append({**{k: v for k, v in r.items() if k != "data"},
+                    "url": ref["url"], "key": ref["key"], "sha256": ref["sha256"]})
+    return out
+
+def _rendition_fields(r: dict) -> dict:
+    if "url" in r:
+        return {"image": r["url"], "key": r["key"], "sha256": r["sha256"]}
+    return {"image": f"data:image/{r['format']};base64,{r['data']}"}
+
+def _rendition_entry(r: dict) -> dict:
+    if "error" in r:
+        return {"error": r["error"], "aspect": r["aspect"], "format": r["format"]}
+    return {**_rendition_fields(r), "aspect": r["aspect"], "width": r["width"], "height": r["height"],
+            "format": r["format"], "bytes": r["bytes"]}
+
+def rendered_item(prompt: str, rendered: list) -> dict:
+    """
+    Response item: the primary rendition as "image", plus "renditions" when extras were asked for.
+    "image" is a data URL, or a blob store URL (with key and sha256) after publish_renditions().
+    An extra rendition that failed to encode is reported as {"error", "aspect", "format"}.
+    """
+    primary = rendered[0]
+    item = {"prompt": prompt, **_rendition_fields(primary), "format": primary["format"], "bytes": primary["bytes"]}
+    if len(rendered) > 1:
+        item["renditions"] = {r["name"]: _rendition_entry(r) for r in rendered}
+    return item
+
+async def run_pipeline_async(url_or_dataurl: str, number_of_images: int, on_event=None, keep_results: bool = True,
+                             use_cache: bool = True, pipelined: bool = None, renditions: list = None,
+                             deadline: Deadline = None, delivery: str = None, timings: Timings = None) -> dict:
+    """
+    Run the full pipeline as coroutines on the engine loop. on_event(event, obj) is
+    called with "plan", "image", "image_failed" and "image_timed_out" as they happen
+    (used by streaming and job modes); it may return an awaitable, which is awaited.
+    With use_cache=False cached plans/images are ignored (fresh results are still stored).
+    With pipelined=True the planner is streamed and each prompt starts generating
+    as soon as it is parsed (default: PIPELINED_PLANNER).
+    The input image goes through prepare_input() once, on first use, and every
+    model call references the result.
+    renditions (see resolve_renditions) are all made from one decode per image.
+    delivery (default IMAGE_DELIVERY) picks inline base64 or blob store URLs per image.
+    deadline (default: REQUEST_DEADLINE from now) caps every upstream call; when it is
+    reached, generations still running are cancelled and reported as timed out, and
+    the images finished so far are returned. DeadlineExceeded if the planner misses it.
+    timings, if given, receives the input, plan, generate.*, post_process.* and publish stages.
+    """
+    deadline = deadline or Deadline()
+    use_deadline(deadline)  # this task and the ones it starts
+    use_timings(timings)
+    digest = image_digest(url_or_dataurl)  # None for URLs until the image is fetched
+    fetched = None
+    if pipelined is None:
+        pipelined = PIPELINED_PLANNER
+    renditions = renditions or [PRIMARY_RENDITION]
+    settings = f"{POST_PROCESS_SETTINGS}|{json.dumps(renditions, sort_keys=True)}"
+
+    results = []
+    timed_out = []
+    counts = {"generated": 0, "failed": 0, "cache_hits": 0, "timed_out": 0}
+
+    async def emit(event, obj):
+        if on_event:
+            r = on_event(event, obj)
+            if inspect.isawaitable(r):
+                await r
+
+    async def done(i, p, rendered):
+        with stage("publish"):
+            item = rendered_item(p, await publish_renditions(rendered, delivery or IMAGE_DELIVERY))
+        counts["generated"] += 1
+        await emit("image", {"index": i, **item})
+        if keep_results:
+            results.append(item)
+
+    async def timeout(i, p):
+        counts["timed_out"] += 1
+        timed_out.append({"index": i, "prompt": p})
+        await emit("image_timed_out", {"index": i, "prompt": p, "error": "deadline_exceeded"})
+
+    ref_task = None
+
+    async def prepare():
+        with stage("input"):
+            return await prepare_input(url_or_dataurl, fetched)
+
+    async def image_ref():
+        # prepared once; concurrent callers share the same task, shielded so that a caller
+        # cancelled by the deadline does not cancel it for the others (and the cleanup)
+        nonlocal ref_task
+        if ref_task is None:
+            ref_task = asyncio.ensure_future(prepare())
+        return await asyncio.shield(ref_task)
+
+    async def gen_task(key, p):
+        # (renditions, post_process_error, from_cache); the disk tier does file I/O, so off the loop
+        if use_cache and digest:
+            hit = await asyncio.to_thread(result_cache.get, cache_key(digest, p, GEN_MODEL, settings))
+            if hit:
+                return json.loads(hit), None, True
+        return (*await gen_and_post_process(p, await image_ref(), renditions, key), False)
+
+    pending = {}  # task -> planner key
+    seen = {}     # planner key -> prompt text
+
+    def submit(key, p):
+        # serve from cache or generate; called once per planner key, also from the streaming planner
+        if key in seen:
+            return
+        seen[key] = p
+        pending[asyncio.ensure_future(gen_task(key, p))] = key
+
+    try:
+        if digest is None:
+            # remote image: key the caches on its bytes, so a new image at the same URL is not
+            # served old results; the input stage reuses the fetch
+            try:
+                with stage("input"):
+                    fetched = await fetch_input(url_or_dataurl)
+                digest = bytes_digest(fetched[0])
+            except Exception as e:
+                log.warning(f"Input image fetch failed, results are not cached for this request: {e}")
+
+        # 1) get prompts (cached too, otherwise a resubmit never gets the same prompts back)
+        plan_key = cache_key(digest, "plan", PLANNER_MODEL, PLANNER_PROMPT, number_of_images)
+        cached_plan = await asyncio.to_thread(result_cache.get, plan_key) if use_cache and digest else None
+        if cached_plan:
+            prompts_json = json.loads(cached_plan)
+            log.info("Planner cache hit")
+        else:
+            async def plan():
+                if pipelined:
+                    return await plan_prompts_streaming(await image_ref(), number_of_images, on_prompt=submit)
+                return await plan_prompts(await image_ref(), number_of_images)
+            try:
+                with stage("plan"):
+                    prompts_json = await asyncio.wait_for(plan(), deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"Planner did not finish within the {deadline.budget:.0f}s request deadline")
+            if digest:
+                await asyncio.to_thread(result_cache.put, plan_key, json.dumps(prompts_json))
+        keys = sorted(
+            [k for k in prompts_json.keys() if k.lower().startswith("prompt")],
+            key=lambda x: int(re.sub(r"[^\d]", "", x) or "9999")
+        )[:number_of_images]
+        prompts = [prompts_json[k] for k in keys]
+        log.info("Planner returned %d prompts (%d already started)", len(prompts), len(pending))
+        await emit("plan", {"prompts": prompts})
+
+        # 2) serve cached images, generate the rest concurrently
+        for k in keys:
+            submit(k, prompts_json[k])  # no-op for keys submitted while the planner streamed
+        index = {k: i for i, k in enumerate(keys)}
+
+        waiting = set(pending)
+        while waiting:
+            finished, waiting = await asyncio.wait(waiting, timeout=deadline.remaining(),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+            if not finished:
+                # deadline reached: give up on what is still running, keep what finished
+                for fut in waiting:
+                    fut.cancel()
+                    k = pending[fut]
+                    if k in index:
+                        await timeout(index[k], seen[k])
+                log.warning("Request deadline (%.0fs) reached; %d image(s) timed out",
+                            deadline.budget, counts["timed_out"])
+                break
+            for fut in finished:
+                k = pending[fut]
+                if k not in index:
+                    fut.exception()  # retrieved, so it is not reported as unhandled
+                    continue
+                i, p = index[k], seen[k]
+                try:
+                    rendered, conv_err, cached = fut.result()
+                    if conv_err is not None:
+                        # reported as a failed image, never as an empty data URL
+                        log.warning(f"Failed to convert image to 24-bit: {conv_err}")
+                        raise RuntimeError(f"post_process_failed: {conv_err}")
+                    if cached:
+                        counts["cache_hits"] += 1
+                    elif digest and not any("error" in r for r in rendered):
+                        # the disk tier does file I/O; keep it off the loop
+                        await asyncio.to_thread(result_cache.put, cache_key(digest, p, GEN_MODEL, settings),
+                                                json.dumps(rendered))
+                    await done(i, p, rendered)
+                except Exception as e:
+                    if isinstance(e, DeadlineExceeded) or deadline.expired:
+                        await timeout(i, p)  # cut short by the deadline, not a failure of its own
+                        continue
+                    counts["failed"] += 1
+                    log.error("Image gen failed for a prompt: %s", e)
+                    await emit("image_failed", {"index": i, "prompt": p, "error": str(e)})
+    except BaseException:
+        for fut in pending:
+            fut.cancel()
+        raise
+    finally:
+        # inputs uploaded by prepare_input() are only needed for this request
+        ref = None
+        if ref_task is not None:
+            if not ref_task.done():
+                # cut short mid-upload (deadline): delete it once it lands, without holding up the response
+                release_input_later(ref_task)
+            elif not ref_task.cancelled() and ref_task.exception() is None:
+                ref = ref_task.result()
+                await release_input(ref)
+
+    upstream = ref.sent_bytes if ref is not None else 0
+    log.info("Upstream image bytes for this request: %d (file upload: %s)", upstream, bool(ref and ref.file_id))
+    return {"prompts": prompts, "generated_images": results, "upstream_image_bytes": upstream,
+            "timed_out_images": timed_out, "partial": bool(timed_out), "elapsed": round(deadline.elapsed(), 3),
+            **counts}
+
+def run_pipeline(url_or_dataurl: str, number_of_images: int, on_event=None, **kwargs) -> dict:
+    """
+    Blocking adapter over run_pipeline_async() for the request threads: the pipeline
+    runs on the shared engine loop while on_event is called here, in the calling
+    thread, so a slow client socket never stalls the loop.
+    """
+    # the pipeline task gets a copy of this thread's context anyway (run_coroutine_threadsafe); the
+    # timings are passed explicitly, like deadline, because jobs start it from the loop with their own
+    kwargs.setdefault("timings", current_timings())
+    if on_event is None:
+        return run_sync(run_pipeline_async(url_or_dataurl, number_of_images, **kwargs))
+    events = queue.Queue()
+    fut = submit_coro(run_pipeline_async(url_or_dataurl, number_of_images,
+                                         on_event=lambda event, obj: events.put((event, obj)), **kwargs))
+    fut.add_done_callback(lambda _: events.put(None))
+    while True:
+        item = events.get()
+        if item is None:
+            break
+        on_event(*item)
+    return fut.result()
+
+# --------------------------------------------------------------------------
+# Callbacks: persisted in the outbox (api/_outbox.py); the first attempt is made before the
+# response, retries happen in the background while the instance lives
+# --------------------------------------------------------------------------
+
+_outbox_worker = None
+
+# A callback's first delivery attempt starts at once; the response waits for it at most this many
+# seconds (0: not at all), so a slow receiver never holds up the response. Waiting a little still
+# settles most callbacks before a serverless instance is frozen (retries may never run there).
+CALLBACK_FIRST_ATTEMPT_WAIT = float(os.environ.get("CALLBACK_FIRST_ATTEMPT_WAIT", "1.5") or "0")
+
+def _callback_headers() -> dict:
+    # read per delivery, so the key is never written to the outbox
+    anon_key = os.environ.get("SUPABASE_ANON_KEY", "")
+    # empty auth headers are skipped: "Bearer " is not a legal header value for httpx
+    return {"Authorization": f"Bearer {anon_key}", "apikey": anon_key} if anon_key else {}
+
+def get_outbox_worker() -> OutboxWorker:
+    """The callback delivery worker; starting it also resumes callbacks left undelivered by earlier runs."""
+    global _outbox_worker
+    if _outbox_worker is None:
+        _outbox_worker = OutboxWorker(Outbox(), headers=_callback_headers)
+        _outbox_worker.start()
+    return _outbox_worker
+
+def _publish_inline(image: str) -> dict:
+    """Blob store fields for an inline data URL image ({} to keep it inline)."""
+    mime, b64 = _strip_data_url(image or "")
+    if not mime:
+        return {}
+    try:
+        ref = get_blob_store().put(_decode_image_b64(b64), mime)
+    except Exception as e:
+        log.warning(f"Blob store write failed, callback image stays inline: {e}")
+        return {}
+    return {"image": ref["url"], "key": ref["key"], "sha256": ref["sha256"]}
+
+def callback_images(images: list) -> list:
+    """
+    Images as they go into the outbox: inline ones are moved to the blob store when there is one,
+    so the stored payload holds references, not megabytes of base64. Without a store they stay
+    inline (and are dropped from the outbox once the callback settles).
+    """
+    if not images or get_blob_store() is None:
+        return images
+    out = []
+    for item in images:
+        item = {**item, **_publish_inline(item.get("image"))}
+        if item.get("renditions"):
+            item["renditions"] = {name: {**r, **_publish_inline(r.get("image"))}
+                                  for name, r in item["renditions"].items()}
+        out.append(item)
+    return out
+
+def enqueue_callback(callback_url: str, payload: dict, label: str = "Callback", product_id: str = "",
+                     wait: bool = None) -> str:
+    """
+    Persist a callback to the Supabase function, start its first delivery attempt and return
+    its id. Unless wait is False, the attempt gets up to CALLBACK_FIRST_ATTEMPT_WAIT seconds to
+    finish before returning; it continues in the background past that, and retries happen there.
+    A newer callback for the same product_id supersedes one that is still undelivered.
+    Must not be called on the engine loop thread.
+    """
+    worker = get_outbox_worker()
+    if payload.get("generated_images"):
+        payload = {**payload, "generated_images": callback_images(payload["generated_images"])}
+    callback_id = worker.outbox.enqueue(callback_url, payload, dedupe_key=product_id or None, label=label)
+    log.info(f"{label} {callback_id} queued for {callback_url}")
+    attempt = submit_coro(worker.deliver_now(callback_id))
+    if wait is not False and CALLBACK_FIRST_ATTEMPT_WAIT > 0:
+        try:
+            attempt.result(CALLBACK_FIRST_ATTEMPT_WAIT)
+        except concurrent.futures.TimeoutError:
+            log.info(f"{label} {callback_id}: first attempt still running, continuing in the background")
+        except Exception as e:
+            log.warning(f"{label} {callback_id}: first attempt did not finish, left to the worker: {e}")
+    worker.notify()
+    return callback_id
+
+def callback_ref(path: str, callback_id: str) -> dict:
+    # "delivered" (or "failed") when the first attempt settled it, "queued" while retries are due
+    status = (get_outbox_worker().outbox.get(callback_id) or {}).get("status", "pending")
+    return {"id": callback_id, "status": "queued" if status in ("pending", "delivering") else status,
+            "status_url": f"{urlparse(path).path}?callback_id={callback_id}"}
+
+# --------------------------------------------------------------------------
+# Job mode: POST ?mode=async -> 202 + job_id, GET ?job_id=... for progress
+# --------------------------------------------------------------------------
+
+# Jobs are coroutines on the engine loop; at most JOB_WORKERS run at once, the rest stay queued
+JOB_WORKERS = int(os.environ.get("IMPROVE2_JOB_WORKERS", "2") or "2")
+
+_job_store = None
+_job_slots = None
+
+def get_job_store() -> JobStore:
+    global _job_store
+    if _job_store is None:
+        _job_store = JobStore()
+    return _job_store
+
+def submit_job(url_or_dataurl: str, number_of_images: int, callback_url: str, passthrough: dict,
+               use_cache: bool = True, renditions: list = None, delivery: str = None) -> str:
+    store = get_job_store()
+    job_id = store.create(number_of_images, meta={"product_id": passthrough.get("product_id", "")})
+    submit_coro(run_job(job_id, url_or_dataurl, number_of_images, callback_url, passthrough, use_cache,
+                        renditions, delivery))
+    return job_id
+
+async def run_job(job_id: str, url_or_dataurl: str, number_of_images: int, callback_url: str, passthrough: dict,
+                  use_cache: bool = True, renditions: list = None, delivery: str = None):
+    global _job_slots
+    if _job_slots is None:
+        _job_slots = asyncio.Semaphore(max(1, JOB_WORKERS))
+    async with _job_slots:
+        await _run_job(job_id, url_or_dataurl, number_of_images, callback_url, passthrough, use_cache, renditions,
+                       delivery)
+
+async def _run_job(job_id, url_or_dataurl, number_of_images, callback_url, passthrough, use_cache, renditions,
+                   delivery):
+    store = get_job_store()
+    timings = Timings("improve2.job")  # the job's own log line; the enqueueing request has its own
+    timings.fields.update(job_id=job_id, number_of_images=number_of_images)
+
+    def on_event(event, obj):
+        # SQLite writes go to a worker thread, off the loop
+        if event == "plan":
+            return asyncio.to_thread(store.set_prompts, job_id, obj["prompts"])
+        elif event == "image":
+            return asyncio.to_thread(store.set_item, job_id, obj["index"], "done", image=obj["image"],
+                                     renditions=obj.get("renditions"))
+        elif event == "image_failed":
+            return asyncio.to_thread(store.set_item, job_id, obj["index"], "failed", error=obj["error"])
+        elif event == "image_timed_out":
+            return asyncio.to_thread(store.set_item, job_id, obj["index"], "timed_out", error=obj["error"])
+
+    try:
+        # the job's clock starts when it leaves the queue
+        out = await run_pipeline_async(url_or_dataurl, number_of_images, on_event=on_event, use_cache=use_cache,
+                                       renditions=renditions, deadline=Deadline(), delivery=delivery,
+                                       timings=timings)
+        await asyncio.to_thread(store.finish, job_id, "succeeded")
+        timings.status = "succeeded"
+        # Completion notification on top of the job store
+        if callback_url and out["generated_images"]:
+            with timings.stage("callback"):
+                await asyncio.to_thread(enqueue_callback, callback_url, {
+                    "job_id": job_id,
+                    "success": True,
+                    "generated_images": out["generated_images"],
+                    "partial": out["partial"],
+                    "timed_out_images": out["timed_out_images"],
+                    **passthrough,
+                }, product_id=passthrough.get("product_id", ""), wait=False)
+    except Exception as e:
+        log.exception("Job %s failed", job_id)
+        timings.status = "failed"
+        await asyncio.to_thread(store.finish, job_id, "failed", error=str(e))
+        if callback_url:
+            await asyncio.to_thread(enqueue_callback, callback_url, {
+                "job_id": job_id,
+                "success": False,
+                "error": str(e),
+                **passthrough,
+            }, label="Error callback", product_id=passthrough.get("product_id", ""), wait=False)
+    finally:
+        timings.log_line()
+
 # --------------------------------------------------------------------------
 # HTTP handler
 # --------------------------------------------------------------------------
@@ -589,24 +1384,80 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self):
+        qs = parse_qs(urlparse(self.path).query)
+        job_id = (qs.get("job_id", [""])[0] or "").strip()
+        if job_id:
+            job = get_job_store().get(job_id)
+            if not job:
+                return send_json(self, 404, {"error": "Unknown job_id"})
+            return send_json(self, 200, job)
+        callback_id = (qs.get("callback_id", [""])[0] or "").strip()
+        if callback_id:
+            cb = get_outbox_worker().outbox.get(callback_id)
+            if not cb:
+                return send_json(self, 404, {"error": "Unknown callback_id"})
+            return send_json(self, 200, cb)
+        product_id = (qs.get("product_id", [""])[0] or "").strip()
+        if product_id:
+            return send_json(self, 200, {"product_id": product_id,
+                                         "callbacks": get_outbox_worker().outbox.find(product_id)})
+
         send_json(self, 200, {
             "ok": True,
             "usage": "POST JSON: { image_url?, image_base64?, number_of_images?, callback_url?, product_id?, auth_token?, user_id?, product_name?, product_price?, product_description?, original_image_path?, generate_caption? }",
-            "hint": "Use image_url (public) for fastest performance."
+            "hint": "Use image_url (public) for fastest performance.",
+            "uploads": "Instead of image_base64 you can POST the raw image (Content-Type: image/*) with parameters in the query string, or multipart/form-data with an 'image' file part and the other fields as form fields.",
+            "streaming": "Add ?stream=ndjson or ?stream=sse (or Accept: text/event-stream) to receive each image as soon as it is ready, followed by a final 'done' record.",
+            "cache": "Identical image + prompt requests are served from cache; send \"cache\": \"bypass\" (or ?cache=bypass) to force fresh generations.",
+            "renditions": "Send \"renditions\": [\"4x5\", \"1x1\", \"thumb\"] (presets) or specs like {\"aspect\": \"4:5\", \"max_edge\": 1350, \"format\": \"webp\", \"quality\": 85} (or ?renditions=4x5,thumb) to get extra crops per image, made from the same decode as the 9:16 image.",
+            "rendition_presets": RENDITION_PRESETS,
+            "encoding": "Images are JPEG by default; send \"output_format\": \"webp\" | \"avif\" | \"jpeg\" | \"png\" | \"auto\" (or ?output_format=...) and optionally \"quality\": 1..100, or an Accept header listing image/avif or image/webp. Each image reports its format and bytes.",
+            "image_delivery": f"\"image_delivery\": \"inline\" | \"url\" | \"auto\" (default {IMAGE_DELIVERY}; blob store: {BLOB_STORE or 'none'}{' - disabled, ' + blob_store_problem() if blob_store_problem() else ''}). url stores each image in the blob store and sends its URL with key, bytes and sha256 instead of base64; auto does so above {BLOB_INLINE_MAX_BYTES} bytes. Responses and callbacks use the same form.",
+            "cache_stats": result_cache.stats(),
+            "http_pool_stats": pool_stats(),
+            "engine_stats": engine_stats(),
+            "rate_limit_stats": limiter.stats(),
+            "hedge_stats": gen_hedger.stats(),
+            "deadline": f"Each request must finish within {REQUEST_DEADLINE:.0f}s (REQUEST_DEADLINE, a margin under the function's maxDuration); send \"deadline\": seconds to ask for less. Images still generating at the deadline are cancelled and listed in timed_out_images, and the finished ones are returned with \"partial\": true.",
+            "jobs": "Add ?mode=async (or \"async\": true) to get 202 + job_id immediately, then poll GET ?job_id=... for progress and results. callback_url, if given, is notified on completion.",
+            "callbacks": f"Callbacks are stored and tried at once; the response waits for that attempt at most {CALLBACK_FIRST_ATTEMPT_WAIT:g}s, then it continues in the background. Failed attempts are retried in the background (exponential backoff, bounded attempts) while this instance lives: on serverless hosts retries are best-effort (at-most-once after the first attempt). A newer callback for the same product_id replaces an undelivered one. auth_token is never written to disk; a callback with one that is left to another process (after a restart) is failed rather than sent without it. With a blob store callback images are sent as URLs. The response carries callback.id and status; poll GET ?callback_id=... or ?product_id=... for delivery status.",
+            # an overview GET does not start the delivery worker or open the outbox
+            "callback_stats": _outbox_worker.stats() if _outbox_worker is not None else {"worker": "not started"},
+            "timings": "Every POST answers with a Server-Timing header (read, decode, input, plan, generate.<prompt>, post_process.<prompt>, publish, callback, serialize) and logs one JSON line with the same stages; send \"timings\": true (or ?timings=1) to also get them as a \"timings\" object in the response (the final record when streaming). Streamed responses send the header before the pipeline runs; async jobs log their own line."
         })
 
+    @timed_request("improve2")
     def do_POST(self):
+        deadline = Deadline()  # the request's clock starts before the body is read
         err = _check_key()
         if err:
             return send_json(self, 500, {"error": err})
 
-        # Read body (supports chunked)
-        raw = (_read_body(self) or b"").strip()
+        # Read body (supports chunked; capped at MAX_BODY_BYTES while reading)
+        try:
+            body = read_body(self)
+        except BodyTooLarge as e:
+            self.close_connection = True
+            return send_json(self, 413, {"error": str(e)})
+        except ValueError as e:
+            self.close_connection = True
+            return send_json(self, 400, {"error": str(e)})
+        raw = body.strip()
+        lap("read")
+        ctype_raw = self.headers.get("content-type", "") or ""
+        main_type = ctype_raw.split(";", 1)[0].strip().lower()
+
+        image_bytes = None
         try:
-            data = json.loads(raw.decode("utf-8", "ignore") or "{}")
+            upload = parse_upload(main_type, ctype_raw, body, self.path)
+            if upload is not None:
+                # Binary upload (raw image/* or multipart): no base64 round trip
+                data, image_bytes = upload
+            else:
+                data = json.loads(raw.decode("utf-8", "ignore") or "{}")
         except Exception:
-            log.error(f"Invalid JSON body; headers={dict(self.headers)}, first200={raw[:200]!r}")
-            return send_json(self, 400, {"error": "Invalid JSON body"})
+            log.error(f"Invalid request body; headers={dict(self.headers)}, first200={raw[:200]!r}")
+            return send_json(self, 400, {"error": "Invalid request body (send JSON, multipart/form-data or a raw image/* body)"})
 
         image_url        = (data.get("image_url") or "").strip()
         image_base64_in  = (data.get("image_base64") or "").strip()
@@ -623,6 +1474,9 @@ class handler(BaseHTTPRequestHandler):
         
         # 🎯 CAPTION GENERATION FLAG - NEW ADDITION
         generate_caption      = data.get("generate_caption", True)  # Default to True for backward compatibility
+        if isinstance(generate_caption, str):
+            # query string / form fields arrive as text
+            generate_caption = generate_caption.strip().lower() not in ("0", "false", "no", "off")
         
         # Log the caption generation setting for debugging
         log.info(f"🎯 Caption generation setting received: {generate_caption} for product: {product_id}")
@@ -634,11 +1488,22 @@ class handler(BaseHTTPRequestHandler):
         if number_of_images < 1 or number_of_images > 6:
             return send_json(self, 400, {"error": "number_of_images must be 1..6"})
 
-        if not image_url and not image_base64_in:
-            return send_json(self, 400, {"error": "Provide image_url or image_base64"})
+        if not image_url and not image_base64_in and not image_bytes:
+            return send_json(self, 400, {"error": "Provide image_url, image_base64 or an image upload"})
 
         # Build canonical url/dataURL
-        if image_url:
+        if image_bytes:
+            if len(image_bytes) > 6 * 1024 * 1024:
+                return send_json(self, 400, {"error": "Image too large (limit 6MB)"})
+            mime = _detect_mime(image_bytes)
+            if mime == "application/octet-stream":
+                return send_json(self, 400, {"error": "Unrecognized image upload (expected PNG, JPEG or WEBP)"})
+            # downscale / re-encode before any model call
+            image_bytes, norm_mime = normalize_input_logged(image_bytes, "upload")
+            mime = norm_mime or mime
+            # single encode, only because the model input is a data URL
+            url_or_dataurl = f"data:{mime};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+        elif image_url:
             url_or_dataurl = image_url
         else:
             mime, base64_image = _strip_data_url(image_base64_in)
@@ -652,109 +1517,136 @@ class handler(BaseHTTPRequestHandler):
                 return send_json(self, 400, {"error": "Image too large (limit 6MB)"})
             if not mime or mime == "application/octet-stream":
                 mime = _detect_mime(buf) or "image/jpeg"
+            # downscale / re-encode before any model call
+            norm_buf, norm_mime = normalize_input_logged(buf, "image_base64")
+            if norm_mime and norm_buf is not buf:
+                mime, base64_image = norm_mime, base64.b64encode(norm_buf).decode("ascii")
             url_or_dataurl = f"data:{mime};base64,{base64_image}"
 
+        passthrough = {
+            "user_id": user_id,
+            "product_name": product_name,
+            "product_price": product_price,
+            "product_description": product_description,
+            "original_image_path": original_image_path,
+            "auth_token": user_auth_token,
+            # 🎯 PASS THROUGH THE CAPTION GENERATION FLAG
+            "generate_caption": generate_caption,
+        }
+
+        qs = query_params(self.path)
+        use_cache = str(data.get("cache") or qs.get("cache") or "").strip().lower() != "bypass"
+        try:
+            quality = int(data.get("quality") or qs.get("quality") or 0) or None
+            if quality is not None and not 1 <= quality <= 100:
+                raise ValueError("quality must be 1..100")
+            # explicit output_format wins, else Accept (image/avif, image/webp), else JPEG
+            output_format = negotiate_output_format(data.get("output_format") or qs.get("output_format"),
+                                                    self.headers.get("accept"), default="JPEG")
+            renditions = resolve_renditions(data.get("renditions") or qs.get("renditions"), output_format, quality)
+            # a client may ask for less time than REQUEST_DEADLINE, never more
+            deadline = Deadline.parse(data.get("deadline") or qs.get("deadline"), started=deadline.started)
+            delivery = str(data.get("image_delivery") or qs.get("image_delivery") or IMAGE_DELIVERY).strip().lower()
+            if delivery not in IMAGE_DELIVERY_MODES:
+                raise ValueError(f"image_delivery must be one of {list(IMAGE_DELIVERY_MODES)}")
+            if delivery == "url" and get_blob_store() is None:
+                raise ValueError(f"image_delivery=url needs a blob store: {blob_store_problem() or 'BLOB_STORE is not configured'}")
+        except ValueError as e:
+            return send_json(self, 400, {"error": str(e)})
+        encoding = {"format": renditions[0]["format"].lower(), "quality": renditions[0]["quality"]}
+        expose_timings(data.get("timings") or qs.get("timings"))
+        lap("decode")  # parse, decode, normalize and validate
+        annotate(number_of_images=number_of_images, product_id=product_id or None)
+
+        # Job mode: enqueue and return immediately
+        if (qs.get("mode") or "").lower() == "async" or data.get("async") is True:
+            try:
+                job_id = submit_job(url_or_dataurl, number_of_images, callback_url,
+                                    {"product_id": product_id, **passthrough}, use_cache=use_cache,
+                                    renditions=renditions, delivery=delivery)
+            except Exception as e:
+                log.exception("Failed to enqueue job")
+                return send_json(self, 500, {"error": "job_enqueue_failed", "message": str(e)})
+            log.info(f"Enqueued job {job_id} for product {product_id}")
+            return send_json(self, 202, {
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": f"{urlparse(self.path).path}?job_id={job_id}",
+            })
+
+        # Optional streaming mode: headers go out now, records as images complete
+        stream = _stream_mode(self)
+        annotate(stream=stream or None)
+        if stream:
+            start_stream(self, stream)
+
         try:
-            # 1) get prompts
-            prompts_json = plan_prompts(url_or_dataurl, number_of_images)
-            keys = sorted(
-                [k for k in prompts_json.keys() if k.lower().startswith("prompt")],
-                key=lambda x: int(re.sub(r"[^\d]", "", x) or "9999")
+            out = run_pipeline(
+                url_or_dataurl, number_of_images,
+                on_event=(lambda event, obj: send_event(self, stream, event, obj)) if stream else None,
+                # When streaming, images are only retained if the callback needs them
+                keep_results=not stream or bool(callback_url),
+                use_cache=use_cache,
+                renditions=renditions,
+                deadline=deadline,
+                delivery=delivery,
             )
-            prompts = [prompts_json[k] for k in keys][:number_of_images]
-            log.info("Planner returned %d prompts", len(prompts))
-
-            # 2) generate images in parallel
-            results = []
-            max_workers = min(4, max(1, number_of_images))
-            with ThreadPoolExecutor(max_workers=max_workers) as ex:
-                futures = {ex.submit(gen_one_image, p, url_or_dataurl): p for p in prompts}
-                for fut in as_completed(futures):
-                    p = futures[fut]
-                    try:
-                        img_b64 = fut.result()
-                        try:
-                            # Force 24-bit RGB before returning
-                            img_b64_rgb = image_post_process(img_b64)
-                        except Exception as conv_err:
-                            log.warning(f"Failed to convert image to 24-bit: {conv_err}")
-                            img_b64_rgb = None
-
-                        results.append({"prompt": p, "image": f"data:image/jpeg;base64,{img_b64_rgb}"})
-                    except Exception as e:
-                        log.error("Image gen failed for a prompt: %s", e)
-
-            # 3) callback with results (if provided)
-            if callback_url and results:
-                try:
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {os.environ.get('SUPABASE_ANON_KEY', '')}",
-                        "apikey": os.environ.get("SUPABASE_ANON_KEY", ""),
-                    }
-                    payload = {
-                        "product_id": product_id,
-                        "success": True,
-                        "generated_images": results,
-                        # pass-through fields
-                        "user_id": user_id,
-                        "product_name": product_name,
-                        "product_price": product_price,
-                        "product_description": product_description,
-                        "original_image_path": original_image_path,
-                        "auth_token": user_auth_token,
-                        # 🎯 PASS THROUGH THE CAPTION GENERATION FLAG
-                        "generate_caption": generate_caption,
-                    }
-                    
-                    # Log what we're sending in the callback for debugging
-                    log.info(f"📞 Sending callback to {callback_url} with generate_caption: {generate_caption}")
-                    
-                    req = urllib.request.Request(
-                        callback_url,
-                        data=json.dumps(payload).encode("utf-8"),
-                        headers=headers,
-                    )
-                    with urllib.request.urlopen(req, timeout=30) as resp:
-                        body = resp.read().decode("utf-8", "ignore")
-                        log.info(f"Callback -> {callback_url} status={resp.status} body={body[:500]}")
-                except Exception as e:
-                    log.error(f"Callback failed: {e}")
+            results = out["generated_images"]
+            lap("pipeline")
 
-            return send_json(self, 200, {"success": True, "generated_images": results})
+            # 3) callback with results (if provided); first attempt before responding, retries in the background
+            callback = None
+            if callback_url and results:
+                # Log what we're sending in the callback for debugging
+                log.info(f"📞 Sending callback to {callback_url} with generate_caption: {generate_caption}")
+                callback_id = enqueue_callback(callback_url, {
+                    "product_id": product_id,
+                    "success": True,
+                    "generated_images": results,
+                    # images cut off by the request deadline, if any
+                    "partial": out["partial"],
+                    "timed_out_images": out["timed_out_images"],
+                    # pass-through fields
+                    **passthrough,
+                }, product_id=product_id)
+                callback = callback_ref(self.path, callback_id)
+                lap("callback")
+
+            if stream:
+                send_event(self, stream, "done", with_timings({
+                    "success": True, "generated": out["generated"], "failed": out["failed"],
+                    "cache_hits": out["cache_hits"], "encoding": encoding,
+                    "timed_out": out["timed_out"], "partial": out["partial"],
+                    "callback": callback,
+                    "upstream_image_bytes": out["upstream_image_bytes"]}))
+                return
+            return send_json(self, 200, {"success": True, "generated_images": results, "encoding": encoding,
+                                         "output_bytes": sum(r.get("bytes", 0) for r in results),
+                                         "partial": out["partial"], "timed_out_images": out["timed_out_images"],
+                                         "callback": callback,
+                                         "upstream_image_bytes": out["upstream_image_bytes"]})
 
         except Exception as e:
             import traceback
             log.exception("Fast pipeline failed")
-            # Send error callback too (best-effort) with the same pass-through fields
+            # Queue an error callback too, with the same pass-through fields
             if callback_url:
                 try:
-                    req = urllib.request.Request(
-                        callback_url,
-                        data=json.dumps({
-                            "product_id": product_id,
-                            "success": False,
-                            "error": str(e),
-                            "user_id": user_id,
-                            "product_name": product_name,
-                            "product_price": product_price,
-                            "product_description": product_description,
-                            "original_image_path": original_image_path,
-                            "auth_token": user_auth_token,
-                            # 🎯 INCLUDE CAPTION FLAG IN ERROR CALLBACK TOO
-                            "generate_caption": generate_caption,
-                        }).encode("utf-8"),
-                        headers={
-                            "Content-Type": "application/json",
-                            "Authorization": f"Bearer {os.environ.get('SUPABASE_ANON_KEY', '')}",
-                            "apikey": os.environ.get("SUPABASE_ANON_KEY", ""),
-                        }
-                    )
-                    with urllib.request.urlopen(req, timeout=30) as resp:
-                        log.info("Error callback -> %s status=%d", callback_url, resp.status)
-                except Exception as cb_err:
-                    log.error("Error callback failed: %s", cb_err)
-
+                    enqueue_callback(callback_url, {
+                        "product_id": product_id,
+                        "success": False,
+                        "error": str(e),
+                        **passthrough,
+                    }, label="Error callback", product_id=product_id)
+                except Exception:
+                    log.exception("Failed to queue error callback")
+
+            code = "deadline_exceeded" if isinstance(e, DeadlineExceeded) else "pipeline_failed"
+            if stream:
+                send_event(self, stream, "error", {"error": code, "message": str(e)})
+                return
+            if isinstance(e, DeadlineExceeded):
+                return send_json(self, 504, {"error": code, "message": str(e)})
             return send_json(self, 500, {
                 "error": "pipeline_failed",
                 "message": str(e),
@@ -1,20 +1,30 @@
 # route: /api/improve_image
 from http.server import BaseHTTPRequestHandler
 import os, json, base64, logging, sys, io, re
-from cgi import parse_header
-from openai import OpenAI
+
+# Sibling helper modules (api/_*.py are not deployed as routes)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _body import read_body, BodyTooLarge, query_params
+from _http import get_openai_client, LazyClient, pool_stats
+from _ratelimit import limiter
+from _deadline import Deadline, DeadlineExceeded, call_timeout, use_deadline
+from _imaging import negotiate_output_format, reencode_image, output_mime
+from _timing import timed_request, lap, stage, expose_timings, with_timings, send_timing_header
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
 log = logging.getLogger("improve_image")
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Shared, pooled client (keep-alive, HTTP/2 when available), built on first use; see api/_http.py
+client = LazyClient(get_openai_client)
 
 def send_json(self, code, obj):
-    data = json.dumps(obj).encode("utf-8")
+    with stage("serialize"):
+        data = json.dumps(with_timings(obj)).encode("utf-8")
     self.send_response(code)
     self.send_header("content-type", "application/json")
     self.send_header("content-length", str(len(data)))
     self.send_header("Access-Control-Allow-Origin", "*")
+    send_timing_header(self, code)
     self.end_headers()
     self.wfile.write(data)
 
@@ -64,10 +74,16 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         send_json(self, 200, {
             "ok": True,
-            "usage": "POST application/json with: { prompt: string, image_url: string }. Add ?format=json for base64."
+            "usage": "POST application/json with: { prompt: string, image_url: string, output_format?: webp|avif|jpeg|png|auto, quality?: 1..100 }. Add ?format=json for base64. Without output_format the model's PNG is returned as-is unless the Accept header lists image/avif or image/webp.",
+            "http_pool_stats": pool_stats(),
+            "rate_limit_stats": limiter.stats(),
+            "timings": "Every POST answers with a Server-Timing header (read, decode, generate, encode) and logs one JSON line with the same stages; with ?format=json, send \"timings\": true (or ?timings=1) to also get them as a \"timings\" object."
         })
 
+    @timed_request("improve_image")
     def do_POST(self):
+        # one model call; the deadline only has to stop it (and its retries) before maxDuration
+        use_deadline(Deadline())
         # fail fast on key issues
         err = _check_key()
         if err:
@@ -75,17 +91,18 @@ class handler(BaseHTTPRequestHandler):
 
         # --- tolerant body read + parsing -----------------------------------
         ctype_raw = self.headers.get("content-type", "") or ""
-        clen_raw  = self.headers.get("content-length", "") or ""
-        try:
-            clen = int(clen_raw) if clen_raw else 0
-        except Exception:
-            clen = 0
-
-        main_type, _ = parse_header(ctype_raw)
-        main_type = (main_type or "").lower()
+        main_type = ctype_raw.split(";", 1)[0].strip().lower()
 
-        body = self.rfile.read(clen) if clen else b""
+        try:
+            body = read_body(self)
+        except BodyTooLarge as e:
+            self.close_connection = True
+            return send_json(self, 413, {"error": str(e)})
+        except ValueError as e:
+            self.close_connection = True
+            return send_json(self, 400, {"error": str(e)})
         raw = (body or b"").strip()
+        lap("read")
 
         # Accept JSON (with/without charset), or anything that starts with "{"
         is_jsonish = main_type.startswith("application/json") or raw.startswith(b"{")
@@ -116,6 +133,18 @@ class handler(BaseHTTPRequestHandler):
         if not prompt:     return send_json(self, 400, {"error": "Missing 'prompt'"})
         if not image_url:  return send_json(self, 400, {"error": "Missing 'image_url'"})
 
+        # Output encoding: output_format / quality, else Accept; None keeps the model's bytes
+        qs = query_params(self.path)
+        try:
+            quality = int(data.get("quality") or qs.get("quality") or 0) or None
+            if quality is not None and not 1 <= quality <= 100:
+                raise ValueError("quality must be 1..100")
+            output_format = negotiate_output_format(data.get("output_format") or qs.get("output_format"),
+                                                    self.headers.get("accept"), default=None)
+        except ValueError as e:
+            return send_json(self, 400, {"error": str(e)})
+        expose_timings(data.get("timings") or qs.get("timings"))
+        lap("decode")
 
         # 1) Ask the Responses API to run the image_generation tool (force PNG)
         image_b64 = None
@@ -130,11 +159,12 @@ class handler(BaseHTTPRequestHandler):
                     content.append({"type": "input_image", "image_url": u})
 
             # Call Responses API with the image_generation tool (no tool_config)
-            resp = client.responses.create(
+            resp = limiter.call_blocking(lambda: client.responses.create(
                 model="gpt-4.1",
                 input=[{"role": "user", "content": content}],
                 tools=[{"type": "image_generation"}],
-            )
+                timeout=call_timeout(),
+            ), "generation")
 
             # Extract base64 image(s) from the tool output
             out_b64 = None
@@ -165,7 +195,11 @@ class handler(BaseHTTPRequestHandler):
                 raise RuntimeError("no image in Responses output")
 
             image_b64 = out_b64
+            lap("generate")
 
+        except DeadlineExceeded as e:
+            log.warning(f"Request deadline reached: {e}")
+            return send_json(self, 504, {"error": "deadline_exceeded", "message": str(e)})
         except Exception as e:
             import traceback
             log.exception("OpenAI image generation failed")
@@ -190,18 +224,30 @@ class handler(BaseHTTPRequestHandler):
             log.warning("Unrecognized image content. First 16 bytes: %s", head)
             return send_json(self, 500, {"error": "unrecognized image bytes", "head_hex": head})
 
+        # 5) Re-encode only when another encoding (or an explicit quality) was asked for
+        if output_format and (output_mime(output_format) != mime or quality):
+            try:
+                source_bytes = len(out_bytes)
+                out_bytes = reencode_image(out_bytes, output_format, quality)
+                mime = output_mime(output_format)
+                log.info(f"Re-encoded output as {output_format}: {source_bytes} -> {len(out_bytes)} bytes")
+            except Exception as e:
+                log.warning(f"Output re-encode to {output_format} failed, returning {mime}: {e}")
+        lap("encode")
+
         # optional JSON output for debugging
-        from urllib.parse import urlparse, parse_qs
-        qs = parse_qs(urlparse(self.path).query)
-        if (qs.get("format", ["png"])[0] or "png").lower() == "json":
+        if (qs.get("format") or "png").lower() == "json":
             return send_json(self, 200, {
                 "mime": mime,
+                "bytes": len(out_bytes),
                 "image_base64": base64.b64encode(out_bytes).decode("utf-8")
             })
 
         self.send_response(200)
-        self.send_header("content-type", mime)  # may be png/webp/jpeg
+        self.send_header("content-type", mime)  # may be png/webp/jpeg/avif
         self.send_header("content-length", str(len(out_bytes)))
+        self.send_header("vary", "Accept")
         self.send_header("Access-Control-Allow-Origin", "*")
+        send_timing_header(self, 200)
         self.end_headers()
         self.wfile.write(out_bytes)
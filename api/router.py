@@ -0,0 +1,98 @@
+# route: /api/router
+# Optional single entry point for every api/ route. One function means one cold start, and one
+# warm process whose connection pool, engine loop and caches serve all routes. A route's module is
+# imported on its first request, so a request never pays for the imports of routes it does not use.
+#
+# The per-route files keep working on their own. To serve everything through this one instead,
+# add this rewrite to vercel.json by hand (api/router.py already has the slowest route's maxDuration):
+#   "rewrites": [{ "source": "/api/:route(improve2|image_generator|improve_image)", "destination": "/api/router?route=:route" }]
+# The route is taken from ?route= or, failing that, from the last path segment.
+from http.server import BaseHTTPRequestHandler
+import os, sys, json, time, threading, importlib, logging
+from urllib.parse import urlparse, parse_qs
+
+# Sibling modules (routes and api/_*.py helpers)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+log = logging.getLogger("router")
+
+ROUTES = ("improve2", "image_generator", "improve_image", "TEST_Fake_images", "index")
+
+_modules = {}
+_import_ms = {}
+_lock = threading.Lock()
+
+
+def load_route(name: str):
+    """The route's module, imported on first use (its import time is recorded for GET /api/router)."""
+    mod = _modules.get(name)
+    if mod is not None:
+        return mod
+    with _lock:
+        if name not in _modules:
+            started = time.perf_counter()
+            _modules[name] = importlib.import_module(name)
+            _import_ms[name] = round((time.perf_counter() - started) * 1000, 1)
+            log.info(f"Loaded route {name} in {_import_ms[name]} ms")
+        return _modules[name]
+
+
+def resolve_route(path: str):
+    """Route name for a request path ("" for the router itself), or None if unknown."""
+    url = urlparse(path)
+    name = (parse_qs(url.query).get("route", [""])[0] or "").strip("/ ")
+    if not name:
+        name = url.path.rstrip("/").rsplit("/", 1)[-1]
+        if name in ("", "api", "router"):
+            return ""
+    name = name.split("/")[-1].removesuffix(".py")
+    return name if name in ROUTES else None
+
+
+def send_json(self, code, obj):
+    data = json.dumps(obj).encode("utf-8")
+    self.send_response(code)
+    self.send_header("content-type", "application/json")
+    self.send_header("content-length", str(len(data)))
+    self.send_header("Access-Control-Allow-Origin", "*")
+    self.end_headers()
+    self.wfile.write(data)
+
+
+class handler(BaseHTTPRequestHandler):
+    def _dispatch(self, method: str):
+        name = resolve_route(self.path)
+        if name is None:
+            return send_json(self, 404, {"error": "Unknown route", "routes": list(ROUTES)})
+        if name == "":
+            if method == "GET":
+                return send_json(self, 200, {
+                    "routes": list(ROUTES),
+                    "loaded": sorted(_modules),
+                    "import_ms": dict(_import_ms),
+                })
+            return send_json(self, 405, {"error": f"{method} needs a route (?route= or /api/<route>)"})
+        try:
+            mod = load_route(name)
+        except Exception as e:
+            log.exception(f"Could not load route {name}")
+            return send_json(self, 500, {"error": f"Could not load route {name}: {e}"})
+        route_handler = getattr(mod, "handler", None)
+        if route_handler is None or not hasattr(route_handler, f"do_{method}"):
+            return send_json(self, 405, {"error": f"{method} is not supported by {name}"})
+        # serve the request as the route's own handler; restored for the next request on this connection
+        cls = self.__class__
+        self.__class__ = route_handler
+        try:
+            return getattr(self, f"do_{method}")()
+        finally:
+            self.__class__ = cls
+
+    def do_OPTIONS(self):
+        self._dispatch("OPTIONS")
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
@@ -0,0 +1,146 @@
+"""
+Fake callback receiver for load tests: accepts the result callbacks improve2 posts, optionally
+failing a share of them (503, retried by the outbox) after a configurable latency.
+
+    python bench/callback_receiver.py --port 8901 --fail-rate 0.1
+    ... "callback_url": "http://127.0.0.1:8901/callback" ...
+
+GET /stats returns the counts, payload sizes and duplicate deliveries (same Idempotency-Key).
+"""
+import sys, json, time, random, argparse, threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+
+from fake_openai import parse_latency, QuietServer
+
+
+class CallbackReceiver:
+    """Records every delivery; start() serves it on a background thread."""
+
+    def __init__(self, fail_rate: float = 0.0, latency: str = "fixed:0"):
+        self.fail_rate = fail_rate
+        self.latency = parse_latency(latency)
+        self.config = {"fail_rate": fail_rate, "latency": latency}
+        self.status = Counter()
+        self.keys = Counter()
+        self.bytes = []
+        self.product_ids = set()
+        self._cond = threading.Condition()
+        self.server = None
+
+    def record(self, status: int, key: str, size: int, product_id: str):
+        with self._cond:
+            self.status[status] += 1
+            if status < 300:
+                self.keys[key] += 1
+                self.bytes.append(size)
+                if product_id:
+                    self.product_ids.add(product_id)
+            self._cond.notify_all()
+
+    def delivered(self) -> int:
+        with self._cond:
+            return sum(self.keys.values())
+
+    def wait_for(self, n: int, timeout: float) -> bool:
+        """Block until `n` callbacks were accepted (True) or `timeout` seconds passed (False)."""
+        end = time.monotonic() + timeout
+        with self._cond:
+            while sum(self.keys.values()) < n:
+                left = end - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            sizes = sorted(self.bytes)
+            return {
+                "received": sum(self.status.values()),
+                "accepted": len(sizes),
+                "by_status": {str(k): v for k, v in self.status.items()},
+                "duplicates": sum(n - 1 for n in self.keys.values() if n > 1),
+                "products": len(self.product_ids),
+                "payload_bytes_p50": sizes[len(sizes) // 2] if sizes else None,
+                "payload_bytes_max": sizes[-1] if sizes else None,
+            }
+
+    def reset(self):
+        with self._cond:
+            self.status.clear()
+            self.keys.clear()
+            self.bytes.clear()
+            self.product_ids.clear()
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve in the background; returns the callback URL."""
+        handler = type("Handler", (_Handler,), {"receiver": self})
+        self.server = QuietServer((host, port), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}/callback"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    receiver: CallbackReceiver = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, obj: dict):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._send(200, {**self.receiver.stats(), "config": self.receiver.config})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("content-length") or 0))
+        receiver = self.receiver
+        time.sleep(receiver.latency())
+        key = self.headers.get("idempotency-key") or ""
+        if random.random() < receiver.fail_rate:
+            receiver.record(503, key, len(raw), "")
+            return self._send(503, {"error": "unavailable (fake)"})
+        try:
+            product_id = str(json.loads(raw).get("product_id") or "")
+        except (ValueError, AttributeError):
+            receiver.record(400, key, len(raw), "")
+            return self._send(400, {"error": "invalid JSON"})
+        receiver.record(200, key, len(raw), product_id)
+        self._send(200, {"ok": True})
+
+
+def add_arguments(ap: argparse.ArgumentParser):
+    """The receiver's options (shared with bench/e2e.py)."""
+    ap.add_argument("--callback-fail-rate", type=float, default=0.0, help="share of callbacks answered with a 503")
+    ap.add_argument("--callback-latency", default="fixed:0.02")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8901)
+    add_arguments(ap)
+    args = ap.parse_args()
+    receiver = CallbackReceiver(args.callback_fail_rate, args.callback_latency)
+    print(f"Callback receiver at {receiver.start(args.host, args.port)}; Ctrl-C to stop", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        receiver.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+End-to-end throughput benchmark: runs each route (bench/serve.py, one process per route) against
+the offline fake OpenAI server and callback receiver, drives it at a fixed concurrency and
+reports throughput, latency percentiles, peak RSS and upstream call counts.
+
+    python bench/e2e.py                                   # all routes, 40 requests at concurrency 8
+    python bench/e2e.py improve2 --requests 200 --concurrency 32 --rate-limit-rate 0.05
+    python bench/e2e.py --latency-image lognormal:2:0.5 --out bench/results/slow-upstream.json
+
+Results are written as JSON (default bench/results/e2e-<UTC time>.json) so runs can be compared.
+The first request per route is sent before the timed run and reported as first_request_ms.
+"""
+import os, sys, json, time, base64, random, argparse, platform, tempfile, subprocess, threading, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_openai
+import callback_receiver
+from serve import API_DIR
+
+ROUTES = ("improve2", "image_generator", "improve_image")
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def input_png_b64(seed: int, edge: int = 512) -> str:
+    """A distinct input image per request, so result caches never serve the timed run."""
+    import io
+    from PIL import Image
+    rnd = random.Random(seed)
+    img = Image.new("RGB", (edge, edge), tuple(rnd.randrange(256) for _ in range(3)))
+    img.paste(tuple(rnd.randrange(256) for _ in range(3)), (edge // 4, edge // 4, 3 * edge // 4, 3 * edge // 4))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def request_body(route: str, i: int, args, callback_url: str) -> dict:
+    image = input_png_b64(i)
+    if route == "improve2":
+        body = {"image_base64": image, "number_of_images": args.images, "cache": "bypass",
+                "product_id": f"bench-{i}"}
+        if callback_url:
+            body["callback_url"] = callback_url
+        return body
+    if route == "image_generator":
+        return {"image_base64": image, "number_of_images": args.images, "cache": "bypass"}
+    if route == "improve_image":
+        return {"prompt": "Place the product on a marble counter in soft morning light",
+                "image_url": f"data:image/jpeg;base64,{image}"}
+    raise ValueError(f"Unknown route {route!r}")
+
+
+def percentile(sorted_values: list, p: float):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def peak_rss_kb(pid: int) -> int:
+    """VmHWM (peak resident set) of a live process in KiB, or 0 where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def child_pids(pid: int) -> list:
+    pids = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+class RouteServer:
+    """One route served by bench/serve.py in its own process."""
+
+    def __init__(self, route: str, env: dict):
+        self.route = route
+        self.proc = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "serve.py"), route],
+                                     cwd=API_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     text=True)
+        line = self.proc.stdout.readline()
+        if not line.startswith("listening "):
+            self.proc.kill()
+            raise RuntimeError(f"{route} did not start (exit code {self.proc.poll()})")
+        self.url = f"http://127.0.0.1:{int(line.split()[1])}/api/{route}"
+
+    def rss(self) -> dict:
+        workers = [peak_rss_kb(p) for p in child_pids(self.proc.pid)]
+        return {"peak_rss_mb": round(peak_rss_kb(self.proc.pid) / 1024, 1),
+                "worker_processes": len(workers),
+                "workers_peak_rss_mb": round(sum(workers) / 1024, 1)}
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def post(url: str, body: dict, timeout: float) -> tuple:
+    """(status, seconds, ok); ok means a 2xx that is not a JSON body with "success": false."""
+    data = json.dumps(body).encode()
+    req = urllib.request.Request(url, data=data, headers={"content-type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            status, ctype, raw = resp.status, resp.headers.get("content-type", ""), resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, time.perf_counter() - started, False
+    except OSError:
+        return None, time.perf_counter() - started, False
+    elapsed = time.perf_counter() - started
+    ok = 200 <= status < 300
+    if ok and ctype.startswith("application/json"):  # improve_image answers with the image itself
+        try:
+            ok = json.loads(raw).get("success", True) is not False
+        except ValueError:
+            ok = False
+    return status, elapsed, ok
+
+
+def run_route(route: str, args, env: dict, fake, receiver, callback_url: str) -> dict:
+    server = RouteServer(route, env)
+    try:
+        expect_callbacks = route == "improve2" and bool(callback_url)
+        first_status, first_s, _ = post(server.url, request_body(route, -1, args, callback_url), args.timeout)
+        if expect_callbacks:
+            receiver.wait_for(1, args.callback_wait)
+        fake.reset()
+        receiver.reset()
+
+        results = []
+        lock = threading.Lock()
+
+        def one(i):
+            r = post(server.url, request_body(route, i, args, callback_url), args.timeout)
+            with lock:
+                results.append(r)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(one, range(args.requests)))
+        wall = time.perf_counter() - started
+
+        ok = sum(1 for _, _, good in results if good)
+        callbacks = None
+        if expect_callbacks:
+            delivered = receiver.wait_for(ok, args.callback_wait)
+            callbacks = {**receiver.stats(), "all_delivered": delivered,
+                         "drain_s": round(time.perf_counter() - started - wall, 2)}
+        upstream = fake.stats()
+        latencies = sorted(s for _, s, _ in results)
+        statuses = {}
+        for status, _, _ in results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return {
+            "route": route,
+            "requests": len(results),
+            "concurrency": args.concurrency,
+            "ok": ok,
+            "errors": len(results) - ok,
+            "status": statuses,
+            "wall_s": round(wall, 3),
+            "throughput_rps": round(len(results) / wall, 3) if wall else None,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50) * 1000, 1),
+                "p95": round(percentile(latencies, 95) * 1000, 1),
+                "p99": round(percentile(latencies, 99) * 1000, 1),
+                "max": round(latencies[-1] * 1000, 1),
+                "mean": round(sum(latencies) / len(latencies) * 1000, 1),
+            },
+            "first_request_ms": round(first_s * 1000, 1),
+            "first_request_status": first_status,
+            **server.rss(),
+            "upstream": {**upstream, "per_request": round(upstream["total"] / max(1, len(results)), 2)},
+            "callbacks": callbacks,
+        }
+    finally:
+        server.stop()
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("routes", nargs="*", default=list(ROUTES))
+    ap.add_argument("--requests", type=int, default=40, help="timed requests per route")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--images", type=int, default=3, help="number_of_images for improve2 / image_generator")
+    ap.add_argument("--timeout", type=float, default=600, help="client timeout per request (s)")
+    ap.add_argument("--no-callbacks", action="store_true", help="do not send callback_url to improve2")
+    ap.add_argument("--callback-wait", type=float, default=60, help="max seconds to wait for callbacks to drain")
+    ap.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                    help="extra environment for the route servers (e.g. HEDGE_ENABLED=1); repeatable")
+    ap.add_argument("--out", help="JSON results path (default bench/results/e2e-<UTC time>.json)")
+    fake_openai.add_arguments(ap)
+    callback_receiver.add_arguments(ap)
+    args = ap.parse_args()
+
+    fake = fake_openai.from_args(args)
+    base_url = fake.start()
+    receiver = callback_receiver.CallbackReceiver(args.callback_fail_rate, args.callback_latency)
+    callback_url = None if args.no_callbacks else receiver.start()
+
+    state_dir = tempfile.mkdtemp(prefix="bench-e2e-")
+    env = {**os.environ, "OPENAI_BASE_URL": base_url, "OPENAI_API_KEY": "sk-fake",
+           "GEN_CACHE_DIR": os.path.join(state_dir, "cache"),
+           "IMPROVE2_JOB_DB": os.path.join(state_dir, "jobs.sqlite3"),
+           "CALLBACK_OUTBOX_DB": os.path.join(state_dir, "callbacks.sqlite3"),
+           "BLOB_DIR": os.path.join(state_dir, "blobs"),
+           "CALLBACK_RETRY_BASE_DELAY": os.environ.get("CALLBACK_RETRY_BASE_DELAY", "0.5")}
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+
+    results = []
+    for route in args.routes:
+        print(f"{route}: {args.requests} requests at concurrency {args.concurrency}...", file=sys.stderr)
+        r = run_route(route, args, env, fake, receiver, callback_url)
+        results.append(r)
+        lat = r["latency_ms"]
+        print(f"  {r['throughput_rps']} req/s  p50 {lat['p50']} ms  p95 {lat['p95']} ms  p99 {lat['p99']} ms  "
+              f"errors {r['errors']}  peak RSS {r['peak_rss_mb']} MB (+{r['workers_peak_rss_mb']} MB workers)  "
+              f"upstream {r['upstream']['per_request']}/req", file=sys.stderr)
+        if r["callbacks"]:
+            print(f"  callbacks {r['callbacks']['accepted']}/{r['ok']} delivered "
+                  f"({r['callbacks']['duplicates']} duplicates)", file=sys.stderr)
+
+    out = args.out or os.path.join(BENCH_DIR, "results", time.strftime("e2e-%Y%m%d-%H%M%S.json", time.gmtime()))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "git": git_rev(),
+                 "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "args": {k: v for k, v in vars(args).items() if k != "routes"},
+                 "fake_openai": fake.config, "callback_receiver": receiver.config},
+        "results": results,
+    }
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {out}", file=sys.stderr)
+    fake.stop()
+    receiver.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Offline OpenAI-compatible server for load tests: answers the endpoints the api/ routes call
+(chat.completions, responses, files) with canned payloads after a configurable latency, and
+injects 500s and 429s (with Retry-After) at configurable rates.
+
+    python bench/fake_openai.py --port 8900 --latency-image lognormal:1.5:0.4 --rate-limit-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=sk-fake ...
+
+Latency specs: fixed:S, uniform:LO:HI, lognormal:MEDIAN:SIGMA, exp:MEAN (seconds).
+Text calls (planner, description) and image calls (the image_generation tool) have separate specs.
+GET /stats returns call counts by endpoint and status.
+"""
+import io, os, re, sys, json, math, time, base64, random, argparse, threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_latency(spec: str):
+    """A sampler for a latency spec (see the module docstring)."""
+    kind, _, args = (spec or "fixed:0").partition(":")
+    nums = [float(x) for x in args.split(":") if x]
+    if kind == "fixed" and len(nums) == 1:
+        return lambda: nums[0]
+    if kind == "uniform" and len(nums) == 2:
+        return lambda: random.uniform(nums[0], nums[1])
+    if kind == "lognormal" and len(nums) == 2:
+        return lambda: random.lognormvariate(math.log(nums[0]), nums[1])
+    if kind == "exp" and len(nums) == 1:
+        return lambda: random.expovariate(1.0 / nums[0]) if nums[0] > 0 else 0.0
+    raise ValueError(f"Bad latency spec {spec!r} (fixed:S, uniform:LO:HI, lognormal:MEDIAN:SIGMA, exp:MEAN)")
+
+
+def make_png(edge: int, noise: bool = True) -> bytes:
+    """An edge x edge PNG; random noise does not compress, so its size is ~3 * edge^2 bytes."""
+    from PIL import Image
+    if noise:
+        img = Image.frombytes("RGB", (edge, edge), os.urandom(edge * edge * 3))
+    else:
+        img = Image.new("RGB", (edge, edge), (180, 60, 60))
+    buf = io.BytesIO()
+    img.save(buf, "PNG", compress_level=1)
+    return buf.getvalue()
+
+
+class QuietServer(ThreadingHTTPServer):
+    """Threaded server that does not print clients dropping idle keep-alive connections."""
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeOpenAI:
+    """The server's configuration and counters; start() serves it on a background thread."""
+
+    def __init__(self, latency_text: str = "fixed:0.2", latency_image: str = "fixed:0.5", error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 1.0, image_edge: int = 256,
+                 image_noise: bool = True, stream_chunk: int = 16, stream_text: str = None,
+                 stream_abort_after: int = None):
+        self.latency_text = parse_latency(latency_text)
+        self.latency_image = parse_latency(latency_image)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.stream_chunk = stream_chunk
+        # for tests of streaming parsers: answer streamed calls with this text instead (malformed or
+        # truncated output), and/or drop the connection after this many events (a stream that breaks off)
+        self.stream_text = stream_text
+        self.stream_abort_after = stream_abort_after
+        self.image_b64 = base64.b64encode(make_png(image_edge, image_noise)).decode()
+        self.config = {"latency_text": latency_text, "latency_image": latency_image, "error_rate": error_rate,
+                       "rate_limit_rate": rate_limit_rate, "retry_after": retry_after, "image_edge": image_edge,
+                       "image_bytes": len(self.image_b64) * 3 // 4}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.server = None
+
+    def count(self, endpoint: str, status: int):
+        with self._lock:
+            self.calls[f"{endpoint} {status}"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = dict(self.calls)
+        by_endpoint = Counter()
+        for key, n in calls.items():
+            by_endpoint[key.rsplit(" ", 1)[0]] += n
+        return {"calls": calls, "by_endpoint": dict(by_endpoint), "total": sum(calls.values())}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve in the background; returns the base URL (ending in /v1) for OPENAI_BASE_URL."""
+        handler = type("Handler", (_Handler,), {"fake": self})
+        self.server = QuietServer((host, port), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}/v1"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def _request_text(body: dict) -> str:
+    """All text the caller sent (messages / input / instructions), for picking a plausible answer."""
+    out = []
+
+    def walk(v):
+        if isinstance(v, str):
+            out.append(v)
+        elif isinstance(v, list):
+            for x in v:
+                walk(x)
+        elif isinstance(v, dict):
+            for k, x in v.items():
+                if k in ("text", "content", "input", "instructions", "messages"):
+                    walk(x)
+    walk(body)
+    return "\n".join(out)
+
+
+def _answer(body: dict) -> str:
+    """Planner JSON when the prompt asks for promptN keys (with a description if asked), else a description."""
+    text = _request_text(body)
+    if "prompt1" not in text:
+        return "A product photo: a single item centered on a plain background, soft studio lighting."
+    m = re.search(r"exactly\s+(\d+)", text, re.IGNORECASE)
+    k = int(m.group(1)) if m else 3
+    prompts = {f"prompt{i}": f"Scene {i}: the product on a styled set, \"warm\" light, 9:16 framing"
+               for i in range(1, k + 1)}
+    if '"prompts"' in text:
+        return json.dumps({"description": "A product photo on a plain background.", "prompts": prompts})
+    return json.dumps(prompts)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake: FakeOpenAI = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, obj: dict, headers: dict = None):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, events: list, delay: float):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        per_event = delay / max(1, len(events))
+        abort_after = self.fake.stream_abort_after
+        for i, ev in enumerate(events + ["[DONE]"]):
+            if abort_after is not None and i >= abort_after:
+                self.close_connection = True  # no terminating chunk: the client sees a broken stream
+                return
+            time.sleep(per_event)
+            data = f"data: {ev if isinstance(ev, str) else json.dumps(ev)}\n\n".encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _injected_failure(self, endpoint: str) -> bool:
+        fake = self.fake
+        roll = random.random()
+        if roll < fake.rate_limit_rate:
+            fake.count(endpoint, 429)
+            self._send(429, {"error": {"message": "Rate limit reached (fake)", "type": "requests",
+                                       "code": "rate_limit_exceeded"}},
+                       {"retry-after": f"{fake.retry_after:g}"})
+            return True
+        if roll < fake.rate_limit_rate + fake.error_rate:
+            time.sleep(fake.latency_text() / 2)
+            fake.count(endpoint, 500)
+            self._send(500, {"error": {"message": "Internal error (fake)", "type": "server_error"}})
+            return True
+        return False
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            return self._send(200, {**self.fake.stats(), "config": self.fake.config})
+        self._send(404, {"error": {"message": "not found"}})
+
+    def do_DELETE(self):
+        self.fake.count("files.delete", 200)
+        self._send(200, {"id": self.path.rsplit("/", 1)[-1], "object": "file", "deleted": True})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("content-length") or 0))
+        fake = self.fake
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/files"):
+            fake.count("files.create", 200)
+            return self._send(200, {"id": f"file-{random.getrandbits(48):x}", "object": "file", "bytes": len(raw),
+                                    "created_at": int(time.time()), "filename": "input", "purpose": "vision",
+                                    "status": "processed"})
+        body = json.loads(raw or b"{}")
+        if path.endswith("/chat/completions"):
+            endpoint = "chat.completions"
+        elif path.endswith("/responses"):
+            endpoint = "responses.image" if body.get("tools") else "responses"
+        else:
+            fake.count(path, 404)
+            return self._send(404, {"error": {"message": f"Unknown path {path}"}})
+        if self._injected_failure(endpoint):
+            return
+
+        delay = fake.latency_image() if endpoint == "responses.image" else fake.latency_text()
+        fake.count(endpoint, 200)
+        text = fake.stream_text if body.get("stream") and fake.stream_text is not None else _answer(body)
+        chunks = [text[i:i + fake.stream_chunk] for i in range(0, len(text), fake.stream_chunk)]
+        if endpoint == "chat.completions":
+            if body.get("stream"):
+                return self._stream([{"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": "fake",
+                                      "choices": [{"index": 0, "delta": {"content": c}, "finish_reason": None}]}
+                                     for c in chunks], delay)
+            time.sleep(delay)
+            return self._send(200, {"id": "fake", "object": "chat.completion", "created": 0, "model": "fake",
+                                    "choices": [{"index": 0, "finish_reason": "stop",
+                                                 "message": {"role": "assistant", "content": text}}],
+                                    "usage": {"prompt_tokens": len(raw) // 4, "completion_tokens": len(text) // 4,
+                                              "total_tokens": (len(raw) + len(text)) // 4}})
+        if endpoint == "responses" and body.get("stream"):
+            return self._stream([{"type": "response.output_text.delta", "delta": c, "item_id": "msg",
+                                  "output_index": 0, "content_index": 0, "sequence_number": i, "logprobs": []}
+                                 for i, c in enumerate(chunks)], delay)
+        time.sleep(delay)
+        if endpoint == "responses.image":
+            output = [{"type": "image_generation_call", "id": "ig", "status": "completed", "result": fake.image_b64}]
+        else:
+            output = [{"type": "message", "id": "msg", "role": "assistant", "status": "completed",
+                       "content": [{"type": "output_text", "text": text, "annotations": []}]}]
+        self._send(200, {"id": "fake", "object": "response", "created_at": int(time.time()), "model": "fake",
+                         "status": "completed", "output": output, "parallel_tool_calls": True,
+                         "tool_choice": "auto", "tools": []})
+
+
+def add_arguments(ap: argparse.ArgumentParser):
+    """The fake server's options (shared with bench/e2e.py)."""
+    ap.add_argument("--latency-text", default="lognormal:0.3:0.3", help="planner / description calls")
+    ap.add_argument("--latency-image", default="lognormal:1.0:0.35", help="image_generation calls")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with a 500")
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of calls answered with a 429")
+    ap.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds on injected 429s")
+    ap.add_argument("--image-edge", type=int, default=256, help="generated image size in px (noise, ~3*edge^2 bytes)")
+
+
+def from_args(args) -> FakeOpenAI:
+    return FakeOpenAI(latency_text=args.latency_text, latency_image=args.latency_image, error_rate=args.error_rate,
+                      rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, image_edge=args.image_edge)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8900)
+    add_arguments(ap)
+    args = ap.parse_args()
+    fake = from_args(args)
+    url = fake.start(args.host, args.port)
+    print(f"Fake OpenAI at {url} ({fake.config['image_bytes']} byte images); Ctrl-C to stop", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
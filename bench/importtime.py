@@ -0,0 +1,77 @@
+"""
+Cold-import cost of the api/ routes.
+
+Runs `python -X importtime -c "import <route>"` in a fresh interpreter per route (the cost a
+serverless cold start pays before the first request is handled) and prints the total, the
+route's direct imports by cumulative time, and the modules with the most self time.
+
+    python bench/importtime.py                      # all routes
+    python bench/importtime.py improve2 --top 20
+    python bench/importtime.py --runs 5 --json importtime.json
+"""
+import os, sys, json, argparse, statistics, subprocess
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+ROUTES = ("improve2", "image_generator", "improve_image", "router")
+
+
+def measure(module: str) -> list:
+    """[(self_us, cumulative_us, depth, name)] for one cold `import module`."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [API_DIR, os.environ.get("PYTHONPATH")]))}
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=API_DIR, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((int(self_us), int(cum_us), depth, name.strip()))
+    return rows
+
+
+def report(module: str, runs: int, top: int) -> dict:
+    samples = [measure(module) for _ in range(runs)]
+    totals = [next(cum for _, cum, depth, name in rows if name == module and depth == 0) for rows in samples]
+    rows = samples[totals.index(sorted(totals)[len(totals) // 2])]  # the median run's breakdown
+    # direct imports of the route sit one level below it; they are listed before it
+    direct = sorted(((cum, name) for _, cum, depth, name in rows if depth == 1), reverse=True)[:top]
+    by_self = sorted(((s, name) for s, _, _, name in rows), reverse=True)[:top]
+    return {
+        "module": module,
+        "total_ms": round(statistics.median(totals) / 1000, 1),
+        "runs_ms": [round(t / 1000, 1) for t in totals],
+        "modules_imported": len(rows),
+        "direct_imports_ms": {name: round(cum / 1000, 1) for cum, name in direct},
+        "self_time_ms": {name: round(s / 1000, 1) for s, name in by_self},
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("routes", nargs="*", default=list(ROUTES))
+    ap.add_argument("--runs", type=int, default=3, help="fresh interpreters per route (median is reported)")
+    ap.add_argument("--top", type=int, default=10)
+    ap.add_argument("--json", help="also write the results to this file")
+    args = ap.parse_args()
+
+    results = []
+    for route in args.routes:
+        r = report(route, max(1, args.runs), args.top)
+        results.append(r)
+        print(f"\n{route}: {r['total_ms']} ms cold import ({r['modules_imported']} modules, runs {r['runs_ms']})")
+        print("  direct imports (cumulative ms):")
+        for name, ms in r["direct_imports_ms"].items():
+            print(f"    {ms:9.1f}  {name}")
+        print("  most self time (ms):")
+        for name, ms in r["self_time_ms"].items():
+            print(f"    {ms:9.1f}  {name}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
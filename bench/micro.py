@@ -0,0 +1,304 @@
+"""
+Micro-benchmarks for the per-request helpers of the api/ routes, on synthetic inputs:
+PNG / JPEG / WebP images from 512 to 4096 px (RGB and RGBA), planner outputs with and without
+code fences, and multi-megabyte base64 response bodies.
+
+For every helper and input it reports the time per call (median and best of N), the Python
+allocations made by one call (tracemalloc: peak and retained bytes including the result, retained
+blocks) and the process peak-RSS growth over that call, which also sees Pillow's native buffers
+but not memory the process already holds from earlier calls (Linux only).
+
+    python bench/micro.py --save-baseline                   # record bench/results/micro-baseline.json
+    python bench/micro.py                                   # everything, compared to that baseline
+    python bench/micro.py --sizes 512,1024 --only post_process
+    python bench/micro.py --fail-on-regression --threshold 1.25
+
+Baselines are machine-specific, so none is committed: record one on the machine you compare on,
+e.g. on the base commit before a change. bench/results/ is git-ignored. A full run takes several
+minutes, most of it image_post_process on 4096 px inputs.
+"""
+import os, io, sys, json, time, base64, argparse, platform, tempfile, statistics, tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(os.path.dirname(BENCH_DIR), "api")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "results", "micro-baseline.json")
+
+SIZES = (512, 1024, 2048, 4096)
+FORMATS = ("PNG", "JPEG", "WEBP")
+
+# below these, differences against the baseline are timer / allocator noise
+TIME_FLOOR_MS = 0.05
+ALLOC_FLOOR_KB = 64
+
+
+def load_routes():
+    """(image_generator, improve2) modules, with caches pointed at a scratch directory."""
+    scratch = tempfile.mkdtemp(prefix="bench-micro-")
+    os.environ.setdefault("GEN_CACHE_DIR", os.path.join(scratch, "cache"))
+    os.environ.setdefault("IMPROVE2_JOB_DB", os.path.join(scratch, "jobs.sqlite3"))
+    os.environ.setdefault("CALLBACK_OUTBOX_DB", os.path.join(scratch, "callbacks.sqlite3"))
+    sys.path.insert(0, API_DIR)
+    import logging
+    import image_generator, improve2
+    logging.disable(logging.INFO)  # the helpers log every call
+    return image_generator, improve2
+
+
+# --------------------------------------------------------------------------
+# Synthetic inputs
+# --------------------------------------------------------------------------
+
+def synthetic_image(edge: int, mode: str):
+    """Gradients plus sensor-like noise: compresses roughly like a product photo, unlike flat fills or pure noise."""
+    from PIL import Image
+    size = (edge, edge)
+    r = Image.linear_gradient("L").resize(size)
+    g = Image.radial_gradient("L").resize(size)
+    b = Image.effect_noise(size, 48)
+    bands = [r, g, b]
+    if mode == "RGBA":
+        bands.append(Image.radial_gradient("L").resize(size).point(lambda v: 255 - v))
+    return Image.merge(mode, bands)
+
+
+def encode(img, fmt: str) -> bytes:
+    buf = io.BytesIO()
+    if fmt == "JPEG":
+        img.save(buf, "JPEG", quality=90)
+    elif fmt == "WEBP":
+        img.save(buf, "WEBP", quality=90)
+    else:
+        img.save(buf, "PNG")  # what the image model returns
+    return buf.getvalue()
+
+
+def image_inputs(sizes, formats) -> list:
+    """[(label, raw bytes, base64, data URL)] for every size / format / mode (JPEG has no alpha)."""
+    out = []
+    for edge in sizes:
+        for mode in ("RGB", "RGBA"):
+            img = synthetic_image(edge, mode)
+            for fmt in formats:
+                if fmt == "JPEG" and mode == "RGBA":
+                    continue
+                raw = encode(img, fmt)
+                b64 = base64.b64encode(raw).decode()
+                out.append((f"{fmt.lower()}-{edge}-{mode.lower()}", raw, b64,
+                            f"data:image/{fmt.lower()};base64,{b64}"))
+    return out
+
+
+def planner_outputs() -> list:
+    """[(label, text)]: planner answers as models actually format them."""
+    out = []
+    for k in (3, 6):
+        plan = json.dumps({f"prompt{i}": f"Scene {i}: the product on a {['marble', 'oak', 'linen'][i % 3]} surface, "
+                                         f"soft window light from the left, shallow depth of field, 9:16 framing, "
+                                         f"props kept minimal so the packaging stays the hero"
+                           for i in range(1, k + 1)}, indent=2)
+        out += [
+            (f"plain-k{k}", plan),
+            (f"fenced-json-k{k}", f"```json\n{plan}\n```"),
+            (f"fenced-k{k}", f"```\n{plan}\n```"),
+            (f"preamble-k{k}", f"Here are {k} ideas for the product:\n\n{plan}\n\nLet me know if you want more."),
+        ]
+    return out
+
+
+class NullHandler:
+    """Just enough of BaseHTTPRequestHandler for send_json(); the body goes nowhere."""
+
+    class _Sink:
+        def write(self, data):
+            return len(data)
+
+    def __init__(self):
+        self.wfile = self._Sink()
+
+    def send_response(self, code):
+        pass
+
+    def send_header(self, name, value):
+        pass
+
+    def end_headers(self):
+        pass
+
+
+# --------------------------------------------------------------------------
+# Measurement
+# --------------------------------------------------------------------------
+
+def _rss_reset() -> bool:
+    """Reset this process's peak RSS (VmHWM) so the next reading covers only what follows."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _rss_kb(field: str):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(fn, min_time: float, min_runs: int, max_runs: int) -> dict:
+    fn()  # warm-up: imports, codec init, regex compilation
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() - started < min_time):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    # one more call under tracemalloc (Python-level allocations only; Pillow's image buffers are
+    # native, so VmHWM growth over the same call is recorded too)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    base_current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    base_rss = _rss_kb("VmRSS") if _rss_reset() else None
+    result = fn()
+    hwm = _rss_kb("VmHWM") if base_rss is not None else None
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained_blocks = sum(s.count_diff for s in after.compare_to(before, "filename") if s.count_diff > 0)
+    del result
+    rss_peak_kb = max(0, hwm - base_rss) if hwm is not None else None
+
+    return {
+        "runs": len(times),
+        "median_ms": round(statistics.median(times) * 1000, 3),
+        "min_ms": round(min(times) * 1000, 3),
+        "alloc_peak_kb": round((peak - base_current) / 1024, 1),
+        "alloc_retained_kb": round((current - base_current) / 1024, 1),
+        "alloc_retained_blocks": retained_blocks,
+        "rss_peak_kb": rss_peak_kb,
+    }
+
+
+def cases(image_generator, improve2, sizes, formats) -> list:
+    """[(name, input label, zero-argument callable)] in a stable order."""
+    out = []
+    images = image_inputs(sizes, formats)
+    for label, raw, b64, data_url in images:
+        out += [
+            ("image_generator.image_post_process", label, lambda b64=b64: image_generator.image_post_process(b64)),
+            ("improve2.image_post_process", label, lambda b64=b64: improve2.image_post_process(b64)),
+            ("_strip_data_url", label, lambda u=data_url: improve2._strip_data_url(u)),
+            ("_decode_image_b64", label, lambda b64=b64: improve2._decode_image_b64(b64)),
+            ("image_generator._detect_mime", label, lambda raw=raw: image_generator._detect_mime(raw)),
+            ("improve2._detect_mime", label, lambda raw=raw: improve2._detect_mime(raw)),
+        ]
+    for label, text in planner_outputs():
+        out += [
+            ("image_generator.parse_json_safe", label, lambda t=text: image_generator.parse_json_safe(t)),
+            ("improve2.parse_json_safe", label, lambda t=text: improve2.parse_json_safe(t)),
+        ]
+    # response bodies: three generated images inline, as improve2 returns them
+    sink = NullHandler()
+    for label, raw, b64, data_url in images:
+        if not label.endswith("-rgb"):
+            continue
+        body = {"success": True, "generated_images": [{"key": f"prompt{i}", "prompt": "...", "image": b64,
+                                                       "mime": "image/png", "bytes": len(raw)} for i in range(1, 4)]}
+        out.append(("send_json", f"3x{label}", lambda body=body: improve2.send_json(sink, 200, body)))
+    return out
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """[(key, metric, old, new, ratio)] for every metric that got worse by more than `threshold`x."""
+    worse = []
+    for key, new in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+        for metric in ("median_ms", "alloc_peak_kb"):
+            a, b = old.get(metric), new.get(metric)
+            # ignore noise-level absolute values
+            floor = TIME_FLOOR_MS if metric == "median_ms" else ALLOC_FLOOR_KB
+            if a is None or b is None or max(a, b) < floor:
+                continue
+            ratio = b / a if a else float("inf")
+            if ratio > threshold:
+                worse.append((key, metric, a, b, ratio))
+    return worse
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default=",".join(map(str, SIZES)), help="image edges in px, comma separated")
+    ap.add_argument("--formats", default=",".join(FORMATS), help="input formats, comma separated")
+    ap.add_argument("--only", default="", help="run helpers whose name contains this")
+    ap.add_argument("--min-time", type=float, default=0.5, help="seconds to spend timing each case")
+    ap.add_argument("--min-runs", type=int, default=3)
+    ap.add_argument("--max-runs", type=int, default=1000)
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE)
+    ap.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    ap.add_argument("--threshold", type=float, default=1.2, help="report metrics that grew by more than this factor")
+    ap.add_argument("--fail-on-regression", action="store_true", help="exit 1 when anything regressed")
+    ap.add_argument("--json", help="also write the results to this file")
+    args = ap.parse_args()
+
+    import PIL
+    image_generator, improve2 = load_routes()
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    formats = [f.strip().upper().replace("JPG", "JPEG") for f in args.formats.split(",") if f.strip()]
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("results", {})
+
+    results = {}
+    print(f"{'helper':38} {'input':22} {'median ms':>10} {'min ms':>10} {'alloc peak KB':>14} "
+          f"{'retained KB':>12} {'RSS peak KB':>12} {'vs base':>8}")
+    for name, label, fn in cases(image_generator, improve2, sizes, formats):
+        if args.only and args.only not in name:
+            continue
+        key = f"{name}[{label}]"
+        r = results[key] = measure(fn, args.min_time, args.min_runs, args.max_runs)
+        old = baseline.get(key, {}).get("median_ms")
+        vs = f"{r['median_ms'] / old:.2f}x" if old and max(old, r["median_ms"]) >= TIME_FLOOR_MS else "-"
+        rss = r["rss_peak_kb"] if r["rss_peak_kb"] is not None else "-"
+        print(f"{name:38} {label:22} {r['median_ms']:10.3f} {r['min_ms']:10.3f} {r['alloc_peak_kb']:14.1f} "
+              f"{r['alloc_retained_kb']:12.1f} {rss:>12} {vs:>8}", flush=True)
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "python": platform.python_version(),
+                 "platform": platform.platform(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                 "pillow": PIL.__version__, "sizes": sizes, "formats": formats},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    worse = compare(results, baseline, args.threshold)
+    if not baseline:
+        print(f"\nNo baseline at {args.baseline}; record one with --save-baseline")
+    else:
+        print(f"\n{len(worse)} regression(s) over {args.threshold}x against {args.baseline}")
+        for key, metric, a, b, ratio in worse:
+            print(f"  {key} {metric}: {a} -> {b} ({ratio:.2f}x)")
+    if worse and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
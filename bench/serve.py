@@ -0,0 +1,32 @@
+"""
+Serve one api/ route (or the router) on a local ThreadingHTTPServer, the way the platform runs its
+handler class. Prints "listening <port>" once ready; bench/e2e.py runs one of these per route.
+
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 python bench/serve.py improve2 --port 8000
+"""
+import os, sys, argparse, importlib
+from http.server import ThreadingHTTPServer
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("route", help="module name under api/, e.g. improve2 or router")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=0)
+    args = ap.parse_args()
+
+    sys.path.insert(0, API_DIR)
+    mod = importlib.import_module(args.route)
+    srv = ThreadingHTTPServer((args.host, args.port), mod.handler)
+    srv.daemon_threads = True
+    print(f"listening {srv.server_address[1]}", flush=True)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+# Offline test setup: the api/ modules import each other as top-level modules (as on the platform),
+# and every on-disk state they keep at import time goes to a throwaway directory.
+import os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "api"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))  # fake_openai: the offline OpenAI-compatible server
+
+_state = tempfile.mkdtemp(prefix="api-tests-")
+os.environ.setdefault("GEN_CACHE_DIR", os.path.join(_state, "cache"))
+os.environ.setdefault("IMPROVE2_JOB_DB", os.path.join(_state, "jobs.sqlite3"))
+os.environ.setdefault("CALLBACK_OUTBOX_DB", os.path.join(_state, "callbacks.sqlite3"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
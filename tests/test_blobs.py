@@ -0,0 +1,40 @@
+import io, hashlib
+
+import pytest
+
+import _blobs
+from _blobs import BlobStore, LocalBlobStore
+
+
+def test_blob_store_is_abstract():
+    with pytest.raises(TypeError):
+        BlobStore()
+
+
+def test_local_put_bytes_and_file_object(tmp_path, monkeypatch):
+    monkeypatch.setattr(_blobs, "CHUNK", 1000)
+    monkeypatch.setattr(_blobs, "SPOOL_MAX_MEMORY", 4000)  # the file object spills to disk
+    store = LocalBlobStore(str(tmp_path), "https://cdn.example.com/b/")
+    data = bytes(range(256)) * 40
+
+    ref = store.put(data, "image/jpeg")
+    sha = hashlib.sha256(data).hexdigest()
+    assert ref == {"key": f"results/{sha[:2]}/{sha}.jpg", "url": f"https://cdn.example.com/b/results/{sha[:2]}/{sha}.jpg",
+                   "bytes": len(data), "sha256": sha, "content_type": "image/jpeg"}
+    assert (tmp_path / "results" / sha[:2] / f"{sha}.jpg").read_bytes() == data
+
+    assert store.put(io.BytesIO(data), "image/jpeg") == ref
+    other = store.put(io.BytesIO(b"x" * 5000), "image/webp")
+    assert (tmp_path.joinpath(*other["key"].split("/"))).read_bytes() == b"x" * 5000
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_local_store_needs_a_public_url(tmp_path, monkeypatch):
+    with pytest.raises(RuntimeError):
+        LocalBlobStore(str(tmp_path), "")
+
+    monkeypatch.setattr(_blobs, "BLOB_STORE", "local")
+    monkeypatch.setattr(_blobs, "BLOB_PUBLIC_URL", "")
+    monkeypatch.setattr(_blobs, "_store", None)
+    assert _blobs.get_blob_store() is None
+    assert "BLOB_PUBLIC_URL" in _blobs.blob_store_problem()
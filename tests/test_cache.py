@@ -0,0 +1,26 @@
+import improve2
+import image_generator
+from _cache import shared_result_cache
+
+IMAGE = "AAAA"
+
+
+def test_routes_share_one_result_cache():
+    # under api/router.py both routes run in one process, on the same GEN_CACHE_DIR
+    assert improve2.result_cache is image_generator.result_cache is shared_result_cache()
+
+
+def test_prompts_key_covers_models_version_and_mode(monkeypatch):
+    def key(mode="two_pass"):
+        return image_generator.prompts_cache_key(IMAGE, "a red kettle", mode, 4)
+
+    base, single = key(), key("single_pass")
+    assert base != single
+    monkeypatch.setattr(image_generator, "PROMPTS_MODEL", "another-model")
+    assert key() != base and key("single_pass") != single
+    monkeypatch.undo()
+    monkeypatch.setattr(image_generator, "COMBINED_MODEL", "another-model")
+    assert key() == base and key("single_pass") != single
+    monkeypatch.undo()
+    monkeypatch.setattr(image_generator, "PROMPTS_VERSION", "2")
+    assert key() != base
@@ -0,0 +1,60 @@
+import json, time, base64, asyncio, threading, urllib.request, urllib.error
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import improve2
+import _deadline
+from _deadline import Deadline, DeadlineExceeded
+
+IMAGE = "data:image/png;base64," + base64.b64encode(b"\x89PNG\r\n\x1a\n" + b"\0" * 64).decode()
+
+
+@pytest.fixture
+def slow_upload(monkeypatch):
+    """An aclient whose files.create stalls for `delay` seconds; records deletes."""
+    state = SimpleNamespace(delay=2.0, created=[], deleted=[])
+
+    async def create(file, purpose, timeout=None):
+        await asyncio.sleep(state.delay)
+        state.created.append(file[0])
+        return SimpleNamespace(id="file-slow")
+
+    async def delete(file_id, timeout=None):
+        state.deleted.append(file_id)
+
+    monkeypatch.setattr(improve2, "aclient", SimpleNamespace(files=SimpleNamespace(create=create, delete=delete)))
+    monkeypatch.setattr(improve2, "UPLOAD_ONCE", True)
+    monkeypatch.setattr(_deadline, "MIN_CALL_TIME", 0.1)  # short deadlines still start the upload
+    return state
+
+
+def test_deadline_during_upload_is_a_deadline_error(slow_upload):
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        improve2.run_pipeline(IMAGE, 2, use_cache=False, deadline=Deadline(0.5))
+    assert time.monotonic() - started < 1.5  # the response does not wait for the upload
+
+    # the upload still finishes, and the uploaded input is deleted afterwards
+    for _ in range(200):
+        if slow_upload.deleted:
+            break
+        time.sleep(0.02)
+    assert slow_upload.created and slow_upload.deleted == ["file-slow"]
+
+
+def test_deadline_during_upload_answers_504(slow_upload):
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), improve2.handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    try:
+        body = json.dumps({"image_base64": IMAGE, "number_of_images": 1, "deadline": 0.5, "cache": False}).encode()
+        req = urllib.request.Request(f"http://127.0.0.1:{srv.server_address[1]}/api/improve2", data=body,
+                                     headers={"content-type": "application/json"})
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(req, timeout=10)
+        assert err.value.code == 504
+        assert json.loads(err.value.read())["error"] == "deadline_exceeded"
+    finally:
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,103 @@
+import time, threading
+from types import SimpleNamespace
+
+import pytest
+
+import image_generator
+import _deadline
+from _deadline import Deadline, current_deadline, use_deadline
+from _timing import Timings, use_timings
+
+PROMPTS = {f"prompt{i}": f"scene {i}" for i in range(1, 7)}
+
+
+class FakeClient:
+    """Stands in for the OpenAI client's responses.create: records concurrency and what each call saw."""
+
+    def __init__(self, delay=0.1, slow=()):
+        self.delay, self.slow = delay, set(slow)
+        self.release = threading.Event()  # slow calls stall until the test lets them go
+        self.in_flight = self.peak = 0
+        self.calls = []
+        self._lock = threading.Lock()
+        self.responses = SimpleNamespace(create=self.create)
+
+    def create(self, model, input, tools, timeout=None):
+        prompt = input[0]["content"][0]["text"].split("ENHANCEMENT IDEA: ", 1)[1].split("\n", 1)[0]
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            self.calls.append({"prompt": prompt, "deadline": current_deadline(), "timeout": timeout})
+        try:
+            if prompt in self.slow:
+                self.release.wait(10)
+            else:
+                time.sleep(self.delay)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return SimpleNamespace(output=[SimpleNamespace(type="image_generation_call", result=f"IMG {prompt}")])
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(image_generator, "client", client)
+    yield client
+    client.release.set()
+
+
+@pytest.fixture
+def request_context():
+    """A request's deadline and timings, current in this thread as the handler would set them."""
+    deadline, timings = Deadline(30), Timings("image_generator")
+    use_deadline(deadline)
+    use_timings(timings)
+    yield SimpleNamespace(deadline=deadline, timings=timings)
+    use_timings(None)
+    use_deadline(None)
+
+
+def generate(prompts=PROMPTS, **kwargs):
+    return image_generator.generate_images_from_prompts(prompts, "AAAA", "a jar of honey", len(prompts),
+                                                        use_cache=False, **kwargs)
+
+
+def test_worker_bound_holds(fake_client, monkeypatch):
+    monkeypatch.setattr(image_generator, "GEN_MAX_WORKERS", 2)
+    images, timed_out = generate()
+    assert timed_out == [] and fake_client.peak == 2
+    assert list(images) == list(PROMPTS)  # prompt order, whatever finished first
+    assert images["prompt3"] == "IMG scene 3"
+
+    fake_client.peak = 0
+    generate(max_workers=3)
+    assert fake_client.peak == 3
+
+
+def test_workers_see_the_requests_deadline_and_timings(fake_client, request_context):
+    images, timed_out = generate()
+    assert timed_out == [] and all(images.values())
+    assert {c["deadline"] for c in fake_client.calls} == {request_context.deadline}
+    assert all(0 < c["timeout"] <= 30 for c in fake_client.calls)
+    stages = request_context.timings.as_dict()["stages_ms"]
+    assert {f"generate.{key}" for key in PROMPTS} <= set(stages)
+    assert all(stages[f"generate.{key}"] >= 90 for key in PROMPTS)
+
+
+def test_deadline_mid_wait_returns_partial_results(fake_client, monkeypatch):
+    fake_client.slow = {"scene 2", "scene 5"}
+    monkeypatch.setattr(image_generator, "GEN_MAX_WORKERS", 6)
+    monkeypatch.setattr(_deadline, "MIN_CALL_TIME", 0.1)  # a 1 s deadline still starts the calls
+    use_deadline(Deadline(1.0))
+    try:
+        started = time.monotonic()
+        images, timed_out = generate()
+        elapsed = time.monotonic() - started
+    finally:
+        use_deadline(None)
+    assert elapsed < 2.0  # returned at the deadline, not when the stalled calls give up
+    assert timed_out == ["prompt2", "prompt5"]
+    assert images["prompt2"] is None and images["prompt5"] is None
+    assert [images[k] for k in ("prompt1", "prompt3", "prompt4", "prompt6")] == [
+        "IMG scene 1", "IMG scene 3", "IMG scene 4", "IMG scene 6"]
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import _hedge
+from _hedge import Hedger, RollingLatency
+
+
+@pytest.fixture(autouse=True)
+def quick(monkeypatch):
+    monkeypatch.setattr(_hedge, "HEDGE_MIN_SAMPLES", 5)
+    monkeypatch.setattr(_hedge, "HEDGE_MIN_DELAY", 0.0)
+
+
+def call(*durations):
+    """A make_call whose n-th invocation sleeps durations[n] (the last one repeats) and returns n."""
+    started = []
+
+    async def make_call():
+        n = len(started)
+        started.append(n)
+        await asyncio.sleep(durations[min(n, len(durations) - 1)])
+        return n
+    make_call.started = started
+    return make_call
+
+
+def warm(hedger, seconds=0.01, n=5):
+    for _ in range(n):
+        hedger.latency.add(seconds)
+        hedger.recent.append(0)
+
+
+def test_percentile():
+    lat = RollingLatency(window=100)
+    assert lat.percentile(95) is None
+    for s in range(1, 101):
+        lat.add(float(s))
+    assert lat.percentile(50) == 50 and lat.percentile(95) == 95 and lat.percentile(100) == 100
+    assert lat.percentile(0) == 1
+    for _ in range(100):  # the window slides
+        lat.add(1000.0)
+    assert lat.percentile(50) == 1000 and len(lat) == 100
+
+
+def test_no_hedging_before_enough_history():
+    h = Hedger("t", enabled=True, budget=1.0)
+    assert h.hedge_delay() is None
+    assert asyncio.run(h.run(call(0.05))) == 0
+    assert h.counters["hedges"] == 0 and len(h.latency) == 1
+
+
+def test_hedge_win_records_the_primarys_elapsed_time():
+    h = Hedger("t", enabled=True, budget=1.0)
+    warm(h, 0.05, n=20)
+    make_call = call(5.0, 0.01)  # the primary stalls, the hedge is quick
+    assert asyncio.run(h.run(make_call)) == 1
+    assert h.counters["hedges"] == 1 and h.counters["hedge_wins"] == 1 and h.counters["cancelled"] == 1
+    # censored at the cancel point: the trigger (0.05 s) plus the hedge's run, not the hedge's 0.01 s
+    assert h.latency.samples[-1] >= 0.06
+    assert h.hedge_delay() == pytest.approx(0.05, abs=0.03)
+
+
+def test_repeated_hedge_wins_do_not_pull_the_trigger_down():
+    h = Hedger("t", enabled=True, budget=1.0)
+    warm(h, 0.05, n=20)
+    make_call = call(*[5.0, 0.001] * 40)
+    before = h.hedge_delay()
+
+    async def many():
+        for _ in range(40):
+            await h.run(make_call)
+    asyncio.run(many())
+    assert h.counters["hedge_wins"] == 40
+    assert h.hedge_delay() >= before
+
+
+def test_budget_limits_hedges_to_a_share_of_recent_calls():
+    h = Hedger("t", enabled=True, budget=0.1)
+    warm(h, 0.01, n=5)
+
+    async def many():
+        return await asyncio.gather(*(h.run(call(0.1)) for _ in range(40)))
+    asyncio.run(many())
+    # 45 calls seen in total (5 warm-up), at most 10% of them hedged
+    assert h.counters["hedges"] == 4 and h.counters["budget_denied"] == 36
+    assert h.stats()["recent_hedges"] == 4
+
+
+def test_budget_starts_empty_and_does_not_bank_a_burst():
+    h = Hedger("t", enabled=True, budget=0.1)
+    for _ in range(5):
+        h.latency.add(0.01)
+    assert not h.budget_allows()  # nothing earned yet
+    asyncio.run(h.run(call(0.05)))
+    assert h.counters["hedges"] == 0 and h.counters["budget_denied"] == 1
+
+    for _ in range(_hedge.HEDGE_WINDOW * 5):  # a long quiet stretch
+        h.recent.append(0)
+
+    async def burst():
+        return await asyncio.gather(*(h.run(call(0.1)) for _ in range(50)))
+    asyncio.run(burst())
+    hedges = sum(h.recent)
+    assert hedges == h.counters["hedges"] <= h.budget * _hedge.HEDGE_WINDOW  # the window's share, not more
+    assert hedges <= h.budget * (len(h.recent) - hedges)
+
+
+def test_both_failing_raises_the_primarys_error():
+    h = Hedger("t", enabled=True, budget=1.0)
+    warm(h, 0.01, n=20)
+    errors = [RuntimeError("primary"), RuntimeError("hedge")]
+
+    async def make_call():
+        error = errors.pop(0)
+        await asyncio.sleep(0.1 if error.args == ("primary",) else 0.01)
+        raise error
+
+    with pytest.raises(RuntimeError, match="primary"):
+        asyncio.run(h.run(make_call))
+    assert h.counters["hedges"] == 1 and len(h.latency) == 20
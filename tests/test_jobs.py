@@ -0,0 +1,138 @@
+import json, asyncio, sqlite3, threading, urllib.request, urllib.error
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import improve2
+from _jobs import JobStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    s = JobStore(str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(improve2, "_job_store", s)
+    return s
+
+
+def test_lifecycle_succeeded(store):
+    job_id = store.create(2, meta={"product_id": "p1"})
+    assert store.get(job_id)["status"] == "queued"
+
+    store.set_prompts(job_id, ["a", "b"])
+    job = store.get(job_id)
+    assert job["status"] == "running"
+    assert job["progress"] == {"total": 2, "done": 0, "failed": 0, "timed_out": 0, "pending": 2}
+
+    store.set_item(job_id, 0, "done", image="data:image/jpeg;base64,AAAA", renditions={"thumb": {"bytes": 3}})
+    store.set_item(job_id, 1, "timed_out", error="deadline_exceeded")
+    store.finish(job_id, "succeeded")
+    job = store.get(job_id)
+    assert job["status"] == "succeeded"
+    assert job["progress"] == {"total": 2, "done": 1, "failed": 0, "timed_out": 1, "pending": 0}
+    assert job["generated_images"] == [{"prompt": "a", "image": "data:image/jpeg;base64,AAAA",
+                                        "renditions": {"thumb": {"bytes": 3}}}]
+    assert job["items"][1] == {"index": 1, "prompt": "b", "status": "timed_out", "error": "deadline_exceeded"}
+
+
+def test_lifecycle_failed(store):
+    job_id = store.create(3)
+    store.finish(job_id, "failed", error="planner exploded")
+    job = store.get(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "planner exploded"
+    assert job["generated_images"] == []
+
+
+def test_unknown_job(store):
+    assert store.get("nope") is None
+
+
+def test_renditions_column_migration(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    db = sqlite3.connect(path)
+    with db:  # job_items as created before the renditions column existed
+        db.executescript("""
+            CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, total INTEGER NOT NULL, error TEXT,
+                               meta TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL);
+            CREATE TABLE job_items (job_id TEXT NOT NULL, idx INTEGER NOT NULL, prompt TEXT, status TEXT NOT NULL,
+                                    image TEXT, error TEXT, PRIMARY KEY (job_id, idx));
+            INSERT INTO jobs VALUES ('old', 'succeeded', 1, NULL, '{}', 1.0, 1.0);
+            INSERT INTO job_items VALUES ('old', 0, 'p', 'done', 'data:image/jpeg;base64,AAAA', NULL);
+        """)
+    db.close()
+
+    store = JobStore(path)
+    assert store.get("old")["generated_images"] == [{"prompt": "p", "image": "data:image/jpeg;base64,AAAA"}]
+    JobStore(path)  # migrating twice is harmless
+
+    job_id = store.create(1)
+    store.set_prompts(job_id, ["p"])
+    store.set_item(job_id, 0, "done", image="x", renditions={"1x1": {"bytes": 1}})
+    assert store.get(job_id)["generated_images"][0]["renditions"] == {"1x1": {"bytes": 1}}
+
+
+def _fake_pipeline(fail=None):
+    async def run_pipeline_async(url_or_dataurl, number_of_images, on_event=None, **kwargs):
+        await on_event("plan", {"prompts": [f"prompt {i}" for i in range(number_of_images)]})
+        if fail:
+            raise RuntimeError(fail)
+        for i in range(number_of_images):
+            await on_event("image", {"index": i, "image": f"data:image/jpeg;base64,{i}"})
+        return {"generated_images": [], "partial": False, "timed_out_images": []}
+    return run_pipeline_async
+
+
+@pytest.mark.parametrize("fail", [None, "upstream down"])
+def test_submit_job_runs_to_completion(store, monkeypatch, fail):
+    monkeypatch.setattr(improve2, "run_pipeline_async", _fake_pipeline(fail))
+    job_id = improve2.submit_job("data:image/jpeg;base64,AAAA", 2, "", {"product_id": "p1"})
+    improve2.run_sync(_wait_done(store, job_id))
+    job = store.get(job_id)
+    if fail:
+        assert (job["status"], job["error"]) == ("failed", fail)
+        assert job["progress"]["pending"] == 2
+    else:
+        assert job["status"] == "succeeded"
+        assert [g["image"] for g in job["generated_images"]] == ["data:image/jpeg;base64,0",
+                                                                 "data:image/jpeg;base64,1"]
+
+
+async def _wait_done(store, job_id, timeout=10.0):
+    for _ in range(int(timeout / 0.02)):
+        if store.get(job_id)["status"] in ("succeeded", "failed"):
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), improve2.handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}/api/improve2"
+    srv.shutdown()
+    srv.server_close()
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_get_job(store, server):
+    job_id = store.create(1)
+    store.set_prompts(job_id, ["p"])
+    store.set_item(job_id, 0, "done", image="data:image/jpeg;base64,AAAA")
+    store.finish(job_id, "succeeded")
+
+    status, body = _get(f"{server}?job_id={job_id}")
+    assert status == 200
+    assert body["status"] == "succeeded"
+    assert body["generated_images"] == [{"prompt": "p", "image": "data:image/jpeg;base64,AAAA"}]
+
+
+def test_get_unknown_job(store, server):
+    assert _get(f"{server}?job_id=missing") == (404, {"error": "Unknown job_id"})
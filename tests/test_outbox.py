@@ -0,0 +1,186 @@
+import json, time, asyncio, sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import _outbox
+import improve2
+from _outbox import Outbox, OutboxWorker, SECRETS_LOST
+
+
+class FakeReceiver:
+    """Stands in for apost_json: answers `statuses` in turn (then 200), after `delay` seconds."""
+
+    def __init__(self, statuses=(), delay=0.0):
+        self.statuses, self.delay, self.calls = list(statuses), delay, []
+
+    async def __call__(self, url, payload, headers=None, timeout=30):
+        await asyncio.sleep(self.delay)
+        self.calls.append({"url": url, "payload": payload, "headers": headers})
+        status = self.statuses.pop(0) if self.statuses else 200
+        if isinstance(status, Exception):
+            raise status
+        return status, "ok"
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(str(tmp_path / "callbacks.sqlite3"))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The outbox's time.time, moved by hand."""
+    c = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(_outbox, "time", SimpleNamespace(time=lambda: c.now, monotonic=time.monotonic))
+    return c
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    r = FakeReceiver()
+    monkeypatch.setattr(_outbox, "apost_json", r)
+    return r
+
+
+def _stored(outbox, callback_id):
+    db = sqlite3.connect(outbox.path)
+    try:
+        return db.execute("SELECT status, payload, last_error FROM callbacks WHERE id = ?", (callback_id,)).fetchone()
+    finally:
+        db.close()
+
+
+def test_lost_secret_fails_the_callback_instead_of_sending_it(outbox):
+    with_token = outbox.enqueue("http://cb", {"product_id": "p1", "auth_token": "SECRET"})
+    without = outbox.enqueue("http://cb", {"product_id": "p2"})
+    assert "SECRET" not in _stored(outbox, with_token)[1]
+
+    restarted = Outbox(outbox.path)  # the token went away with the first process
+    claimed = restarted.claim(10)
+    assert [cb["id"] for cb in claimed] == [without]
+    assert restarted.get(with_token)["status"] == "failed"
+    assert restarted.get(with_token)["last_error"] == SECRETS_LOST
+
+    # the process that queued it still sends the token
+    again = outbox.enqueue("http://cb", {"product_id": "p3", "auth_token": "SECRET"})
+    assert outbox.claim(1, again)[0]["payload"]["auth_token"] == "SECRET"
+
+
+def test_outbox_created_before_secret_fields_is_migrated(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    db = sqlite3.connect(path)
+    db.executescript(_outbox._SCHEMA.replace(",\n    secret_fields   TEXT", ""))
+    db.close()
+    box = Outbox(path)
+    callback_id = box.enqueue("http://cb", {"auth_token": "t"})
+    assert box.claim(1, callback_id)[0]["payload"] == {"auth_token": "t"}
+    Outbox(path)  # migrating twice is harmless
+
+
+@pytest.mark.parametrize("wait", [None, False])
+def test_enqueue_callback_does_not_wait_for_a_slow_receiver(outbox, receiver, monkeypatch, wait):
+    receiver.delay = 1.5
+    worker = OutboxWorker(outbox)
+    monkeypatch.setattr(worker, "start", lambda: None)  # first attempts only, no background scans
+    monkeypatch.setattr(improve2, "_outbox_worker", worker)
+    monkeypatch.setattr(improve2, "CALLBACK_FIRST_ATTEMPT_WAIT", 0.2)
+
+    started = time.monotonic()
+    callback_id = improve2.enqueue_callback("http://cb", {"product_id": "p1"}, wait=wait)
+    assert time.monotonic() - started < 0.6
+    assert outbox.get(callback_id)["status"] in ("pending", "delivering")
+
+    for _ in range(150):  # the attempt carries on in the background
+        if outbox.get(callback_id)["status"] == "delivered":
+            break
+        time.sleep(0.02)
+    assert outbox.get(callback_id)["status"] == "delivered"
+    assert json.loads(_stored(outbox, callback_id)[1]) == {}
+
+
+def deliver(worker, cb):
+    asyncio.run(worker._deliver(cb))
+
+
+def test_expired_lease_is_reclaimed(outbox, clock):
+    callback_id = outbox.enqueue("http://cb", {"product_id": "p1"})
+    assert [cb["attempts"] for cb in outbox.claim(10)] == [1]
+    assert outbox.claim(10) == []  # leased to the first claimer
+
+    clock.now += _outbox.LEASE - 1
+    assert outbox.claim(10) == []
+    clock.now += 2  # that process died mid-delivery
+    other = Outbox(outbox.path)
+    assert [(cb["id"], cb["attempts"]) for cb in other.claim(10)] == [(callback_id, 2)]
+
+    outbox.delivered(callback_id, 200)  # a late answer from the first attempt still settles it
+    assert outbox.get(callback_id)["status"] == "delivered"
+    clock.now += _outbox.LEASE + 1
+    assert other.claim(10) == []
+
+
+def test_newer_callback_for_a_product_supersedes_undelivered_ones(outbox):
+    pending = outbox.enqueue("http://cb", {"v": 1}, dedupe_key="p1")
+    delivering = outbox.enqueue("http://cb", {"v": 2}, dedupe_key="p1")
+    outbox.claim(1, delivering)
+    other_product = outbox.enqueue("http://cb", {"v": 1}, dedupe_key="p2")
+    latest = outbox.enqueue("http://cb", {"v": 3, "auth_token": "t"}, dedupe_key="p1")
+
+    assert outbox.get(pending)["status"] == outbox.get(delivering)["status"] == "superseded"
+    assert _stored(outbox, pending)[1] == "{}"
+    assert [cb["id"] for cb in outbox.find("p1")][0] == latest
+    assert {cb["id"] for cb in outbox.claim(10)} == {other_product, latest}
+
+    outbox.delivered(latest, 200)
+    again = outbox.enqueue("http://cb", {"v": 4}, dedupe_key="p1")
+    assert outbox.get(latest)["status"] == "delivered"  # delivered ones are left alone
+    assert outbox.get(again)["status"] == "pending"
+
+
+def test_backoff_schedule(monkeypatch):
+    monkeypatch.setattr(_outbox, "OUTBOX_BASE_DELAY", 2.0)
+    monkeypatch.setattr(_outbox, "OUTBOX_MAX_DELAY", 60.0)
+    monkeypatch.setattr(_outbox.random, "uniform", lambda lo, hi: hi)
+    assert [_outbox.backoff(n) for n in range(1, 8)] == [2, 4, 8, 16, 32, 60, 60]
+    monkeypatch.setattr(_outbox.random, "uniform", lambda lo, hi: lo)
+    assert _outbox.backoff(3) == 4  # jitter takes off at most half
+
+
+def test_retries_until_max_attempts(outbox, clock, receiver, monkeypatch):
+    monkeypatch.setattr(_outbox, "OUTBOX_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(_outbox.random, "uniform", lambda lo, hi: hi)
+    receiver.statuses = [503, ConnectionResetError("reset"), 503]
+    worker = OutboxWorker(outbox)
+    callback_id = outbox.enqueue("http://cb", {"product_id": "p1", "auth_token": "t"})
+
+    for attempt, delay in ((1, 2.0), (2, 4.0)):
+        deliver(worker, outbox.claim(10)[0])
+        cb = outbox.get(callback_id)
+        assert (cb["status"], cb["attempts"]) == ("pending", attempt)
+        assert cb["next_attempt_at"] == pytest.approx(clock.now + delay)
+        clock.now += delay - 0.5
+        assert outbox.claim(10) == []  # not due yet
+        clock.now += 0.5
+    assert outbox.get(callback_id)["last_error"] == "ConnectionResetError: reset"
+
+    deliver(worker, outbox.claim(10)[0])
+    cb = outbox.get(callback_id)
+    assert (cb["status"], cb["attempts"], cb["last_status"]) == ("failed", 3, 503)
+    assert _stored(outbox, callback_id)[1] == "{}" and callback_id not in outbox._secrets
+    assert worker.counters == {"attempts": 3, "delivered": 0, "retried": 2, "failed": 1}
+    assert [c["payload"]["auth_token"] for c in receiver.calls] == ["t"] * 3
+    assert {c["headers"]["Idempotency-Key"] for c in receiver.calls} == {callback_id}
+
+
+@pytest.mark.parametrize("status, outcome", [
+    *((s, "pending") for s in _outbox.RETRY_STATUS),
+    (400, "failed"), (401, "failed"), (404, "failed"), (410, "failed"), (301, "failed"),
+    (204, "delivered"),
+])
+def test_receiver_status_decides_retry(outbox, receiver, status, outcome):
+    receiver.statuses = [status]
+    callback_id = outbox.enqueue("http://cb", {"product_id": "p1"})
+    deliver(OutboxWorker(outbox), outbox.claim(10)[0])
+    cb = outbox.get(callback_id)
+    assert cb["status"] == outcome and cb["last_status"] == status
@@ -0,0 +1,80 @@
+import io, random, itertools
+
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image, ImageDraw, ImageFilter
+
+import image_generator
+from _cache import PerceptualCache, dhash, color_signature
+
+
+def product_shot(seed: int, w: int = 384, h: int = 512) -> Image.Image:
+    """One shared layout (backdrop, shadow, placement); the product's shape, size and colour vary."""
+    r = random.Random(seed)
+    img = Image.new("RGB", (w, h), (245, 245, 242))
+    d = ImageDraw.Draw(img)
+    d.ellipse((w * 0.25, h * 0.78, w * 0.75, h * 0.86), fill=(215, 215, 210))
+    bw, bh = r.uniform(0.3, 0.5) * w, r.uniform(0.45, 0.65) * h
+    box = (w / 2 - bw / 2, h * 0.82 - bh, w / 2 + bw / 2, h * 0.82)
+    color = tuple(r.randrange(30, 230) for _ in range(3))
+    getattr(d, r.choice(["rectangle", "ellipse"]))(box, fill=color)
+    for _ in range(r.randrange(0, 4)):  # labels
+        x, y = r.uniform(box[0], box[2] - 30), r.uniform(box[1], box[3] - 20)
+        d.rectangle((x, y, x + r.uniform(15, 60), y + r.uniform(5, 20)), fill=tuple(r.randrange(256) for _ in range(3)))
+    return img.filter(ImageFilter.GaussianBlur(1))
+
+
+def encode(img: Image.Image, fmt: str = "PNG", scale: float = 1.0, **kwargs) -> bytes:
+    if scale != 1.0:
+        img = img.resize((round(img.width * scale), round(img.height * scale)))
+    buf = io.BytesIO()
+    img.save(buf, fmt, **kwargs)
+    return buf.getvalue()
+
+
+def key(data: bytes):
+    return dhash(data), color_signature(data)
+
+
+def test_false_positive_and_recall_rates():
+    shots = [product_shot(i) for i in range(40)]
+
+    misses = 0
+    for img in shots:
+        h, sig = key(encode(img))
+        for variant in (encode(img, "JPEG", quality=70), encode(img, "JPEG", 0.5, quality=85),
+                        encode(img, "WEBP", 0.75, quality=75)):
+            c = PerceptualCache()
+            c.put(h, "described", sig)
+            misses += c.get(*key(variant)) is None
+    assert misses / (3 * len(shots)) <= 0.05  # re-encodes and resizes still hit
+
+    false_hits = 0
+    keys = [key(encode(img)) for img in shots]
+    for (h1, s1), (h2, s2) in itertools.combinations(keys, 2):
+        c = PerceptualCache()
+        c.put(h1, "described", s1)
+        false_hits += c.get(h2, s2) is not None
+    assert false_hits <= 1  # of 780 same-layout pairs; dHash alone at distance 6 matched 92
+
+
+def test_same_gradients_different_colour_is_a_miss():
+    a = Image.new("RGB", (256, 256), (240, 240, 240))
+    b = a.copy()
+    ImageDraw.Draw(a).rectangle((64, 64, 192, 192), fill=(200, 30, 30))
+    ImageDraw.Draw(b).rectangle((64, 64, 192, 192), fill=(30, 120, 30))  # close luminance, other product
+    (ha, sa), (hb, sb) = key(encode(a)), key(encode(b))
+    cache = PerceptualCache()
+    cache.put(ha, "red box", sa)
+    assert cache.get(ha, sa) == "red box"
+    assert cache.get(hb, sb) is None
+
+
+def test_describe_cache_per_model_and_mode():
+    assert set(image_generator.describe_caches) == {
+        (image_generator.DESCRIBE_MODEL, "two_pass"), (image_generator.COMBINED_MODEL, "single_pass")}
+    two, single = image_generator.describe_cache_for("two_pass"), image_generator.describe_cache_for("single_pass")
+    assert two is not single
+    two.put(1, "two-pass description")
+    assert single.get(1) is None
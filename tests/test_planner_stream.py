@@ -0,0 +1,172 @@
+import json, time
+
+import pytest
+
+import improve2
+import fake_openai
+
+PLAN = {
+    "prompt1": 'Marble counter, "soft" morning light',
+    "prompt2": "Kitchen shelf \\ rustic wood, café props",
+    "prompt3": "Beach at dusk, low angle",
+}
+TEXT = json.dumps(PLAN, indent=2)  # escaped quotes, backslashes and \u escapes to split across chunks
+IMAGE = "data:image/jpeg;base64,AAAA"
+
+
+def chunked(text: str, size: int) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def fake_deltas(chunks: list, sent: list, fail: Exception = None):
+    async def _planner_deltas(image_ref, k):
+        for c in chunks:
+            sent.append(c)
+            yield c
+        if fail is not None:
+            raise fail
+    return _planner_deltas
+
+
+@pytest.fixture
+def batch_planner(monkeypatch):
+    """Replaces plan_prompts (the fallback) and records its calls."""
+    calls = []
+
+    async def plan_prompts(image_ref, k):
+        calls.append(k)
+        return {"prompt1": "batch plan"}
+    monkeypatch.setattr(improve2, "plan_prompts", plan_prompts)
+    return calls
+
+
+def plan(k=3, on_prompt=None, image=IMAGE):
+    return improve2.run_sync(improve2.plan_prompts_streaming(image, k, on_prompt=on_prompt))
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 11, 64])
+def test_prompts_handed_out_as_soon_as_complete(monkeypatch, batch_planner, size):
+    sent = []
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(chunked(TEXT, size), sent))
+    emitted = []
+    out = plan(on_prompt=lambda key, value: emitted.append((key, value, len("".join(sent)))))
+
+    assert out == PLAN
+    assert [(key, value) for key, value, _ in emitted] == list(PLAN.items())
+    for key, value, seen in emitted:
+        # the chunk with the value's closing quote, not the end of the stream
+        end = TEXT.index(json.dumps(value)) + len(json.dumps(value))
+        assert end <= seen < end + size
+    assert batch_planner == []
+
+
+def test_code_fenced_output(monkeypatch, batch_planner):
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(chunked(f"```json\n{TEXT}\n```", 4), []))
+    assert plan() == PLAN
+
+
+def test_prompt_keys_out_of_range_are_not_handed_out(monkeypatch, batch_planner):
+    emitted = []
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(chunked(TEXT, 5), []))
+    plan(k=2, on_prompt=lambda key, value: emitted.append(key))
+    assert emitted == ["prompt1", "prompt2"]
+
+
+def test_truncated_output_uses_streamed_prompts(monkeypatch, batch_planner):
+    cut = TEXT.index('"prompt3"') + 15  # mid-value
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(chunked(TEXT[:cut], 6), []))
+    assert plan() == {"prompt1": PLAN["prompt1"], "prompt2": PLAN["prompt2"]}
+    assert batch_planner == []
+
+
+def test_malformed_output_falls_back_to_batch_planner(monkeypatch, batch_planner):
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(chunked("Sorry, I can't help with that.", 4), []))
+    assert plan() == {"prompt1": "batch plan"}
+    assert batch_planner == [3]
+
+
+def test_json_without_prompts_falls_back_to_batch_planner(monkeypatch, batch_planner):
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(['{"ideas": ', '["a", "b"]}'], []))
+    assert plan() == {"prompt1": "batch plan"}
+
+
+def test_stream_failing_before_any_prompt_falls_back(monkeypatch, batch_planner):
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(chunked(TEXT[:20], 4), [], ConnectionError("reset")))
+    assert plan() == {"prompt1": "batch plan"}
+    assert batch_planner == [3]
+
+
+def test_stream_breaking_off_keeps_prompts_handed_out(monkeypatch, batch_planner):
+    cut = TEXT.index('"prompt2"') + 5
+    emitted = []
+    monkeypatch.setattr(improve2, "_planner_deltas", fake_deltas(chunked(TEXT[:cut], 4), [], ConnectionError("reset")))
+    assert plan(on_prompt=lambda key, value: emitted.append(key)) == {"prompt1": PLAN["prompt1"]}
+    assert emitted == ["prompt1"]
+    assert batch_planner == []
+
+
+# --- against the offline fake server, through the OpenAI SDK -------------------
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    openai = pytest.importorskip("openai")
+    started = []
+
+    def start(**kwargs):
+        fake = fake_openai.FakeOpenAI(**{"latency_text": "fixed:0.05", **kwargs})
+        base_url = fake.start()
+        started.append(fake)
+        monkeypatch.setattr(improve2, "aclient", openai.AsyncOpenAI(base_url=base_url, api_key="sk-test",
+                                                                    max_retries=0))
+        return fake
+
+    yield start
+    for fake in started:
+        fake.stop()
+
+
+def _calls(fake, endpoint):
+    return fake.stats()["by_endpoint"].get(endpoint, 0)
+
+
+@pytest.mark.parametrize("chunk", [1, 3, 7, 16])
+def test_fake_server_stream(fake_server, chunk):
+    fake = fake_server(stream_chunk=chunk, latency_text="fixed:0.6")
+    emitted = []
+    started = time.monotonic()
+    out = plan(on_prompt=lambda key, value: emitted.append((key, time.monotonic())))
+    finished = time.monotonic()
+
+    assert sorted(out) == ["prompt1", "prompt2", "prompt3"]
+    assert [key for key, _ in emitted] == ["prompt1", "prompt2", "prompt3"]
+    # the events are spread over the call's latency: prompt1 arrives well before the stream ends
+    assert emitted[0][1] - started < (finished - started) * 0.8
+    assert _calls(fake, "chat.completions") == 1
+
+
+def test_fake_server_responses_stream_for_uploaded_input(fake_server):
+    fake = fake_server(stream_chunk=5)
+    emitted = []
+    out = plan(on_prompt=lambda key, value: emitted.append(key), image=improve2.InputRef(IMAGE, file_id="file-1"))
+    assert sorted(out) == emitted == ["prompt1", "prompt2", "prompt3"]
+    assert _calls(fake, "responses") == 1 and _calls(fake, "chat.completions") == 0
+
+
+def test_fake_server_malformed_stream_falls_back(fake_server):
+    fake = fake_server(stream_text="I cannot produce JSON today.")
+    out = plan()
+    assert sorted(out) == ["prompt1", "prompt2", "prompt3"]  # from the batch (non-streamed) call
+    assert _calls(fake, "chat.completions") == 2
+
+
+def test_fake_server_truncated_stream(fake_server):
+    fake = fake_server(stream_text=TEXT[:TEXT.index('"prompt3"') + 15], stream_chunk=4)
+    assert plan() == {"prompt1": PLAN["prompt1"], "prompt2": PLAN["prompt2"]}
+    assert _calls(fake, "chat.completions") == 1
+
+
+def test_fake_server_stream_broken_before_any_prompt(fake_server):
+    fake = fake_server(stream_abort_after=2)
+    out = plan()
+    assert sorted(out) == ["prompt1", "prompt2", "prompt3"]
+    assert _calls(fake, "chat.completions") == 2
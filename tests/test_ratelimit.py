@@ -0,0 +1,198 @@
+import asyncio, threading, email.utils
+from types import SimpleNamespace
+
+import pytest
+
+import _ratelimit
+from _ratelimit import AdaptiveLimiter, _SharedBucket, retry_after
+from _deadline import Deadline, DeadlineExceeded, use_deadline, current_deadline
+
+
+class FakeClock:
+    """time.time / time.monotonic / asyncio.sleep for the limiter: sleeping advances the clock at once."""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now, self.sleeps = now, []
+
+    def time(self):
+        return self.now
+
+    monotonic = time
+
+    async def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+class UpstreamError(Exception):
+    """Shaped like the SDK's APIStatusError: status_code, code and response.headers."""
+
+    def __init__(self, status: int, headers: dict = None, code: str = None):
+        super().__init__(f"HTTP {status}")
+        self.status_code, self.code = status, code
+        self.response = SimpleNamespace(status_code=status, headers=headers or {})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = FakeClock()
+    monkeypatch.setattr(_ratelimit, "time", SimpleNamespace(time=c.time, monotonic=c.monotonic))
+    monkeypatch.setattr(_ratelimit, "asyncio", SimpleNamespace(
+        sleep=c.sleep, get_running_loop=asyncio.get_running_loop, to_thread=asyncio.to_thread))
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_RPS", 0.0)
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_MIN_CONC", 1)
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_MAX_CONC", 8)
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_MAX_RETRIES", 5)
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_BASE_DELAY", 1.0)
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_MAX_DELAY", 5.0)
+    monkeypatch.setattr(_ratelimit.random, "uniform", lambda lo, hi: hi)  # the top of every jitter range
+    return c
+
+
+def scripted(*outcomes):
+    """A make_call that raises or returns the outcomes in turn; records how often it ran."""
+    outcomes = list(outcomes)
+    calls = []
+
+    async def make_call():
+        calls.append(1)
+        out = outcomes.pop(0)
+        if isinstance(out, Exception):
+            raise out
+        return out
+    make_call.calls = calls
+    return make_call
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_throttle_halves_the_limit_once_per_cooldown(clock):
+    lim = AdaptiveLimiter(shared_db="")
+    assert lim.limit == 8
+    assert run(lim.call(scripted(UpstreamError(429), UpstreamError(429), "ok"))) == "ok"
+    # the second 429 came within AIMD_COOLDOWN of the first (the 1 s retry sleep): one decrease
+    assert lim.counters["limit_decreases"] == 1 and lim.counters["throttled"] == 2
+    assert 4 < lim.limit < 5  # halved, then +1/limit for the success
+
+    for _ in range(4):
+        clock.now += _ratelimit.AIMD_COOLDOWN
+        run(lim._on_throttle(None))
+    assert lim.limit == 1.0  # floored at RATE_LIMIT_MIN_CONC
+    assert lim.counters["limit_decreases"] == 5
+
+
+def test_successes_grow_the_limit_additively_up_to_the_cap(clock):
+    lim = AdaptiveLimiter(shared_db="")
+    lim.limit = 4.0
+    for _ in range(4):
+        run(lim.call(scripted("ok")))
+    assert 4.9 < lim.limit < 5.0  # about +1 per window of `limit` successes
+    for _ in range(200):
+        run(lim.call(scripted("ok")))
+    assert lim.limit == 8.0
+
+
+@pytest.mark.parametrize("headers, sleeps", [
+    ({"retry-after": "7"}, [5.0, 2.0]),  # backoff sleep capped at RATE_LIMIT_MAX_DELAY, the pause does the rest
+    ({"retry-after-ms": "2500"}, [2.5]),
+    ({"retry-after": "30"}, [5.0, 25.0]),
+])
+def test_retry_after_is_honoured(clock, monkeypatch, headers, sleeps):
+    monkeypatch.setattr(_ratelimit.random, "uniform", lambda lo, hi: lo)  # no jitter on top
+    lim = AdaptiveLimiter(shared_db="")
+    hint = retry_after(UpstreamError(429, headers))
+    started = clock.now
+    assert run(lim.call(scripted(UpstreamError(429, headers), "ok"))) == "ok"
+    assert clock.sleeps == sleeps
+    assert clock.now - started == pytest.approx(hint)  # never earlier than the server asked
+    # the pause holds back every caller, not just the throttled one
+    assert lim.bucket.paused_until == pytest.approx(started + hint)
+    assert run(lim.call(scripted("ok"))) == "ok" and clock.sleeps == sleeps
+
+
+def test_retry_after_http_date(clock):
+    date = email.utils.formatdate(clock.now + 30, usegmt=True)
+    assert retry_after(UpstreamError(429, {"retry-after": date})) == pytest.approx(30, abs=1)
+    assert retry_after(UpstreamError(429, {"retry-after": "soon"})) is None
+    assert retry_after(UpstreamError(429)) is None
+
+
+def test_jittered_backoff_is_capped_and_retries_are_bounded(clock):
+    lim = AdaptiveLimiter(shared_db="")
+    make_call = scripted(*[UpstreamError(503)] * 6)
+    with pytest.raises(UpstreamError):
+        run(lim.call(make_call))
+    assert len(make_call.calls) == 6  # the first try and RATE_LIMIT_MAX_RETRIES retries
+    assert clock.sleeps == [1.0, 2.0, 4.0, 5.0, 5.0]  # 2^n, capped at RATE_LIMIT_MAX_DELAY
+    assert lim.counters["retries"] == 5 and lim.counters["gave_up"] == 1
+    assert lim.counters["limit_decreases"] == 0  # a 5xx is not a throttle
+
+
+def test_not_retried(clock):
+    lim = AdaptiveLimiter(shared_db="")
+    for error in (UpstreamError(400), UpstreamError(429, code="insufficient_quota")):
+        make_call = scripted(error)
+        with pytest.raises(UpstreamError):
+            run(lim.call(make_call))
+        assert len(make_call.calls) == 1
+    assert clock.sleeps == [] and lim.in_flight == 0
+
+
+def test_no_retry_past_the_deadline(clock, monkeypatch):
+    lim = AdaptiveLimiter(shared_db="")
+
+    async def call():
+        use_deadline(Deadline(3))  # real clock; the retry would need 10 s
+        return await lim.call(scripted(UpstreamError(429, {"retry-after": "10"}), "ok"))
+
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_MAX_DELAY", 60.0)
+    with pytest.raises(DeadlineExceeded):
+        run(call())
+    assert clock.sleeps == [] and lim.counters["gave_up"] == 1
+
+
+def test_concurrency_is_held_to_the_limit(clock):
+    lim = AdaptiveLimiter(shared_db="")
+    lim.limit = 2.0
+    peak = []
+
+    async def make_call():
+        peak.append(lim.in_flight)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        return "ok"
+
+    async def many():
+        return await asyncio.gather(*(lim.call(make_call) for _ in range(6)))
+
+    assert run(many()) == ["ok"] * 6
+    assert max(peak) == 2 and lim.in_flight == 0
+
+
+def test_shared_bucket_across_processes(clock, tmp_path, monkeypatch):
+    monkeypatch.setattr(_ratelimit, "RATE_LIMIT_BURST", 2.0)
+    path = str(tmp_path / "bucket.sqlite3")
+    a, b = _SharedBucket(path), _SharedBucket(path)  # two processes on one host
+
+    assert a.take(1.0, 2.0) == 0 and b.take(1.0, 2.0) == 0
+    assert a.take(1.0, 2.0) == pytest.approx(1.0)  # the burst is spent by both together
+    clock.now += 3
+    assert b.take(1.0, 2.0) == 0
+
+    a.pause(clock.now + 20)
+    b.pause(clock.now + 5)  # a shorter pause does not shorten the longer one
+    assert b.take(0, 2.0) == pytest.approx(20)
+
+
+def test_call_blocking_runs_on_limiter_threads_with_the_callers_deadline():
+    lim = AdaptiveLimiter(shared_db="")
+    deadline = Deadline(60)
+    use_deadline(deadline)
+    try:
+        name, seen = lim.call_blocking(lambda: (threading.current_thread().name, current_deadline()))
+    finally:
+        use_deadline(None)
+    assert name.startswith("upstream-blocking") and seen is deadline
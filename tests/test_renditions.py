@@ -0,0 +1,100 @@
+import io, base64
+
+import pytest
+
+import _imaging
+import improve2
+from _imaging import parse_renditions, make_renditions
+
+
+def _png(w=320, h=480):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (w, h), (200, 40, 40)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_presets_and_dict_specs():
+    specs = parse_renditions(["4x5", {"aspect": "3:2", "max_edge": 640, "quality": 70}])
+    assert [s["name"] for s in specs] == ["4x5", "3x2@640"]
+    assert specs[1]["max_edge"] == 640 and specs[1]["quality"] == 70
+
+
+@pytest.mark.parametrize("spec", [
+    {"aspect": "1:1", "crop": "top"},         # unknown key
+    {"aspect": "1:1", "max_edge": 0},
+    {"aspect": "1:1", "max_edge": -5},
+    {"aspect": "1:1", "max_edge": "big"},
+    {"aspect": "1:1", "max_edge": [256]},
+    {"aspect": "1:100"},                      # sliver
+    {"aspect": "5:1"},
+    {"aspect": "1:1", "quality": 0},
+    {"aspect": "1:1", "quality": 101},
+    {"aspect": "1:1", "name": "../x"},
+    {"aspect": "1:1", "name": 7},
+])
+def test_bad_specs_are_rejected(spec):
+    with pytest.raises(ValueError):
+        parse_renditions([spec])
+
+
+def test_failed_rendition_is_reported_not_dropped(monkeypatch):
+    real = _imaging.encode_image
+
+    def encode(img, fmt, quality=None):
+        if img.width == img.height:  # the square thumb
+            raise OSError("encoder exploded")
+        return real(img, fmt, quality)
+
+    monkeypatch.setattr(_imaging, "encode_image", encode)
+    specs = [improve2.PRIMARY_RENDITION] + parse_renditions(["thumb"])
+    out = improve2._encode_renditions(make_renditions(_png(), specs))
+    assert out[0]["bytes"] > 0 and "error" not in out[0]
+    assert out[1] == {"name": "thumb", "aspect": "1:1", "format": "jpeg", "error": "encoder exploded"}
+
+    item = improve2.rendered_item("p", out)
+    assert item["image"].startswith("data:image/jpeg;base64,")
+    assert item["renditions"]["thumb"] == {"error": "encoder exploded", "aspect": "1:1", "format": "jpeg"}
+    base64.b64decode(item["image"].split(",", 1)[1])
+
+
+class _FakePool:
+    """Stands in for a spawn pool whose workers crash or hang while bootstrapping."""
+
+    def __init__(self, *args, fail=None, **kwargs):
+        from concurrent.futures import Future
+        self.fail, self.shut_down, self._future = fail, False, Future
+        self._processes = {}
+
+    def submit(self, fn, *args):
+        f = self._future()
+        if self.fail is not None:
+            f.set_exception(self.fail)
+        return f  # without a failure the worker never answers
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+@pytest.mark.parametrize("fail", [None, "broken"])
+def test_post_process_falls_back_when_pool_does_not_start(monkeypatch, fail):
+    import asyncio, concurrent.futures
+    from concurrent.futures.process import BrokenProcessPool
+
+    pools = []
+
+    def make_pool(*args, **kwargs):
+        pools.append(_FakePool(fail=BrokenProcessPool("worker died") if fail else None))
+        return pools[-1]
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", make_pool)
+    monkeypatch.setattr(improve2, "_pp_pool", None)
+    monkeypatch.setattr(improve2, "_pp_probe", None)
+    monkeypatch.setattr(improve2, "POST_PROCESS_WORKERS", 2)
+    monkeypatch.setattr(improve2, "POST_PROCESS_POOL_START_TIMEOUT", 0.2)
+
+    b64 = base64.b64encode(_png()).decode()
+    out = asyncio.run(improve2.post_process_offloaded(b64))
+    assert out[0]["name"] == "9x16" and out[0]["bytes"] > 0
+    assert pools[0].shut_down
+    assert improve2.POST_PROCESS_WORKERS == 0 and improve2.get_post_process_pool() is None
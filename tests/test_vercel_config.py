@@ -0,0 +1,20 @@
+import os, re, json
+
+from _deadline import FUNCTION_MAX_DURATION
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_routes_with_deadlines_get_the_max_duration():
+    # REQUEST_DEADLINE assumes FUNCTION_MAX_DURATION; a route left at the platform default is
+    # killed long before its deadline
+    with open(os.path.join(ROOT, "vercel.json")) as f:
+        functions = json.load(f)["functions"]
+    api = os.path.join(ROOT, "api")
+    for name in sorted(os.listdir(api)):
+        if name.startswith("_") or not name.endswith(".py"):
+            continue
+        with open(os.path.join(api, name)) as f:
+            source = f.read()
+        if re.search(r"^from _deadline import|^import (improve2|image_generator)\b", source, re.M):
+            assert functions.get(f"api/{name}", {}).get("maxDuration", 0) >= FUNCTION_MAX_DURATION, name